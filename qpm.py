@@ -29,6 +29,9 @@ import matplotlib.pylab as pylab
 import matplotlib.dates as mdates
 
 import pdb, os, time
+import contextlib, itertools, hashlib, json, glob, collections, functools, sys, threading, shutil, weakref
+
+from concurrent.futures import ProcessPoolExecutor
 
 from cycler import cycler
 from matplotlib import rcParams
@@ -36,6 +39,8 @@ from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from pandas.tseries.offsets import MonthEnd
 from scipy.stats.mstats import winsorize
+from scipy.stats import t as t_dist
+import scipy.sparse as sp
 
 DataFrame = pd.DataFrame
 Series = pd.Series
@@ -97,22 +102,216 @@ def return_signal(_STRATEGY_NAME):
 
     return signal_variables
 
-def list_variables(data_dir, file_name):
+#------------------------------------------------#
+#  Instrumentation
+
+## Records of the last _MAX_STAGE_RECORDS finished stages in this process, oldest first (see stage_report).
+## The per-month stages of stream_backtest / update_strategy would otherwise grow the list without bound in a
+## long-lived process, so the oldest records are dropped; export_stages regularly to keep a full history.
+_MAX_STAGE_RECORDS = 100000
+_STAGE_RECORDS = collections.deque(maxlen = _MAX_STAGE_RECORDS)
+
+## Nesting depth of the open stages and the open step, per thread (qpm_download runs its queries on worker
+## threads, and downloads on different threads each have their own sequence of steps)
+_STAGE_LOCAL = threading.local()
+
+## set_quiet(True) silences the '> ...' progress messages of the pipeline and the download steps
+_QUIET = False
+
+def set_quiet(quiet = True):
+
+	global _QUIET
+	_QUIET = quiet
+
+def log(message):
+
+	if not _QUIET:
+		print(message)
+
+def _peak_rss():
+
+	## Peak resident set size of the process in bytes; None where the resource module is missing (Windows)
+	try:
+		import resource
+	except ImportError:
+		return None
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+def _num_rows(obj):
+
+	## Rows of a DataFrame / Series, or of the first one in a tuple of results
+	if isinstance(obj, (DataFrame, Series)):
+		return len(obj)
+	if isinstance(obj, tuple):
+		return next((len(x) for x in obj if isinstance(x, (DataFrame, Series))), None)
+	return None
+
+def stage_depth():
+
+	return getattr(_STAGE_LOCAL, 'depth', 0)
+
+def set_stage_depth(depth):
+
+	## A worker thread inherits the depth of the stage that submitted its work
+	_STAGE_LOCAL.depth = depth
+
+def begin_stage(name, rows_in = None, **info):
+
+	record = dict({'stage' : name, 'depth' : stage_depth(), 'started' : datetime.now().isoformat(timespec = 'seconds'),
+				   'rows_in' : rows_in, 'rows_out' : None}, **info)
+	record['_start'] = (time.perf_counter(), time.process_time(), _peak_rss())
+	set_stage_depth(record['depth'] + 1)
+
+	return record
+
+def end_stage(record, rows_out = None):
+
+	## Wall and CPU seconds, and by how much the stage raised the process's peak RSS
+	start_wall, start_cpu, start_rss = record.pop('_start')
+	peak_rss = _peak_rss()
+
+	record['wall_seconds'] = time.perf_counter() - start_wall
+	record['cpu_seconds'] = time.process_time() - start_cpu
+	record['peak_rss_delta'] = max(peak_rss - start_rss, 0) if peak_rss is not None else None
+	record['peak_rss'] = peak_rss
+	if rows_out is not None:
+		record['rows_out'] = rows_out
+
+	set_stage_depth(record['depth'])
+	_STAGE_RECORDS.append(record)
+
+	return record
+
+@contextlib.contextmanager
+def stage(name, rows_in = None, **info):
+
+	## with stage('name', rows_in = len(df)) as record: ...; record['rows_out'] = len(result)
+	record = begin_stage(name, rows_in, **info)
+	try:
+		yield record
+	finally:
+		end_stage(record)
+
+def instrumented(func):
+
+	## Record a stage for every call of func, with the rows of its first DataFrame argument and of its result
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		df_in = next((x for x in args if isinstance(x, DataFrame)), None)
+		with stage(func.__name__, len(df_in) if df_in is not None else None) as record:
+			result = func(*args, **kwargs)
+			record['rows_out'] = _num_rows(result)
+		return result
+
+	return wrapper
+
+def step(message, pipeline = None):
+
+	## Sequential steps of a script (qpm_download): closes the previous step, prints message and opens a new one
+	close_step()
+	log(message)
+	_STAGE_LOCAL.open_step = begin_stage(message, pipeline = pipeline)
+
+def step_done(message = 'Done', rows_out = None):
+
+	close_step(rows_out)
+	log(message)
+
+def close_step(rows_out = None):
+
+	open_step = getattr(_STAGE_LOCAL, 'open_step', None)
+	if open_step is not None:
+		_STAGE_LOCAL.open_step = None
+		end_stage(open_step, rows_out)
+
+def stage_report():
+
+	## One row per finished stage (nested stages have a larger depth and finish before their parent)
+	columns = ['stage', 'depth', 'started', 'wall_seconds', 'cpu_seconds', 'peak_rss_delta', 'peak_rss', 'rows_in', 'rows_out']
+	df_report = DataFrame(list(_STAGE_RECORDS))
+	extra = [x for x in df_report.columns if x not in columns]
+
+	return df_report.reindex(columns = columns + extra)
+
+def export_stages(path):
+
+	with open(path, 'w') as f:
+		json.dump(list(_STAGE_RECORDS), f, indent = 1, default = str)
+
+def reset_stages():
+
+	_STAGE_RECORDS.clear()
+
+#------------------------------------------------#
+#  File Catalog
+
+## Metadata of files already inspected, keyed by (path, size, mtime)
+_CATALOG = {}
+
+def _parquet_catalog(path):
+
+	import pyarrow.parquet as pq
+
+	parquet_file = pq.ParquetFile(path)
+	metadata = parquet_file.metadata
+
+	## Skip the columns pandas uses to store the index
+	pandas_metadata = parquet_file.schema_arrow.pandas_metadata or {}
+	index_columns = [x for x in pandas_metadata.get('index_columns', []) if isinstance(x, str)]
+	columns = [x for x in parquet_file.schema_arrow.names if x not in index_columns]
+
+	## Row-group statistics (row counts and the ldate range when it is recorded)
+	row_groups = []
+	ldate_pos = parquet_file.schema_arrow.get_field_index('ldate')
+	for i in range(metadata.num_row_groups):
+		row_group = metadata.row_group(i)
+		stats = {'num_rows' : row_group.num_rows, 'ldate_min' : None, 'ldate_max' : None}
+		if ldate_pos >= 0:
+			column_stats = row_group.column(ldate_pos).statistics
+			if column_stats is not None and column_stats.has_min_max:
+				stats['ldate_min'], stats['ldate_max'] = pd.Timestamp(column_stats.min), pd.Timestamp(column_stats.max)
+		row_groups.append(stats)
+
+	ldate_min = [x['ldate_min'] for x in row_groups if x['ldate_min'] is not None]
+	ldate_max = [x['ldate_max'] for x in row_groups if x['ldate_max'] is not None]
 
+	return {'columns' : columns, 'num_rows' : metadata.num_rows, 'row_groups' : row_groups,
+			'ldate_min' : min(ldate_min) if ldate_min else None, 'ldate_max' : max(ldate_max) if ldate_max else None}
 
-	file_type = file_name.split('.')[-1]
+def catalog(data_dir, file_name):
+
+	## File metadata without reading the data: columns for every type, plus row count, row-group
+	## statistics and the ldate range for parquet. Results are cached until the file changes.
+	path = os.path.abspath('%s/%s' %(data_dir, file_name))
+	file_type = _file_type(path)
+	key = (path,) + _source_stat(path)
+
+	if key in _CATALOG:
+		return _CATALOG[key]
 
 	if file_type == 'dta':
-		header = pd.io.stata.StataReader('%s/%s' %(data_dir, file_name)).variable_labels()
-		header = list(header.keys())
+		with pd.io.stata.StataReader(path) as reader:
+			info = {'columns' : list(reader.variable_labels().keys())}
 	elif file_type == 'csv':
-		header = pd.read_csv('%s/%s' %(data_dir, file_name), nrows = 1)
-		header = list(header.columns)
+		info = {'columns' : list(pd.read_csv(path, nrows = 0).columns)}
 	elif file_type == 'parquet':
-		header = pd.read_parquet('%s/%s' %(data_dir, file_name))
-		header = list(header.columns)
+		info = _parquet_catalog(path)
+	elif file_type == 'dataset':
+		info = _dataset_catalog(path)
 	else:
-		raise Exception('Please provide a valid file_type: .dta or .csv')
+		raise Exception('Please provide a valid file_type: .dta, .csv, .parquet or a partitioned dataset directory')
+
+	info = dict({'file_type' : file_type, 'num_rows' : None, 'row_groups' : None, 'ldate_min' : None, 'ldate_max' : None}, **info)
+	_CATALOG[key] = info
+
+	return info
+
+def list_variables(data_dir, file_name):
+
+
+	header = catalog(data_dir, file_name)['columns']
 
 	## Print output of the headers based on the type of variables
 	list_dic = {'Identifiers' : ['permno', 'ticker', 'comnam', 'conm', 'gvkey', 'cusip', 'lpermco'],
@@ -135,19 +334,358 @@ def list_variables(data_dir, file_name):
 		print(item + ':')
 		print('%s\n' %([x for x in header if x in list_dic[item]]))
 
-def load_data(data_dir, file_name, variable_list = []):
+#------------------------------------------------#
+#  Partitioned Datasets
+
+## Directories with one parquet file per calendar year (year=YYYY/part-0.parquet), written chunk by chunk by
+## qpm_download in streaming mode. load_data reads them (pass the directory as file_name) and skips the
+## years outside start_date / end_date without opening their files.
+_PARTITION_COLUMN = 'year'
+
+def _file_type(path):
+
+	return 'dataset' if os.path.isdir(path) else path.split('.')[-1]
+
+def _source_stat(path):
+
+	## (size, mtime) of a file; for a dataset, the total size and latest mtime of its parquet files
+	if not os.path.isdir(path):
+		stat = os.stat(path)
+		return stat.st_size, stat.st_mtime_ns
+
+	stats = [os.stat(f) for f in glob.glob(os.path.join(path, '**', '*.parquet'), recursive = True)]
+	return sum(x.st_size for x in stats), max([x.st_mtime_ns for x in stats], default = 0)
+
+def write_partitions(df, output_dir, date_column = 'ldate', append = False):
+
+	## Write the rows of each calendar year of date_column to output_dir/year=YYYY/part-0.parquet, replacing
+	## the partition if it exists. The temporary file is hidden so that readers never pick up a partial write.
+	## With append = True the rows are added to the existing partition instead (new rows win on the same
+	## permno and date), as qpm_download does in incremental mode.
+	years = df[date_column].dt.year
+	key = [x for x in ['permno', date_column] if x in df.columns]
+	for year, df_year in df.groupby(years, sort = True):
+		partition_dir = os.path.join(output_dir, '%s=%d' %(_PARTITION_COLUMN, year))
+		os.makedirs(partition_dir, exist_ok = True)
+		partition_file = os.path.join(partition_dir, 'part-0.parquet')
+		temp_file = os.path.join(partition_dir, '.part-0.parquet.%d.tmp' %(os.getpid()))
+		if append and os.path.exists(partition_file):
+			df_year = pd.concat([pd.read_parquet(partition_file), df_year], ignore_index = True)
+			df_year = df_year.drop_duplicates(subset = key, keep = 'last')
+		df_year.to_parquet(temp_file, index = False)
+		os.replace(temp_file, partition_file)
+
+	return sorted(years.unique())
+
+def clear_partitions(output_dir):
+
+	## Remove the year partitions of output_dir (other files are left alone). A new download into the directory
+	## starts with this, so that years outside its sample are not read along with it.
+	for partition_dir in glob.glob(os.path.join(output_dir, '%s=*' %(_PARTITION_COLUMN))):
+		shutil.rmtree(partition_dir)
+
+def _open_dataset(path):
+
+	import pyarrow as pa
+	import pyarrow.dataset as ds
+
+	## Years in which a column is entirely missing (e.g. ESG scores before 2000) store it as null, so the
+	## dataset schema is the promotion of the schemas of all partitions
+	dataset = ds.dataset(path, format = 'parquet', partitioning = 'hive')
+	schema = pa.unify_schemas([x.physical_schema for x in dataset.get_fragments()] + [dataset.schema], promote_options = 'permissive')
+
+	return ds.dataset(path, schema = schema, format = 'parquet', partitioning = 'hive')
+
+def _dataset_catalog(path):
+
+	dataset = _open_dataset(path)
+	partitions = sorted(int(x.split('=')[1]) for x in os.listdir(path) if x.startswith('%s=' %(_PARTITION_COLUMN)))
+
+	return {'columns' : [x for x in dataset.schema.names if x != _PARTITION_COLUMN], 'num_rows' : dataset.count_rows(),
+			'partitions' : partitions}
+
+def read_dataset(path, columns = None, start_date = None, end_date = None, date_column = 'ldate'):
+
+	## Rows with date_column in [start_date, end_date]: whole years are pruned by partition, the rest by row filter
+	import pyarrow.dataset as ds
+
+	dataset = _open_dataset(path)
+	condition = None
+	for date, after in [(start_date, True), (end_date, False)]:
+		if date is None:
+			continue
+		date = pd.Timestamp(date)
+		if after:
+			expression = (ds.field(_PARTITION_COLUMN) >= date.year) & (ds.field(date_column) >= date)
+		else:
+			expression = (ds.field(_PARTITION_COLUMN) <= date.year) & (ds.field(date_column) <= date)
+		condition = expression if condition is None else condition & expression
+
+	columns = columns or [x for x in dataset.schema.names if x != _PARTITION_COLUMN]
+
+	return dataset.to_table(columns = columns, filter = condition).to_pandas()
+
+def _date_filters(start_date, end_date, date_column = 'ldate'):
+
+	## Row filters for pd.read_parquet (row groups outside the range are skipped using their statistics)
+	filters = [(date_column, op, pd.Timestamp(date)) for op, date in [('>=', start_date), ('<=', end_date)] if date is not None]
+
+	return filters or None
+
+#------------------------------------------------#
+#  CSV Ingestion
+
+## Stata exports: daily dates as 01jan2001, monthly dates as 2001m1
+_CSV_DATE_FORMATS = {'date' : '%d%b%Y', 'ldate' : '%Ym%m', 'ym' : '%Ym%m'}
+_CSV_INTEGER_COLUMNS = {'permno' : 'int32', 'exchcd' : 'int8', 'shrcd' : 'int8'}
+
+def parse_dates(values, date_format):
+
+	## Dates repeat across stocks, so parse each distinct string once and broadcast back
+	codes, uniques = pd.factorize(values)
+	parsed = pd.to_datetime(uniques, format = date_format).values
+	parsed = np.append(parsed, np.datetime64('NaT', 'ns'))
+
+	return Series(parsed[codes], index = values.index, name = values.name)
+
+def read_csv_fast(path, usecols = None, engine = 'c', date_columns = ['date', 'ldate', 'ym']):
+
+	## Read a Stata-exported CSV with vectorized date parsing for date_columns, storing
+	## identifiers as compact integers (when they have no missing values).
+	## engine = 'pyarrow' switches to the multithreaded columnar reader (its float parsing can
+	## differ from the C reader in the last digit).
+	dtype = {x : 'float64' for x in _CSV_INTEGER_COLUMNS if usecols is None or x in usecols}
+	df = pd.read_csv(path, usecols = usecols, engine = engine, dtype = dtype)
+
+	for var in date_columns:
+		if var in df.columns:
+			df[var] = parse_dates(df[var], _CSV_DATE_FORMATS[var])
+
+	for var, int_type in _CSV_INTEGER_COLUMNS.items():
+		if var in df.columns and df[var].notna().all():
+			df[var] = df[var].astype(int_type)
+
+	return df
+
+#------------------------------------------------#
+#  Panel Cache for load_data
+
+## Bump _CACHE_VERSION whenever load_data changes the panel it builds
+_CACHE_VERSION = 1
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'qpm')
+_CACHE_MAX_BYTES = 20 * 1024**3
+
+def _cache_key(data_dir, file_name, variable_list, options = {}):
 
-	file_type = file_name.split('.')[-1]
+	## Fingerprint of the source file (path, size, mtime), the requested variables, load options and the code version
+	path = os.path.abspath('%s/%s' %(data_dir, file_name))
+	size, mtime = _source_stat(path)
+	payload = json.dumps([path, size, mtime, sorted(variable_list), _CACHE_VERSION, pd.__version__] +
+						 ([options] if options else []))
+
+	return hashlib.sha256(payload.encode()).hexdigest()[:32], path
+
+def _read_cache(cache_dir, key):
+
+	cache_file = os.path.join(cache_dir, '%s.parquet' %(key))
+	if not os.path.exists(cache_file):
+		return None
+
+	## Touch the entry so that eviction drops the least recently used panels first
+	os.utime(cache_file)
+	return pd.read_parquet(cache_file)
+
+def _write_cache(cache_dir, key, source, variable_list, df_full, max_bytes):
+
+	os.makedirs(cache_dir, exist_ok = True)
+	cache_file = os.path.join(cache_dir, '%s.parquet' %(key))
+
+	## Write to a temporary file first so that a crash never leaves a truncated entry behind
+	temp_file = '%s.%d.tmp' %(cache_file, os.getpid())
+	df_full.to_parquet(temp_file)
+	os.replace(temp_file, cache_file)
+	with open(os.path.join(cache_dir, '%s.json' %(key)), 'w') as f:
+		json.dump({'source' : source, 'variable_list' : sorted(variable_list), 'created' : datetime.now().isoformat()}, f)
+
+	evict_cache(cache_dir, max_bytes)
+
+def evict_cache(cache_dir = None, max_bytes = _CACHE_MAX_BYTES):
+
+	## Remove least recently used panels until the cache directory fits in max_bytes
+	cache_dir = cache_dir or _CACHE_DIR
+	entries = [(os.path.getmtime(f), os.path.getsize(f), f) for f in glob.glob(os.path.join(cache_dir, '*.parquet'))]
+	total = sum(size for _, size, _ in entries)
+
+	for _, size, cache_file in sorted(entries):
+		if total <= max_bytes:
+			break
+		_remove_cache_entry(cache_file)
+		total -= size
+
+def _remove_cache_entry(cache_file):
+
+	for f in [cache_file, cache_file.replace('.parquet', '.json')]:
+		if os.path.exists(f):
+			os.remove(f)
+
+def clear_cache(data_dir = None, file_name = None, cache_dir = None):
+
+	## Invalidate cached panels: all of them, or only those built from data_dir/file_name
+	cache_dir = cache_dir or _CACHE_DIR
+	source = os.path.abspath('%s/%s' %(data_dir, file_name)) if file_name is not None else None
+
+	for cache_file in glob.glob(os.path.join(cache_dir, '*.parquet')):
+		if source is not None:
+			meta_file = cache_file.replace('.parquet', '.json')
+			if not os.path.exists(meta_file):
+				continue
+			with open(meta_file) as f:
+				if json.load(f)['source'] != source:
+					continue
+		_remove_cache_entry(cache_file)
+
+#------------------------------------------------#
+#  Compact Memory Mode
+
+## Identifier codes held as small integers (or float32 when they have gaps) and names as categoricals.
+## Returns, factors and market caps stay float64 so that portfolio returns are unchanged in float32 mode.
+_COMPACT_CATEGORY_COLUMNS = ['ticker', 'conm']
+_FLOAT64_COLUMNS = ['daret', 'ret', 'retx', 'me', 'mve_c', 'me_lagged', 'rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma']
+
+def compact_panel(df, float32 = False):
+
+	## Downcast the panel in place and return it:
+	##   - permno to int32, exchcd and shrcd to int8 (float32 if they have missing values; the codes are exact)
+	##   - ticker and conm to categoricals
+	##   - with float32 = True, every other float64 column (characteristics, signals) to float32
+	for col, dtype in _CSV_INTEGER_COLUMNS.items():
+		if col not in df.columns or df[col].dtype == dtype:
+			continue
+		values = df[col]
+		if values.isna().any():
+			df[col] = values.astype('float32')
+		elif np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+			df[col] = values.astype(dtype)
+
+	for col in _COMPACT_CATEGORY_COLUMNS:
+		if col in df.columns and df[col].dtype == object:
+			df[col] = df[col].astype('category')
+
+	if float32:
+		for col in df.columns:
+			if df[col].dtype == np.float64 and col not in _FLOAT64_COLUMNS:
+				df[col] = df[col].astype(np.float32)
+
+	return df
+
+#------------------------------------------------#
+#  Factor Store
+
+## Fama-French factors registered in this process, keyed by frequency ('monthly' on ldate, 'daily' on date)
+_FACTOR_COLUMNS = ['rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma']
+_FACTOR_DATE_COLUMNS = {'monthly' : 'ldate', 'daily' : 'date'}
+_FACTOR_STORE = {}
+
+## Optional directory the store is mirrored to; None keeps the factors in memory only
+_FACTOR_PATH = None
+
+def _factor_file(path, frequency):
+
+	return os.path.join(path, 'FFData.parquet' if frequency == 'monthly' else 'FFData_%s.parquet' %(frequency))
+
+def set_factor_path(path):
+
+	## Mirror registered factors to path (FFData.parquet for monthly, FFData_daily.parquet for daily) and read them
+	## back from there when nothing has been registered in this process. set_factor_path('.') restores the old
+	## behaviour of writing FFData.parquet to the working directory; set_factor_path(None) turns the mirror off
+	## (get_factors still reads an existing FFData.parquet there when nothing is registered).
+	global _FACTOR_PATH
+	_FACTOR_PATH = path
+
+def register_factors(df, frequency = 'monthly'):
+
+	## Keep one row per date with the factor columns present in df
+	date_col = _FACTOR_DATE_COLUMNS[frequency]
+	columns = [date_col] + [x for x in _FACTOR_COLUMNS if x in df.columns]
+	df_factors = df[columns].drop_duplicates(subset = [date_col]).dropna(subset = [date_col])
+	df_factors = df_factors.sort_values([date_col]).reset_index(drop = True)
+
+	_FACTOR_STORE[frequency] = df_factors
+
+	if _FACTOR_PATH is not None:
+		os.makedirs(_FACTOR_PATH, exist_ok = True)
+		factor_file = _factor_file(_FACTOR_PATH, frequency)
+		temp_file = '%s.%d.tmp' %(factor_file, os.getpid())
+		df_factors.to_parquet(temp_file)
+		os.replace(temp_file, factor_file)
+
+	return df_factors
+
+def get_factors(frequency = 'monthly'):
+
+	## Registered factors for this process. Otherwise fall back, once, to the on-disk mirror (set_factor_path) and
+	## then to FFData.parquet in the working directory, where qpm_download used to save the factors, and memoize it
+	if frequency not in _FACTOR_STORE:
+		for path in [x for x in [_FACTOR_PATH, '.'] if x is not None]:
+			if os.path.exists(_factor_file(path, frequency)):
+				log('> No %s factors registered, reading %s' %(frequency, _factor_file(path, frequency)))
+				_FACTOR_STORE[frequency] = pd.read_parquet(_factor_file(path, frequency))
+				break
+
+	if frequency not in _FACTOR_STORE:
+		raise Exception('No %s factors registered and no %s in the working directory. Run load_data (or qpm_download) '
+						'first, or point set_factor_path to saved factors.' %(frequency, _factor_file('.', frequency)))
+
+	return _FACTOR_STORE[frequency].copy()
+
+def clear_factors(frequency = None):
+
+	if frequency is None:
+		_FACTOR_STORE.clear()
+	else:
+		_FACTOR_STORE.pop(frequency, None)
+
+@instrumented
+def load_data(data_dir, file_name, variable_list = [], cache = False, cache_dir = None, cache_max_bytes = _CACHE_MAX_BYTES, csv_engine = 'c',
+			  compact = False, float32 = False, start_date = None, end_date = None):
+
+	## compact = True downcasts identifiers and makes names categorical before the panel is sorted (see compact_panel);
+	## float32 = True also stores characteristics as float32
+	## start_date / end_date keep the months in that range; parquet files and partitioned datasets (file_name a
+	## directory, see write_partitions) skip the data outside it. Lags at start_date see no earlier months.
+
+	file_type = _file_type('%s/%s' %(data_dir, file_name))
+
+	#------------------------------------------------#
+	#  Cached Panel
+
+	if cache:
+		cache_dir = cache_dir or _CACHE_DIR
+		options = dict({'compact' : True, 'float32' : float32} if compact else {},
+					   **{x : str(y) for x, y in [('start_date', start_date), ('end_date', end_date)] if y is not None})
+		cache_key, source = _cache_key(data_dir, file_name, variable_list, options)
+		df_full = _read_cache(cache_dir, cache_key)
+
+		if df_full is not None:
+			log('> Loading cached panel...')
+			register_factors(df_full)
+			return df_full
 
 	## List of variables
 	basic_list = ['permno', 'daret', 'retx', 'vol', 'shrout', 'prc', 'shrcd', 'exchcd', 'ticker', 'ldate', 'conm', 'me', 'be', 'revt', 'cogs', 'at', 'hml', 'smb', 'mktrf', 'rf', 'umd', 'cma', 'rmw']
 	# aux_list = ['ldate_lag', 'ldate_lag12', 'screen', 'me_lagged', 'screen12']
 	final_list = list(set(basic_list + variable_list))
 
+	## Check the requested variables against the file header before reading any data
+	if variable_list != []:
+		missing = [x for x in final_list if x not in catalog(data_dir, file_name)['columns']]
+		if missing:
+			raise Exception('Variables not found in %s: %s' %(file_name, missing))
+
 	#------------------------------------------------#
 	#  Load Raw Data
 
-	print('> Loading Raw Data...')
+	log('> Loading Raw Data...')
 
 	if file_type == 'dta':
 		if variable_list != []:
@@ -156,30 +694,30 @@ def load_data(data_dir, file_name, variable_list = []):
 			df_full = pd.read_stata('%s/%s' %(data_dir, file_name))
 	elif file_type == 'parquet':
 		if variable_list != []:
-			df_full = pd.read_parquet('%s/%s' %(data_dir, file_name), columns = final_list)
+			df_full = pd.read_parquet('%s/%s' %(data_dir, file_name), columns = final_list, filters = _date_filters(start_date, end_date))
 		else:
-			df_full = pd.read_parquet('%s/%s' %(data_dir, file_name))    
+			df_full = pd.read_parquet('%s/%s' %(data_dir, file_name), filters = _date_filters(start_date, end_date))
+	elif file_type == 'dataset':
+		df_full = read_dataset('%s/%s' %(data_dir, file_name), final_list if variable_list != [] else None, start_date, end_date)
 	elif file_type == 'csv':
 		if variable_list != []:
-			df_full = pd.read_csv('%s/%s' %(data_dir, file_name), usecols = final_list)
+			df_full = read_csv_fast('%s/%s' %(data_dir, file_name), usecols = final_list, engine = csv_engine)
 		else:
-			df_full = pd.read_csv('%s/%s' %(data_dir, file_name))
-
-		## Additional adjustments regarding data type
-		if 'date' in df_full.columns:
-			df_full['date'] = df_full['date'].map(lambda x : datetime.strptime(x, '%d%b%Y').strftime('%Y-%m-%d'))
-			df_full['date'] = pd.to_datetime(df_full['date'])
-		if 'ldate' in df_full.columns:
-			df_full['ldate'] = df_full['ldate'].map(lambda x : datetime.strptime(x, '%Ym%m').strftime('%Y-%m-01'))
-			df_full['ldate'] = df_full['ldate'].map(lambda x : datetime.strptime(x, '%Y-%m-%d'))
-		if 'ym' in df_full.columns:
-			df_full['ym'] = df_full['ym'].map(lambda x : datetime.strptime(x, '%Ym%m').strftime('%Y-%m-01'))
-			df_full['ym'] = pd.to_datetime(df_full['ym'])
+			df_full = read_csv_fast('%s/%s' %(data_dir, file_name), engine = csv_engine)
 	else:
 		raise Exception('Please provide a valid file_type: .dta or .csv')
 
+	## dta and csv files are read whole and restricted afterwards
+	if file_type in ['dta', 'csv'] and (start_date is not None or end_date is not None):
+		keep = Series(True, index = df_full.index)
+		if start_date is not None:
+			keep &= df_full['ldate'] >= pd.Timestamp(start_date)
+		if end_date is not None:
+			keep &= df_full['ldate'] <= pd.Timestamp(end_date)
+		df_full = df_full[keep].reset_index(drop = True)
+
 	## Rename Key Variables
-	print('> Renaming key variables...')
+	log('> Renaming key variables...')
 	if 'me' not in df_full.columns:
 		df_full['me'] = df_full['mve_c']
 	if 'daret' not in df_full.columns:
@@ -190,13 +728,17 @@ def load_data(data_dir, file_name, variable_list = []):
 		df_full['profitA'] = (df_full['revt'] - df_full['cogs']) / df_full['at']
 
 	## Drop Duplicates
-	print('> Dropping duplicates...')
+	log('> Dropping duplicates...')
 	df_full.drop_duplicates(subset = ['permno', 'ldate'], keep = 'first', inplace = True)
 
+	if compact:
+		log('> Compacting panel...')
+		compact_panel(df_full, float32)
+
 	#------------------------------------------------#
 	#  Auxiliary Variables
 
-	print('> Creating Auxiliary Variables...')
+	log('> Creating Auxiliary Variables...')
 
 	df_full.sort_values(by = ['permno', 'ldate'], inplace = True)
 
@@ -208,56 +750,110 @@ def load_data(data_dir, file_name, variable_list = []):
 
 	df_full['me_lagged'] = df_full.groupby(['permno'])['me'].shift(1).multiply(df_full['screen'])
 
-	## Save Fama-French Data
-	df_full[['ldate', 'rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma']].drop_duplicates().to_parquet('FFData.parquet')
+	## Register Fama-French Data
+	register_factors(df_full)
+
+	if cache:
+		log('> Saving panel to cache...')
+		_write_cache(cache_dir, cache_key, source, variable_list, df_full, cache_max_bytes)
 
 	return df_full
 
-def load_data_etf(data_dir, file_name):
+@instrumented
+def load_data_etf(data_dir, file_name, csv_engine = 'c'):
 
-	file_type = file_name.split('.')[-1]
+	file_type = _file_type('%s/%s' %(data_dir, file_name))
 
 	#------------------------------------------------#
 	#  Load Raw Data
 
-	print('> Loading Raw Data...')
+	log('> Loading Raw Data...')
 
 	if file_type == 'dta':
 		df_full = pd.read_stata('%s/%s' %(data_dir, file_name))
 	elif file_type == 'csv':
-		df_full = pd.read_csv('%s/%s' %(data_dir, file_name))
-		df_full['date'] = df_full['date'].map(lambda x : datetime.strptime(x, '%d%b%Y').strftime('%Y-%m-%d'))
-		df_full['ym'] = df_full['ym'].map(lambda x : datetime.strptime(x, '%Ym%m').strftime('%Y-%m-01'))
-
-		df_full['date'] = pd.to_datetime(df_full['date'])
-		df_full['ym'] = pd.to_datetime(df_full['ym'])
+		df_full = read_csv_fast('%s/%s' %(data_dir, file_name), engine = csv_engine, date_columns = ['date', 'ym'])
+	elif file_type == 'dataset':
+		df_full = read_dataset('%s/%s' %(data_dir, file_name), date_column = 'date')
 
 	else:
 		raise Exception('Please provide a valid file_type: .dta or .csv')
 
 	return df_full
 
-def select_sample(df_input, sample_start, sample_end, remove_micro_caps):
+def partition_by_month(df):
+
+	## Panel reordered by ldate (stable, so rows keep their order within a month). On such a frame
+	## select_sample takes any date range as one contiguous slice instead of masking every row.
+	return df.sort_values('ldate', kind = 'stable')
 
-	print('> Selecting Sample for Given Criteria...')
+def _sort_within_months(values, month, mask):
 
-	df = df_input[(df_input['ldate'] <= sample_end) & (df_input['ldate'] >= sample_start)]
+	## Positions of the masked, non-missing values sorted by (month, value)
+	index = np.flatnonzero(mask & ~np.isnan(values))
+	return index[np.lexsort((values[index], month[index]))]
 
-	## Drop Stocks with Missing Returns
-	df = df.dropna(subset = ['daret'])
+def _lower_quantile_within_months(values, month, index, percentile, valid):
 
-	## Drop Stocks with Missing Signal Values
-	df = df.dropna(subset = ['signal'])
+	## Per-month quantile with interpolation = 'lower' over the rows flagged in valid, reusing
+	## a sort from _sort_within_months. Months without valid rows get NaN.
+	num_months = month.max() + 1 if len(month) > 0 else 0
+	sorted_month, keep = month[index], valid[index]
+
+	n_valid = np.bincount(sorted_month, weights = keep, minlength = num_months).astype(np.int64)
+	target = np.floor(percentile * (n_valid - 1)).astype(np.int64)
+	cum_valid = np.cumsum(keep) - (np.cumsum(n_valid) - n_valid)[sorted_month]
+	hit = keep & (cum_valid == target[sorted_month] + 1)
+
+	cutoffs = np.full(num_months, np.nan)
+	cutoffs[sorted_month[hit]] = values[index[hit]]
+
+	return cutoffs
+
+def micro_cap_cutoffs(df, percentile = 0.2, exchanges = [1], mord = None):
+
+	## Per-month market-cap cutoff broadcast to every row: the given percentile (interpolation = 'lower')
+	## of me_lagged among stocks listed on exchanges (exchcd codes; None for all exchanges)
+	if mord is None:
+		mord = month_ordinal(df['ldate'])
+	month = mord - mord.min() if len(mord) > 0 else mord
+	me_lagged = df['me_lagged'].to_numpy(dtype = np.float64, na_value = np.nan)
+
+	if exchanges is None:
+		is_breakpoint = np.ones(len(df), dtype = bool)
+	else:
+		is_breakpoint = df['exchcd'].isin(exchanges).to_numpy()
+
+	index = _sort_within_months(me_lagged, month, is_breakpoint)
+	cutoffs = _lower_quantile_within_months(me_lagged, month, index, percentile, np.ones(len(df), dtype = bool))
+
+	return cutoffs[month]
+
+@instrumented
+def select_sample(df_input, sample_start, sample_end, remove_micro_caps, micro_cap_percentile = 0.2, micro_cap_exchanges = [1]):
+
+	log('> Selecting Sample for Given Criteria...')
+
+	if df_input['ldate'].is_monotonic_increasing:
+		ldate = df_input['ldate'].to_numpy(dtype = 'datetime64[ns]')
+		first = np.searchsorted(ldate, np.datetime64(pd.Timestamp(sample_start), 'ns'), side = 'left')
+		last = np.searchsorted(ldate, np.datetime64(pd.Timestamp(sample_end), 'ns'), side = 'right')
+		df = df_input.iloc[first:last]
+	else:
+		df = df_input[(df_input['ldate'] <= sample_end) & (df_input['ldate'] >= sample_start)]
+
+	## Drop Stocks with Missing Returns or Signal Values
+	df = df[df['daret'].notna() & df['signal'].notna()]
 
 	## Deal with Micro Caps
 	if remove_micro_caps:
 
-		thresholds = df[df['exchcd'] == 1].groupby('ldate')['me_lagged'].quantile(0.2, interpolation = 'lower')
-		df['cutoff'] = df['ldate'].map(lambda x : thresholds[x])
+		df['cutoff'] = micro_cap_cutoffs(df, micro_cap_percentile, micro_cap_exchanges)
 		df = df[df['me_lagged'] >= df['cutoff']]
 
 	return df
 
+@instrumented
 def create_lag(df, var_name, lag):
 
 	df['ldate_lag_temp'] = df.groupby(['permno'])['ldate'].shift(lag)
@@ -270,296 +866,1349 @@ def create_lag(df, var_name, lag):
 
 def compute_rolling_by_permno(df, var_name, window_size, min_obs, stat_type):
 
-	## Use data only that we need
-	sub_df = df.reset_index()[['permno', 'ldate', 'index'] + [var_name]]
+	## Rolling statistic over the trailing window_size months of each permno (gaps count as missing)
+	return rolling_stats(df, var_name, [window_size], min_obs, [stat_type]).iloc[:, 0].sort_index()
 
-	## Create a full panel
-	temp_df = sub_df.set_index(['permno', 'ldate']).unstack().stack(dropna = False).reset_index()
+@instrumented
+def rolling_stats(df, var_name, windows, min_obs, stats = ['mean', 'std']):
 
-	## Compute rolling stat
-	if stat_type == 'mean':
-		temp_df['temp'] = temp_df.groupby('permno')['Investment'].transform(lambda x : x.rolling(window = window_size, min_periods = min_obs).mean())
-	elif stat_type in ['std', 'vol']:
-		temp_df['temp'] = temp_df.groupby('permno')['Investment'].transform(lambda x : x.rolling(window = window_size, min_periods = min_obs).std())
-	else:
-		raise Exception('UNIMPLEMENTED stat_type: %s' %(stat_type))
-
-	return temp_df.dropna(subset = ['index']).set_index('index').sort_index()['temp']
+	## Rolling statistics of var_name for every permno at once, for each window in windows (months).
+	## stats can include 'mean', 'std' (or 'vol'), 'sum', 'min', 'max', 'skew' and 'zscore'.
+	## Returns a frame aligned with df, with one column per statistic and window, e.g. 'ret_std36'.
+	panel = Panel.from_long(df, [var_name])
 
+	df_stats = {}
+	for window_size in windows:
+		for stat_type in stats:
+			df_stats['%s_%s%d' %(var_name, stat_type, window_size)] = panel.to_series(panel.rolling(var_name, window_size, min_obs, stat_type))
 
+	return DataFrame(df_stats, index = df.index)
 
 def rank(df, var_name):
 
 	return df.groupby('ldate')[var_name].rank(ascending = True)
 	
 
-def create_portfolios(df, sort_frequency, num_port):
+def month_ordinal(dates):
 
-	#------------------------------------------------#
-	#  Sort Portfolios
+	## Integer month index (year * 12 + month - 1) used to address months as array positions
+	dates = pd.DatetimeIndex(dates)
+	return np.asarray(dates.year, dtype = np.int64) * 12 + np.asarray(dates.month, dtype = np.int64) - 1
+
+def month_to_date(mord):
+
+	## Inverse of month_ordinal: first day of each month
+	mord = np.asarray(mord, dtype = np.int64)
+	return pd.to_datetime(DataFrame({'year' : mord // 12, 'month' : mord % 12 + 1, 'day' : 1}))
+
+#------------------------------------------------#
+#  Dense Panel
+
+## Rolling moments are recomputed from the window where the raw sum of squares exceeds the centred one this much
+_MOMENT_CONDITION = 1e4
+
+def _rolling_sum(values, window_size):
+
+	## Trailing sums over window_size rows (months). The cumulative sum restarts every window_size rows, so a
+	## window is its prefix in the current block plus the part of the previous block it covers (that block's
+	## total less its prefix before the window). Unlike differences of one cumulative sum over the whole
+	## history, the rounding error stays at the scale of the values inside the window.
+	n, pad = len(values), (-len(values)) % window_size
+	blocks = np.concatenate([values, np.zeros((pad,) + values.shape[1:])]).reshape((-1, window_size) + values.shape[1:])
+	blocks = np.cumsum(blocks, axis = 1)
+	prefix = blocks.reshape((-1,) + values.shape[1:])[:n]
+
+	result = prefix.copy()
+	if n > window_size:
+		result[window_size:] += np.repeat(blocks[:, -1], window_size, axis = 0)[:n - window_size] - prefix[:n - window_size]
+	return result
+
+def _constant_windows(values, valid, window_size):
 
-	print('> Sorting stocks into %d portfolios at frequency: %s...' %(num_port, sort_frequency))
+	## True where the valid values of a trailing window are all equal. A value that differs from the stock's
+	## previous valid value is a change, and the window is constant unless it also holds the value before its
+	## latest change.
+	rows = np.arange(len(values))[:, None]
+	last = np.maximum.accumulate(np.where(valid, rows, -1), axis = 0)
+	previous = np.vstack([np.full((1,) + values.shape[1:], -1), last[:-1]])
+	change = valid & (previous >= 0) & (values != np.take_along_axis(values, np.maximum(previous, 0), axis = 0))
+	before_change = np.maximum.accumulate(np.where(change, previous, -1), axis = 0)
+
+	return before_change < np.maximum(rows - window_size + 1, 0)
+
+class Panel:
+
+	## Panel variables stored as dense (month x permno) arrays, NaN where a stock has no row.
+	## Lags, leads, cross-sectional ranks and rolling windows become array slices along the
+	## month axis, so there is no groupby('permno') and no date-continuity check per call.
+	## The row coordinates of the long frame it came from are kept, so results map straight
+	## back onto that frame with to_series.
+
+	def __init__(self, first_month, permnos, present, data, row_month, row_permno, index):
+
+		self.first_month = first_month
+		self.permnos = permnos
+		self.present = present
+		self.data = data
+		self.row_month = row_month
+		self.row_permno = row_permno
+		self.index = index
+
+	@classmethod
+	def from_long(cls, df, variables):
+
+		## Build from a long frame with one row per (permno, ldate)
+		mord = month_ordinal(df['ldate'])
+		first_month = mord.min()
+		row_month = mord - first_month
+		permnos, row_permno = np.unique(df['permno'].to_numpy(), return_inverse = True)
+
+		present = np.zeros((row_month.max() + 1, len(permnos)), dtype = bool)
+		present[row_month, row_permno] = True
+		if present.sum() != len(df):
+			raise Exception('Panel requires unique (permno, ldate) rows. Please drop duplicates first.')
+
+		panel = cls(first_month, permnos, present, {}, row_month, row_permno, df.index)
+		for var in variables:
+			panel[var] = df[var].to_numpy(dtype = np.float64, na_value = np.nan)
+
+		return panel
+
+	def __getitem__(self, var):
+
+		return self.data[var]
+
+	def __setitem__(self, var, values):
+
+		## Accepts a dense (month x permno) array or one value per row of the original frame
+		values = np.asarray(values, dtype = np.float64)
+		if values.shape != self.present.shape:
+			dense = np.full(self.present.shape, np.nan)
+			dense[self.row_month, self.row_permno] = values
+			values = dense
+		self.data[var] = values
+
+	@property
+	def shape(self):
+
+		return self.present.shape
+
+	@property
+	def dates(self):
+
+		return month_to_date(self.first_month + np.arange(self.shape[0]))
+
+	def shift(self, values, lag, contiguous = True):
+
+		## Value lag months earlier (negative lag: later). With contiguous = True the stock must
+		## have a row in every month in between, the same screen create_lag applies.
+		values = self.data[values] if isinstance(values, str) else values
+		shifted = np.full(values.shape, np.nan)
+		if lag > 0:
+			shifted[lag:] = values[:-lag]
+		elif lag < 0:
+			shifted[:lag] = values[-lag:]
+		else:
+			shifted = values.copy()
+
+		if contiguous and lag != 0:
+			count = np.vstack([np.zeros((1, self.shape[1]), dtype = np.int64), np.cumsum(self.present, axis = 0)])
+			k = abs(lag)
+			span = np.zeros(self.shape, dtype = np.int64)
+			if lag > 0:
+				span[k:] = count[k + 1:] - count[1:-k]
+			else:
+				span[:-k] = count[k + 1:] - count[1:-k]
+			shifted[span != k] = np.nan
+
+		return shifted
+
+	def lag(self, var, lag = 1, contiguous = True):
+
+		return self.shift(var, lag, contiguous)
+
+	def lead(self, var, lead = 1, contiguous = True):
+
+		return self.shift(var, -lead, contiguous)
+
+	def rank(self, var):
+
+		## Cross-sectional rank within each month (average ties), as rank() does on the long frame
+		return DataFrame(self.data[var]).rank(axis = 1).to_numpy()
+
+	def window(self, var, window_size, fill = np.nan):
+
+		## Read-only (month x permno x window_size) view of the trailing window, padded with fill at the start
+		values = self.data[var] if isinstance(var, str) else var
+		padded = np.vstack([np.full((window_size - 1, self.shape[1]), fill), values])
+		return np.lib.stride_tricks.sliding_window_view(padded, window_size, axis = 0)
+
+	def rolling(self, var, window_size, min_obs, stat_type):
+
+		## Trailing-window statistic along the month axis, NaN unless min_obs values are available.
+		## Moments come from rolling sums (centered on each stock's mean to limit cancellation),
+		## min / max from the strided window view. As in pandas, a constant window has std 0 and skew 0
+		## (so zscore is NaN), rather than the rounding noise left after subtracting the mean.
+		values = self.data[var] if isinstance(var, str) else var
+		valid = ~np.isnan(values)
+		nobs = _rolling_sum(valid.astype(np.float64), window_size)
+
+		if stat_type in ['min', 'max']:
+			fill = np.inf if stat_type == 'min' else -np.inf
+			window = self.window(np.where(valid, values, fill), window_size, fill)
+			result = window.min(axis = 2) if stat_type == 'min' else window.max(axis = 2)
+			return np.where(nobs >= max(min_obs, 1), result, np.nan)
+
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			center = np.nanmean(np.where(valid, values, np.nan), axis = 0) if valid.any() else np.zeros(self.shape[1])
+		center = np.where(np.isnan(center), 0., center)
+		x = np.where(valid, values - center, 0.)
+
+		S1 = _rolling_sum(x, window_size)
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			mean = S1 / nobs
+			if stat_type == 'sum':
+				result = S1 + nobs * center
+			elif stat_type == 'mean':
+				result = mean + center
+			elif stat_type in ['std', 'vol', 'zscore', 'skew']:
+				## Sums of squared (and cubed) deviations from the window mean
+				S2 = _rolling_sum(x**2, window_size)
+				M2 = np.maximum(S2 - S1 * mean, 0.)
+				M3 = _rolling_sum(x**3, window_size) - 3 * mean * S2 + 2 * nobs * mean**3 if stat_type == 'skew' else None
+
+				## Windows whose spread is small next to their distance from the stock's mean lose most digits in
+				## the differences above: their moments are recomputed from the window itself
+				constant = _constant_windows(values, valid, window_size)
+				refine = np.nonzero((nobs >= 2) & ~constant & (S2 > _MOMENT_CONDITION * M2))
+				if len(refine[0]) > 0:
+					deviation = self.window(values, window_size)[refine]
+					deviation = deviation - np.nanmean(deviation, axis = 1, keepdims = True)
+					M2[refine] = np.nansum(deviation**2, axis = 1)
+					if M3 is not None:
+						M3[refine] = np.nansum(deviation**3, axis = 1)
+				M2 = np.where(constant, 0., M2)
+
+				if stat_type == 'skew':
+					m2, m3 = M2 / nobs, M3 / nobs
+					result = np.sqrt(nobs * (nobs - 1)) * m3 / ((nobs - 2) * m2**1.5)
+					## Constant window: 0; otherwise NaN below pandas' variance floor of 1e-14
+					result = np.where(constant, 0., np.where(m2 > 1e-14, result, np.nan))
+					result = np.where(nobs >= 3, result, np.nan)
+				else:
+					std = np.where(nobs >= 2, np.sqrt(M2 / (nobs - 1)), np.nan)
+					result = std if stat_type != 'zscore' else (values - center - mean) / np.where(std > 0, std, np.nan)
+			else:
+				raise Exception('UNIMPLEMENTED stat_type: %s' %(stat_type))
+
+		return np.where(nobs >= max(min_obs, 1), result, np.nan)
+
+	def to_series(self, values, name = None):
+
+		## Dense array (or variable name) back onto the rows of the original long frame
+		if isinstance(values, str):
+			name, values = values, self.data[values]
+		return Series(values[self.row_month, self.row_permno], index = self.index, name = name)
+
+	def to_long(self, variables = None):
+
+		## Long frame with one row per (permno, ldate) cell that exists, sorted by permno and ldate
+		variables = list(self.data.keys()) if variables is None else variables
+		permno_idx, month_idx = np.nonzero(self.present.T)
+
+		df = DataFrame({'permno' : self.permnos[permno_idx], 'ldate' : month_to_date(self.first_month + month_idx).values})
+		for var in variables:
+			df[var] = self.data[var][month_idx, permno_idx]
+
+		return df
+
+def _lerp_percentile(sorted_values, starts, counts, quantiles):
+
+	## Linear-interpolated percentiles of many sorted segments at once.
+	## Mirrors numpy's 'linear' method so breakpoints match pd.qcut bit for bit.
+	virtual = (counts[:, None] - 1) * quantiles[None, :]
+	previous = np.floor(virtual)
+	above = virtual >= (counts[:, None] - 1)
+	gamma = np.where(above, 0., virtual - previous)
+	previous = np.where(above, counts[:, None] - 1, previous).astype(np.int64)
+	next_ = np.where(above, previous, previous + 1)
+
+	a = sorted_values[starts[:, None] + previous]
+	b = sorted_values[starts[:, None] + next_]
+	diff = b - a
+	return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+
+def compute_breakpoints(signal, month, is_breakpoint, num_port):
+
+	## NYSE-style breakpoints for every month in one pass.
+	##   signal        : array of sorting variable
+	##   month         : dense integer month position (0 ... num_months - 1)
+	##   is_breakpoint : boolean array of stocks that define the breakpoints (e.g. NYSE)
+	## Returns the (num_months x num_port + 1) quantile edges, plus the inner edges "snapped" to the
+	## first breakpoint stock strictly above them (its value and its row position), which is what
+	## place_in_portfolios searches against.
+
+	num_months = month.max() + 1 if len(month) > 0 else 0
+	position = np.arange(len(signal))
+
+	mask = is_breakpoint & ~np.isnan(signal)
+	bp_signal, bp_month, bp_position = signal[mask], month[mask], position[mask]
+	order = np.lexsort((bp_position, bp_signal, bp_month))
+	bp_signal, bp_month, bp_position = bp_signal[order], bp_month[order], bp_position[order]
+
+	counts = np.bincount(bp_month, minlength = num_months)
+	starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+	has_bp = counts > 0
+
+	## Same quantile grid as pd.qcut
+	quantiles = np.linspace(0, 1, num_port + 1)
+
+	edges = np.full((num_months, num_port + 1), np.nan)
+	edges[has_bp] = _lerp_percentile(bp_signal, starts[has_bp], counts[has_bp], quantiles)
+
+	## Count breakpoint stocks at or below each inner edge to find the first one above it
+	inner = edges[:, 1:-1]
+	snapped = np.full(inner.shape, np.inf)
+	snapped_position = np.full(inner.shape, len(signal), dtype = np.int64)
+	if num_port > 1 and len(bp_signal) > 0:
+		below = (bp_signal[:, None] <= inner[bp_month]).astype(np.int64)
+		n_below = np.zeros(inner.shape, dtype = np.int64)
+		n_below[has_bp] = np.add.reduceat(below, starts[has_bp], axis = 0)
+		valid = has_bp[:, None] & (n_below < counts[:, None])
+		first_above = np.where(valid, starts[:, None] + n_below, 0)
+		snapped = np.where(valid, bp_signal[first_above], np.inf)
+		snapped_position = np.where(valid, bp_position[first_above], len(signal))
+
+	return edges, snapped, snapped_position
+
+def place_in_portfolios(signal, month, is_breakpoint, snapped, snapped_position):
+
+	## Batched search of every stock against its month's snapped breakpoints. This is the same
+	## placement as sorting by signal and forward-filling from the nearest breakpoint stock below:
+	##   - breakpoint stocks get their own quantile bin (edges are right-closed, as in pd.qcut)
+	##   - other stocks tied with a breakpoint stock only pick up its bin if it comes earlier in the frame
+	##   - missing signals sort last and go to the top portfolio
+	values = np.where(np.isnan(signal), np.inf, signal)[:, None]
+	snapped, snapped_position = snapped[month], snapped_position[month]
+
+	position = np.arange(len(signal))[:, None]
+	tied = (snapped == values) & (is_breakpoint[:, None] | (snapped_position < position))
+
+	return 1 + ((snapped < values) | tied).sum(axis = 1)
+
+def assign_portfolios(df, sort_frequency, num_port, mord = None):
+
+	## Portfolio labels (1 ... num_port) from NYSE breakpoints without sorting the panel.
+	## mord can pass in month_ordinal(df['ldate']) when it has already been computed.
+	## Months without breakpoint stocks put every stock in portfolio 1. Labels are integers, or floats
+	## with NaN for June sorts when a stock has no July assignment yet.
+
+	signal = df['signal'].to_numpy(dtype = np.float64, na_value = np.nan)
+	nyse = (df['exchcd'] == 1).to_numpy()
+	if mord is None:
+		mord = month_ordinal(df['ldate'])
+	month = mord - mord.min() if len(mord) > 0 else mord
+	labels = np.full(len(df), np.nan)
 
 	if sort_frequency == 'Monthly':
 
-		## Group stocks into portfolios using NYSE breakpoints and monthly signals
-		
-		df['portfolio'] = df[df['exchcd'] == 1].groupby('ldate')['signal'].transform(lambda x : pd.qcut(x, num_port, labels = range(1, num_port + 1)))
-		
-		## Fill in the values for Non-NYSE Stocks
-		
-		df.sort_values(['ldate', 'signal'], inplace = True)
-		df['portfolio'] = df.groupby('ldate')['portfolio'].ffill()
-		df['portfolio'].fillna(1, inplace = True)
+		## Breakpoints from NYSE stocks each month, all stocks placed against them
+		edges, snapped, snapped_position = compute_breakpoints(signal, month, nyse, num_port)
+		labels[:] = place_in_portfolios(signal, month, nyse, snapped, snapped_position)
+		labels[np.isnan(edges[month, 0])] = 1
 
 	elif sort_frequency == 'June':
 
-		## Group stocks into portfolios using NYSE breakpoints and monthly signals (note: signal is lagged)
-		
-		df['lmonth'] = df['ldate'].map(lambda x : x.month)
-		df['portfolio'] = df[(df['exchcd'] == 1) & (df['lmonth'] == 7)].groupby('ldate')['signal'].transform(lambda x : pd.qcut(x, num_port, labels = range(1, num_port + 1)))
+		## Sort at the end of June (signal is lagged, so ldate is July) ...
+		july = (mord % 12) == 6
+		edges, snapped, snapped_position = compute_breakpoints(signal[july], month[july], nyse[july], num_port)
+		july_labels = place_in_portfolios(signal[july], month[july], nyse[july], snapped, snapped_position)
+		july_labels[np.isnan(edges[month[july], 0])] = 1
 
-		## Fill in the values for Non-NYSE Stocks
-		
-		df.sort_values(['ldate', 'signal'], inplace = True)
-		df['temp'] = np.where(df['lmonth'] == 7, df.groupby('ldate')['portfolio'].ffill(), np.nan)
-		df['portfolio'].fillna(df['temp'], inplace = True)
-		df['temp'] = np.where(df['lmonth'] == 7, 1, np.nan)
-		df['portfolio'].fillna(df['temp'], inplace = True)
+		## ... and hold the most recent July assignment of each stock for July to May
+		permno_code = pd.factorize(df['permno'])[0].astype(np.int64)
+		span = month.max() + 1 if len(month) > 0 else 1
+		key = permno_code * span + month
 
-		## Assign stocks to the same portfolio for July to May
-		
-		df.sort_values(['permno', 'ldate'], inplace = True)
-		df['temp'] = np.where(df['lmonth'] != 7, df.groupby('permno')['portfolio'].ffill(), np.nan)
-		df['portfolio'].fillna(df['temp'], inplace = True)
+		july_key = key[july]
+		order = np.argsort(july_key, kind = 'stable')
+		july_key, july_labels = july_key[order], july_labels[order]
 
-		df.drop(columns = ['temp'], inplace = True)
+		pos = np.searchsorted(july_key, key, side = 'right') - 1
+		found = pos >= 0
+		found[found] = (july_key[pos[found]] // span) == permno_code[found]
+		labels[found] = july_labels[pos[found]]
 
 	else:
-	
+
 		raise Exception('Please provide a valid _SORT_FREQUENCY type. It should either be Monthly or June.')
 
-	#------------------------------------------------#
-	#  Compute Returns for Different Weighting Schemes
+	if not np.isnan(labels).any():
+		labels = labels.astype(np.int64)
 
-	print('> Computing returns using various weights...')
+	return Series(labels, index = df.index)
 
-	## Rank-weighted strategy long-only
-	# print(df)
-	
-	df['signal_rank'] = df.groupby('ldate')['signal'].rank() # <-- this is the right one
-	df['Tsignal_rank'] = df.groupby('ldate')['signal_rank'].transform(sum)
-	df['weight'] = df['signal_rank'] / df['Tsignal_rank']
-	df['wgtd_daret'] = df['weight'] * df['daret']
+def portfolio_returns(df, num_port, mord = None, holdings = False):
+
+	## Every weighting scheme from a single month-by-portfolio reduction:
+	##   - rank-weighted long-only     : sum(rank * ret) / sum(rank)
+	##   - rank-weighted long-short    : 4 * (long-only - sum(ret) / N)
+	##   - value-weighted portfolios   : sum(me_lagged * ret) / sum(me_lagged)
+	## Each sum is one np.bincount over (month, portfolio) cells, so the cost does not grow with num_port.
+	## Returns df_rets and the per-stock value weights, and with holdings = True also the weights of every
+	## scheme as a Holdings object.
+
+	if mord is None:
+		mord = month_ordinal(df['ldate'])
+	month = mord - mord.min() if len(mord) > 0 else mord
+	num_months = month.max() + 1 if len(month) > 0 else 0
+
+	portfolio = np.asarray(df['portfolio'].astype(float))
+	portfolio = np.where(np.isnan(portfolio), 0, portfolio).astype(np.int64)
+	cell = month * (num_port + 1) + portfolio
+
+	def cell_sum(weights):
+		return np.bincount(cell, weights = weights, minlength = num_months * (num_port + 1)).reshape(num_months, num_port + 1)
+
+	signal_rank = df['signal_rank'].to_numpy(dtype = np.float64, na_value = np.nan)
+	daret = df['daret'].to_numpy(dtype = np.float64, na_value = np.nan)
+	me_lagged = df['me_lagged'].to_numpy(dtype = np.float64, na_value = np.nan)
+
+	has_signal = ~np.isnan(signal_rank)
+	has_ret = has_signal & ~np.isnan(daret)
+	has_me_ret = ~np.isnan(me_lagged) & ~np.isnan(daret)
+
+	NObs = cell_sum(None)
+	NStocks = cell_sum(has_signal.astype(np.float64)).sum(axis = 1)
+	Tsignal_rank = cell_sum(np.where(has_signal, signal_rank, 0.)).sum(axis = 1)
+	rank_daret = cell_sum(np.where(has_ret, signal_rank * daret, 0.)).sum(axis = 1)
+	sum_daret = cell_sum(np.where(has_ret, daret, 0.)).sum(axis = 1)
+	Tme = cell_sum(np.where(np.isnan(me_lagged), 0., me_lagged))
+	me_daret = cell_sum(np.where(has_me_ret, me_lagged * daret, 0.))
+
+	## Months with stocks but no valid weights contribute a zero return, as before
+	def safe_divide(num, den):
+		return np.divide(num, den, out = np.zeros(np.broadcast(num, den).shape), where = den != 0)
+
+	present = NObs.sum(axis = 1) > 0
+	ldate = np.empty(num_months, dtype = 'datetime64[ns]')
+	ldate[month] = df['ldate'].to_numpy(dtype = 'datetime64[ns]')
 
 	df_rets = {}
+	df_rets['retP_rank_longonly'] = safe_divide(rank_daret, Tsignal_rank)
+	df_rets['retP_rank_longshort'] = 4 * (df_rets['retP_rank_longonly'] - safe_divide(sum_daret, NStocks))
 
-	df_rets['retP_rank_longonly'] = df.groupby('ldate')['wgtd_daret'].sum()
+	retP_vw = np.where(NObs > 0, safe_divide(me_daret, Tme), np.nan)
+	for por_num in range(1, num_port + 1):
+		df_rets['retP_vw_P%d' %(por_num)] = retP_vw[:, por_num]
 
-	## Rank-weighted strategy long-short strategy
-	
-	df['NStocks'] = df.groupby('ldate')['signal'].transform('count')
-	df['weight'] = 4*(df['weight'] - 1/df['NStocks'])
-	df['wgtd_daret'] = df['weight'] * df['daret']
+	df_rets['retF_vw'] = df_rets['retP_vw_P%d' %(num_port)] - df_rets['retP_vw_P1']
 
-	df_rets['retP_rank_longshort'] = df.groupby('ldate')['wgtd_daret'].sum()
-	df_rets = DataFrame(df_rets)
-	df_rets.head()
+	df_rets = DataFrame(df_rets, index = pd.DatetimeIndex(ldate, name = 'ldate'))[present]
 
-	## Value-weighted returns for each of the portfolio
-	
-	df['Tme'] = df.groupby(['ldate', 'portfolio'])['me_lagged'].transform('sum')
-	df['weight'] = df['me_lagged'] / df['Tme']
+	## Value weights of each stock within its portfolio (NaN outside of portfolios)
+	weight = me_lagged / np.where(portfolio > 0, Tme[month, portfolio], np.nan)
+
+	if not holdings:
+		return df_rets.reset_index(), Series(weight, index = df.index)
 
+	#------------------------------------------------#
+	#  Sparse Holdings of Every Scheme
+
+	permnos, col = np.unique(df['permno'].to_numpy(), return_inverse = True)
+	row = (np.cumsum(present) - 1)[month]
+
+	def matrix(values):
+		W = sp.csr_matrix((np.where(np.isnan(values), 0., values), (row, col)), shape = (present.sum(), len(permnos)))
+		W.eliminate_zeros()
+		return W
+
+	w_rank = safe_divide(np.where(has_signal, signal_rank, 0.), Tsignal_rank[month])
+	w_vw = np.where(portfolio > 0, safe_divide(np.where(np.isnan(me_lagged), 0., me_lagged), Tme[month, portfolio]), 0.)
+
+	weights = {}
+	weights['rank_longonly'] = matrix(w_rank)
+	weights['rank_longshort'] = matrix(4 * (w_rank - safe_divide(has_signal.astype(np.float64), NStocks[month])))
 	for por_num in range(1, num_port + 1):
+		weights['vw_P%d' %(por_num)] = matrix(np.where(portfolio == por_num, w_vw, 0.))
+	weights['F_vw'] = weights['vw_P%d' %(num_port)] - weights['vw_P1']
 
-		sub_df = df[df['portfolio'] == por_num].copy(deep = True)
-		sub_df['wgtd_daret'] = sub_df['weight'] * sub_df['daret']
+	df_holdings = Holdings(df_rets.index, permnos, weights, matrix(daret))
 
-		df_rets['retP_vw_P%d' %(por_num)] = sub_df.groupby('ldate')['wgtd_daret'].sum()
+	return df_rets.reset_index(), Series(weight, index = df.index), df_holdings
 
-	df_rets['retF_vw'] = df_rets['retP_vw_P%d' %(num_port)] - df_rets['retP_vw_P1']
-	# common_index = df_rets['retF_vw'].index
+@instrumented
+def create_portfolios(df, sort_frequency, num_port, compact = False, holdings = False):
 
-	return df, df_rets.reset_index()
+	## Adds portfolio, signal_rank, Tsignal_rank, weight (value weight within the portfolio), wgtd_daret
+	## (rank-weighted long-short weight times daret), NStocks and Tme to df and sorts it in place, by
+	## ldate and signal for Monthly sorts and by permno and ldate for June sorts.
+	## compact = True leaves df untouched and returns, in place of df, a slim frame on the same index with
+	## permno, ldate and the results (portfolio, signal_rank, weight).
+	## holdings = True also returns the sparse weights of every scheme (see Holdings) as a third output.
 
-def analyze_strategy(df_strategy, analysis_type):
+	#------------------------------------------------#
+	#  Sort Portfolios
+
+	log('> Sorting stocks into %d portfolios at frequency: %s...' %(num_port, sort_frequency))
+
+	mord = month_ordinal(df['ldate'])
+	if compact:
+		df_port = df[['permno', 'ldate']].copy()
+		df_port['portfolio'] = assign_portfolios(df, sort_frequency, num_port, mord)
+	else:
+		if sort_frequency == 'June':
+			df['lmonth'] = df['ldate'].dt.month
+		df['portfolio'] = assign_portfolios(df, sort_frequency, num_port, mord)
+		df_port = df
 
 	#------------------------------------------------#
-	#  Prepare Data
+	#  Compute Returns for Different Weighting Schemes
 
-	print('> Merging strategy returns with Fama and French factor returns...')
+	log('> Computing returns using various weights...')
 
-	df_ff = pd.read_parquet('FFData.parquet').sort_values(['ldate']).rename(columns = {'ldate' : 'ym'})
+	df_port['signal_rank'] = df.groupby('ldate')['signal'].rank() # <-- this is the right one
+	df_inputs = df_port if not compact else df_port.assign(daret = df['daret'], me_lagged = df['me_lagged'])
+	results = portfolio_returns(df_inputs, num_port, mord, holdings)
+	df_rets, df_port['weight'] = results[0], results[1]
 
-	## Strategy Returns
-	df_strategy = df_strategy.rename(columns = {'ldate' : 'ym'})
-	df_strategy['ym'] = pd.to_datetime(df_strategy['ym'])
+	if not compact:
 
-	## Merge Data
-	df = pd.merge(df_strategy, df_ff, on = ['ym'], validate = 'many_to_one', indicator = True)
+		## Per-month rank totals and per-portfolio market caps behind the weights, as columns of df
+		month = mord - mord.min() if len(mord) > 0 else mord
+		num_months = month.max() + 1 if len(month) > 0 else 0
+		signal_rank = df['signal_rank'].to_numpy(dtype = np.float64, na_value = np.nan)
+		has_signal = ~np.isnan(signal_rank)
+		Tsignal_rank = np.bincount(month, weights = np.where(has_signal, signal_rank, 0.))[month]
+		NStocks = np.bincount(month[has_signal], minlength = num_months)[month]
 
-	if analysis_type == 'Performance':
+		portfolio = df['portfolio'].to_numpy(dtype = np.float64, na_value = np.nan)
+		in_portfolio = ~np.isnan(portfolio)
+		cell = month * (num_port + 1) + np.where(in_portfolio, portfolio, 0).astype(np.int64)
+		me_lagged = df['me_lagged'].to_numpy(dtype = np.float64, na_value = np.nan)
+		Tme = np.bincount(cell, weights = np.where(np.isnan(me_lagged), 0., me_lagged))[cell]
 
-		#------------------------------------------------#
-		#  Average Portfolio Return
+		## Same column order as before: weight follows Tsignal_rank
+		df['Tsignal_rank'] = Tsignal_rank
+		df['weight'] = df.pop('weight')
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			df['wgtd_daret'] = 4 * (signal_rank / Tsignal_rank - 1 / NStocks) * df['daret'].to_numpy(dtype = np.float64, na_value = np.nan)
+		df['NStocks'] = NStocks
+		df['Tme'] = np.where(in_portfolio, Tme, np.nan)
 
-		select_cols = [x for x in df.columns if 'retP_vw_P' in x]
+		df.sort_values(['ldate', 'signal'] if sort_frequency == 'Monthly' else ['permno', 'ldate'], inplace = True)
 
-		plot_series = df[select_cols].mean()
-		plot_series.index = plot_series.index.map(lambda x : x.replace('retP_vw_P', ''))
+	if holdings:
+		return df_port, df_rets, results[2]
 
-		fig = plt.figure(figsize = (12, 6))
-		plt.grid(axis = 'y', zorder = 0)
-		plt.bar(plot_series.index, plot_series.values * 100, color = 'maroon', width = 0.5, zorder = 5)
-		plt.title('Average Portfolio Return')
-		plt.xlabel('Portfolio Quantile'); plt.ylabel('Portfolio Return (%)')
-		plt.show()
-		plt.close()
+	return df_port, df_rets
 
-		#------------------------------------------------#
-		#  Cumulative Returns for the Long-Only Portfolio
-
-		df.sort_values(['ym'], inplace = True)
-		df['CLNmkt'] = np.log(1 + df['mktrf'] + df['rf']).cumsum()
-		df['CLNretP'] = np.log(1 + df['retP_rank_longonly']).cumsum()
-		plot_df = df[['CLNmkt', 'CLNretP', 'ym']].set_index('ym')
-		fig = plt.figure(figsize = (12, 6))
-		plot_df['CLNretP'].plot(ax = plt.gca(), color = 'maroon', label = 'Portfolio')
-		plot_df['CLNmkt'].plot(ax = plt.gca(), color = 'gray', label = 'Market')
-		plt.xlabel('Date'); plt.ylabel('Cumulative Return')
-		plt.title('Cumulative Returns for the Long-Only Strategy')
-		plt.legend()
-		plt.show()
-		plt.close()
+@instrumented
+def backtest_signals(df_full, signal_list, sample_start, sample_end, remove_micro_caps, sort_frequency, num_port, lag = 1,
+					 micro_cap_percentile = 0.2, micro_cap_exchanges = [1]):
+
+	## Run create_lag / select_sample / create_portfolios for many signal columns at once.
+	## The lag screen, date and return filters, month index, exchange membership and the
+	## market-cap sort behind the micro-cap cutoffs are computed once and shared by all signals.
+	## num_port can be an int or a list. Returns a long table keyed by (signal, num_port, ldate).
+
+	num_port_list = [num_port] if np.isscalar(num_port) else list(num_port)
+
+	log('> Running %d signals for %s portfolios at frequency: %s...' %(len(signal_list), num_port_list, sort_frequency))
+
+	#------------------------------------------------#
+	#  Shared Sample
+
+	## Lag every signal in one grouped pass (same screen as create_lag)
+	if lag != 0:
+		ldate_lag = df_full.groupby(['permno'])['ldate'].shift(lag)
+		screen = (ldate_lag == df_full['ldate'] - pd.DateOffset(months = lag)).astype(int).replace(0, np.nan)
+		signals = df_full.groupby(['permno'])[signal_list].shift(lag).multiply(screen, axis = 0)
+	else:
+		signals = df_full[signal_list]
+
+	in_sample = ((df_full['ldate'] <= sample_end) & (df_full['ldate'] >= sample_start) & df_full['daret'].notna()).to_numpy()
+	base = df_full.loc[in_sample, ['permno', 'ldate', 'exchcd', 'daret', 'me_lagged']]
+	signals = signals.loc[in_sample]
+
+	mord = month_ordinal(base['ldate'])
+	month = mord - mord.min() if len(mord) > 0 else mord
+	me_lagged = base['me_lagged'].to_numpy(dtype = np.float64, na_value = np.nan)
+
+	if remove_micro_caps:
+		if micro_cap_exchanges is None:
+			is_breakpoint = np.ones(len(base), dtype = bool)
+		else:
+			is_breakpoint = base['exchcd'].isin(micro_cap_exchanges).to_numpy()
+		cap_index = _sort_within_months(me_lagged, month, is_breakpoint)
+
+	#------------------------------------------------#
+	#  Evaluate Signals
+
+	df_rets_list = []
+	for signal_name in signal_list:
+
+		signal = signals[signal_name].to_numpy(dtype = np.float64, na_value = np.nan)
+		keep = ~np.isnan(signal)
+
+		## Micro caps: below the cutoff percentile of lagged market cap (NYSE by default) among stocks with a signal
+		if remove_micro_caps:
+			cutoffs = _lower_quantile_within_months(me_lagged, month, cap_index, micro_cap_percentile, keep)
+			keep = keep & (me_lagged >= cutoffs[month])
+
+		df = base.loc[keep]
+		df['signal'] = signal[keep]
+		df['signal_rank'] = df.groupby('ldate')['signal'].rank()
+
+		for num_port_i in num_port_list:
+			df['portfolio'] = assign_portfolios(df, sort_frequency, num_port_i, mord = mord[keep])
+			df_rets, _ = portfolio_returns(df, num_port_i, mord = mord[keep])
+			df_rets.insert(0, 'num_port', num_port_i)
+			df_rets.insert(0, 'signal', signal_name)
+			df_rets_list.append(df_rets)
+
+	return pd.concat(df_rets_list, ignore_index = True)
+
+#------------------------------------------------#
+#  Holdings
+
+class Holdings:
+
+	## Portfolio weights of every scheme as sparse (month x permno) matrices, built by portfolio_returns from
+	## the arrays it already holds, with the stock returns of the same cells. Schemes are 'rank_longonly',
+	## 'rank_longshort', 'vw_P1' ... 'vw_P<num_port>' and 'F_vw' (vw_P<num_port> - vw_P1), so that
+	## weights times returns summed over each row give the df_rets columns of the same name.
+	## Turnover, holding counts and cost-adjusted returns are then sparse row operations.
+
+	def __init__(self, dates, permnos, weights, returns):
+
+		self.dates = dates
+		self.permnos = permnos
+		self.weights = weights
+		self.returns = returns
+
+	@property
+	def schemes(self):
+
+		return list(self.weights.keys())
+
+	def gross_returns(self, scheme):
+
+		return Series(np.asarray(self.weights[scheme].multiply(self.returns).sum(axis = 1)).ravel(), index = self.dates)
+
+	def count(self, scheme):
+
+		## Number of stocks held each month
+		W = self.weights[scheme]
+		return Series(np.diff(W.indptr), index = self.dates)
+
+	def turnover(self, scheme, drift = True):
+
+		## Sum of absolute weight changes at each rebalancing. With drift = True the previous month's weights
+		## are first grown by their returns, w * (1 + r) / (1 + portfolio return), so that only trades count.
+		## The first month is the cost of building the initial position, sum |w|.
+		W = self.weights[scheme].tocsr()
+		if drift:
+			gross = np.asarray(W.multiply(self.returns).sum(axis = 1)).ravel()
+			scale = 1 / np.where(1 + gross != 0, 1 + gross, 1)
+			W_before = sp.diags(scale) @ W.multiply(self.returns + W.astype(bool)).tocsr()
+		else:
+			W_before = W
+
+		## Rebalancing into month t trades from the (drifted) weights of month t - 1
+		shifted = sp.vstack([sp.csr_matrix((1, W.shape[1])), W_before[:-1]]).tocsr()
+		trades = abs(W - shifted)
+
+		return Series(np.asarray(trades.sum(axis = 1)).ravel(), index = self.dates)
+
+	def net_returns(self, scheme, cost_bps, drift = True):
+
+		## Returns after proportional trading costs of cost_bps basis points per unit of turnover
+		return self.gross_returns(scheme) - cost_bps / 10000 * self.turnover(scheme, drift)
+
+	def to_long(self, scheme):
+
+		## (ldate, permno, weight) rows of the held positions
+		W = self.weights[scheme].tocoo()
+		return DataFrame({'ldate' : self.dates[W.row], 'permno' : self.permnos[W.col], 'weight' : W.data})
+
+#------------------------------------------------#
+#  Parameter Sweeps
+
+## Panel held by each sweep worker; set once by the pool initializer, which also quiets the worker
+_SWEEP_PANEL = None
+
+def _init_sweep_worker(df_panel):
+
+	global _SWEEP_PANEL
+	_SWEEP_PANEL = df_panel
+	set_quiet(True)
+
+def _run_sweep_config(config):
+
+	start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+	df = select_sample(_SWEEP_PANEL, config['sample_start'], config['sample_end'], config['remove_micro_caps'],
+					   micro_cap_percentile = config.get('micro_cap_percentile', 0.2),
+					   micro_cap_exchanges = config.get('micro_cap_exchanges', [1]))
+	_, df_rets = create_portfolios(df, config['sort_frequency'], config['num_port'], compact = True)
+
+	timing = {'seconds' : time.perf_counter() - start_wall, 'cpu_seconds' : time.process_time() - start_cpu,
+			  'nobs' : len(df), 'pid' : os.getpid()}
+
+	return df_rets, timing
+
+def sweep_grid(sample_period, remove_micro_caps, sort_frequency, num_port):
+
+	## Cartesian product of sweep settings. Each argument is a list; sample_period holds (start, end) pairs.
+	configs = []
+	for (sample_start, sample_end), micro, freq, num in itertools.product(sample_period, remove_micro_caps, sort_frequency, num_port):
+		configs.append({'sample_start' : sample_start, 'sample_end' : sample_end, 'remove_micro_caps' : micro,
+						'sort_frequency' : freq, 'num_port' : num})
+
+	return configs
+
+@instrumented
+def run_sweep(df_full, configs, max_workers = None):
+
+	## Run select_sample + create_portfolios for each configuration on a process pool.
+	## df_full must already hold the (lagged) 'signal' column. The panel is trimmed to the columns the
+	## pipeline needs, partitioned by month and shipped to each worker once through the pool initializer, not once per task;
+	## workers only send back df_rets and their timing.
+	## Returns the stacked df_rets (one block per config_id) and a per-configuration timing table.
+
+	df_panel = partition_by_month(df_full[['permno', 'ldate', 'exchcd', 'daret', 'me_lagged', 'signal']])
+
+	log('> Running %d configurations on %s workers...' %(len(configs), max_workers or os.cpu_count()))
+
+	df_rets_list, timing_list = [], []
+	with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_sweep_worker, initargs = (df_panel,)) as executor:
+		for config_id, (df_rets, timing) in enumerate(executor.map(_run_sweep_config, configs)):
+			df_rets.insert(0, 'config_id', config_id)
+			df_rets_list.append(df_rets)
+			timing_list.append(dict(configs[config_id], config_id = config_id, **timing))
+
+	df_timing = DataFrame(timing_list).set_index('config_id')
+
+	return pd.concat(df_rets_list, ignore_index = True), df_timing
+
+#------------------------------------------------#
+#  Streaming Backtest
+
+def stream_months(data_dir, file_name, columns, first_date = None, last_date = None):
+
+	## Yield (ldate, rows of that month) in calendar order from a parquet master file, reading only the
+	## row groups whose ldate statistics cover the month and keeping a row group only until its last month
+	## has passed. Memory stays bounded by the row groups that overlap one month, so the file should be
+	## written sorted by ldate (e.g. partition_by_month(df).to_parquet(path, row_group_size = ...)).
+	## Months without rows are yielded as empty frames so that callers can track calendar gaps.
+	import pyarrow.parquet as pq
+
+	info = catalog(data_dir, file_name)
+	if info['file_type'] != 'parquet':
+		raise Exception('Streaming requires a parquet file.')
+
+	parquet_file = pq.ParquetFile('%s/%s' %(data_dir, file_name))
+	first_month = month_ordinal(Series([pd.Timestamp(first_date or info['ldate_min'])]))[0]
+	last_month = month_ordinal(Series([pd.Timestamp(last_date or info['ldate_max'])]))[0]
+
+	## Month range of each row group (the whole file when a row group has no statistics)
+	group_range = []
+	for stats in info['row_groups']:
+		if stats['ldate_min'] is None:
+			group_range.append((first_month, last_month))
+		else:
+			group_range.append(tuple(month_ordinal(Series([stats['ldate_min'], stats['ldate_max']]))))
+
+	loaded = {}
+	for mord in range(first_month, last_month + 1):
+
+		for i, (lo, hi) in enumerate(group_range):
+			if lo <= mord <= hi and i not in loaded:
+				df_group = parquet_file.read_row_group(i, columns = columns).to_pandas()
+				loaded[i] = (df_group, month_ordinal(df_group['ldate']))
+
+		## Row groups in file order, so that duplicates resolve as in load_data
+		df_month = pd.concat([df_group[group_mord == mord] for i, (df_group, group_mord) in sorted(loaded.items())] or
+							 [DataFrame(columns = columns)], ignore_index = True)
+
+		for i in [i for i in loaded if group_range[i][1] <= mord]:
+			del loaded[i]
+
+		yield month_to_date(np.array([mord]))[0], df_month
+
+def _window_stat(values, min_obs, stat_type):
+
+	## Statistic over the columns of a (stocks x window) array, NaN unless min_obs values are available
+	nobs = (~np.isnan(values)).sum(axis = 1)
+	with np.errstate(invalid = 'ignore', divide = 'ignore'), warnings.catch_warnings():
+		warnings.simplefilter('ignore', category = RuntimeWarning)
+		if stat_type == 'mean':
+			result = np.nanmean(values, axis = 1)
+		elif stat_type == 'sum':
+			result = np.nansum(values, axis = 1)
+		elif stat_type in ['std', 'vol']:
+			result = np.where(nobs >= 2, np.nanstd(values, axis = 1, ddof = 1), np.nan)
+		elif stat_type == 'min':
+			result = np.nanmin(values, axis = 1)
+		elif stat_type == 'max':
+			result = np.nanmax(values, axis = 1)
+		else:
+			raise Exception('UNIMPLEMENTED stat_type: %s' %(stat_type))
+
+	return np.where(nobs >= max(min_obs, 1), result, np.nan)
+
+class StrategyState:
+
+	## Everything a backtest carries from one month to the next, so that it can run out of core
+	## (stream_backtest) or be extended by one month at a time (update_strategy):
+	##   - how many consecutive months each stock has been listed (the date-continuity check of create_lag)
+	##   - last month's market cap (me_lagged)
+	##   - the last lag (+ window) months of signal_variable
+	##   - the most recent June portfolio of each stock
+	##   - with beta_window set, each stock's last beta_window (excess return, excess market return)
+	##     observations, from which 'beta' is computed as in qpm_download.rolling_betas
+	## The signal is signal_variable lagged by lag months, or with window set its trailing window statistic
+	## (stat_type over window months, at least min_obs values, as in rolling_stats) lagged by lag months.
+	## sample_end = None keeps the strategy open for later months.
+
+	def __init__(self, signal_variable, sample_start, sample_end, remove_micro_caps, sort_frequency, num_port, lag = 1,
+				 window = None, min_obs = 1, stat_type = 'mean', micro_cap_percentile = 0.2, micro_cap_exchanges = [1],
+				 beta_window = None, beta_min_obs = 20):
+
+		if sort_frequency not in ['Monthly', 'June']:
+			raise Exception('Please provide a valid _SORT_FREQUENCY type. It should either be Monthly or June.')
+
+		self.config = {'signal_variable' : signal_variable, 'sample_start' : pd.Timestamp(sample_start),
+					   'sample_end' : pd.Timestamp(sample_end) if sample_end is not None else None,
+					   'remove_micro_caps' : remove_micro_caps, 'sort_frequency' : sort_frequency, 'num_port' : num_port,
+					   'lag' : lag, 'window' : window, 'min_obs' : min_obs, 'stat_type' : stat_type,
+					   'micro_cap_percentile' : micro_cap_percentile, 'micro_cap_exchanges' : micro_cap_exchanges,
+					   'beta_window' : beta_window, 'beta_min_obs' : beta_min_obs}
+
+		self.last_ldate = None
+		self.streak = Series(dtype = np.float64)
+		self.me_previous = Series(dtype = np.float64)
+		self.history = collections.deque(maxlen = lag + (window - 1 if window else 0) + 1)
+		self.june_labels = Series(dtype = np.float64)
+
+		self.beta_permnos = pd.Index([])
+		self.beta_y = np.empty((0, beta_window or 0))
+		self.beta_x = np.empty((0, beta_window or 0))
+
+	def first_date(self):
+
+		## Earliest month a fresh state has to see: the start of the file when betas are built, else
+		## just enough months before sample_start to fill the lag and window
+		if self.config['beta_window']:
+			return None
+		return self.config['sample_start'] - pd.DateOffset(months = self.history.maxlen)
+
+	def _update_betas(self, df):
+
+		## Append this month's observation to each listed stock's buffer and fit the slope on the valid pairs
+		permno = df['permno'].to_numpy()
+		new = ~np.isin(permno, self.beta_permnos)
+		if new.any():
+			self.beta_permnos = self.beta_permnos.append(pd.Index(permno[new]))
+			self.beta_y = np.vstack([self.beta_y, np.full((new.sum(), self.beta_y.shape[1]), np.nan)])
+			self.beta_x = np.vstack([self.beta_x, np.full((new.sum(), self.beta_x.shape[1]), np.nan)])
+
+		rows = self.beta_permnos.get_indexer(permno)
+		rf = df['rf'].to_numpy(dtype = np.float64, na_value = np.nan)
+		for buffer, values in [(self.beta_y, df['daret'].to_numpy(dtype = np.float64, na_value = np.nan) - rf),
+							   (self.beta_x, df['vwretd'].to_numpy(dtype = np.float64, na_value = np.nan) - rf)]:
+			buffer[rows, :-1] = buffer[rows, 1:]
+			buffer[rows, -1] = values
+
+		y, x = self.beta_y[rows], self.beta_x[rows]
+		valid = ~np.isnan(y) & ~np.isnan(x)
+		nobs = valid.sum(axis = 1)
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			x_dev = np.where(valid, x - np.nansum(np.where(valid, x, 0.), axis = 1, keepdims = True) / nobs[:, None], 0.)
+			y_dev = np.where(valid, y - np.nansum(np.where(valid, y, 0.), axis = 1, keepdims = True) / nobs[:, None], 0.)
+			beta = (x_dev * y_dev).sum(axis = 1) / (x_dev**2).sum(axis = 1)
+
+		return np.where(nobs >= self.config['beta_min_obs'], beta, np.nan)
+
+	def update(self, ldate, df):
+
+		## Advance the state by one month with that month's rows of the master panel. Returns the month's
+		## df_rets row, or None when the month is outside the sample or has no eligible stocks.
+		config = self.config
+		ldate = pd.Timestamp(ldate)
+
+		## Calendar months without any data still break the continuity of every stock
+		if self.last_ldate is not None:
+			if ldate <= self.last_ldate:
+				raise Exception('State is already at %s; cannot add %s.' %(self.last_ldate.date(), ldate.date()))
+			if ldate > self.last_ldate + pd.DateOffset(months = 1):
+				self.update(self.last_ldate + pd.DateOffset(months = 1), df.iloc[0:0])
+
+		self.last_ldate = ldate
+
+		rename = {'mve_c' : 'me'} if 'me' not in df.columns else {}
+		rename.update({'ret' : 'daret'} if 'daret' not in df.columns else {})
+		df = df.rename(columns = rename).drop_duplicates(subset = ['permno'], keep = 'first')
+		permno = df['permno'].to_numpy()
+
+		if config['beta_window']:
+			df['beta'] = self._update_betas(df)
+
+		## Carry the state forward by one month
+		self.streak = self.streak.reindex(permno).fillna(0) + 1
+		df['me_lagged'] = self.me_previous.reindex(permno).to_numpy()
+		self.me_previous = Series(df['me'].to_numpy(dtype = np.float64, na_value = np.nan), index = permno)
+		self.history.append(Series(df[config['signal_variable']].to_numpy(dtype = np.float64, na_value = np.nan), index = permno))
+
+		if ldate < config['sample_start'] or (config['sample_end'] is not None and ldate > config['sample_end']) or len(df) == 0:
+			return None
+
+		## Signal: the value (or window statistic) lag months ago, for stocks listed in every month since
+		lag, window, history = config['lag'], config['window'], self.history
+		if len(history) <= lag:
+			signal = np.full(len(df), np.nan)
+		elif window:
+			months = list(history)[max(len(history) - lag - window, 0):len(history) - lag]
+			signal = _window_stat(np.column_stack([x.reindex(permno).to_numpy() for x in months]), config['min_obs'], config['stat_type'])
+		else:
+			signal = history[-1 - lag].reindex(permno).to_numpy()
+		df['signal'] = np.where(self.streak.to_numpy() >= lag + 1, signal, np.nan)
 
 		#------------------------------------------------#
-		#  Cumulative Returns for the Long-Short Rank-Based Portfolio
-
-		df.sort_values(['ym'], inplace = True)
-		df['CLNrf'] = np.log(1 + df['rf']).cumsum()
-		df['CLNretP'] = np.log(1 + df['retP_rank_longshort'] + df['rf']).cumsum()
-		plot_df = df[['CLNrf', 'CLNretP', 'ym']].set_index('ym')
-		fig = plt.figure(figsize = (12, 6))
-		plot_df['CLNretP'].plot(ax = plt.gca(), color = 'maroon', label = 'Portfolio')
-		plot_df['CLNrf'].plot(ax = plt.gca(), color = 'gray', label = 'Risk-free Benchmark')
-		plt.xlabel('Date'); plt.ylabel('Cumulative Return')
-		plt.title('Cumulative Returns for the Long-Short Rank-Based Strategy')
-		plt.legend()
-		plt.show()
-		plt.close()
-        
+		#  Select Sample
+
+		df = df[df['daret'].notna() & df['signal'].notna()]
+		if config['remove_micro_caps']:
+			df = df[df['me_lagged'] >= micro_cap_cutoffs(df, config['micro_cap_percentile'], config['micro_cap_exchanges'])]
+		if len(df) == 0:
+			return None
+
 		#------------------------------------------------#
-		#  Cumulative Returns for the Long-Short Portfolio-Based Portfolio
-
-		df.sort_values(['ym'], inplace = True)
-		df['CLNretF_vw'] = np.log(1 + df['retF_vw'] + df['rf']).cumsum()
-		plot_df = df[['CLNrf', 'CLNretF_vw', 'ym']].set_index('ym')
-		fig = plt.figure(figsize = (12, 6))
-		plot_df['CLNretF_vw'].plot(ax = plt.gca(), color = 'maroon', label = 'Portfolio')
-		plot_df['CLNrf'].plot(ax = plt.gca(), color = 'gray', label = 'Risk-free Benchmark')
-		plt.xlabel('Date'); plt.ylabel('Cumulative Return')
-		plt.title('Cumulative Returns for the Long-Short Portfolio-Based Strategy')
-		plt.legend()
+		#  Sort Portfolios and Compute Returns
+
+		num_port = config['num_port']
+		if config['sort_frequency'] == 'Monthly':
+			df['portfolio'] = assign_portfolios(df, 'Monthly', num_port)
+		else:
+			## July (signal as of June) updates the held assignment, which every month then reads
+			if ldate.month == 7:
+				labels = assign_portfolios(df, 'Monthly', num_port).astype(float)
+				self.june_labels = pd.concat([self.june_labels, Series(labels.to_numpy(), index = df['permno'].to_numpy())])
+				self.june_labels = self.june_labels[~self.june_labels.index.duplicated(keep = 'last')]
+			df['portfolio'] = self.june_labels.reindex(df['permno'].to_numpy()).to_numpy()
+
+		df['signal_rank'] = df['signal'].rank()
+		df_rets, _ = portfolio_returns(df, num_port)
+
+		return df_rets
+
+	def stream(self, data_dir, file_name, last_date = None):
+
+		## Feed the months of a parquet master file after the state's last month (through last_date or
+		## sample_end), yielding each month's df_rets row
+		config = self.config
+		columns = catalog(data_dir, file_name)['columns']
+		read_cols = ['permno', 'ldate', 'exchcd', 'me' if 'me' in columns else 'mve_c', 'daret' if 'daret' in columns else 'ret']
+		if config['beta_window']:
+			read_cols += ['rf', 'vwretd']
+		if config['signal_variable'] not in read_cols and not (config['beta_window'] and config['signal_variable'] == 'beta'):
+			read_cols += [config['signal_variable']]
+
+		first_date = self.first_date() if self.last_ldate is None else self.last_ldate + pd.DateOffset(months = 1)
+		last_date = last_date or config['sample_end']
+
+		for ldate, df in stream_months(data_dir, file_name, read_cols, first_date, last_date):
+			df_rets = self.update(ldate, df)
+			if df_rets is not None:
+				yield df_rets
+
+	def save(self, path):
+
+		## Write to a temporary file first so that a crash never leaves a truncated state behind
+		temp_file = '%s.%d.tmp' %(path, os.getpid())
+		pd.to_pickle(self, temp_file)
+		os.replace(temp_file, path)
+
+	@classmethod
+	def load(cls, path):
+
+		return pd.read_pickle(path)
+
+def stream_backtest(data_dir, file_name, signal_variable, sample_start, sample_end, remove_micro_caps, sort_frequency, num_port, lag = 1,
+					window = None, min_obs = 1, stat_type = 'mean', micro_cap_percentile = 0.2, micro_cap_exchanges = [1], state = None):
+
+	## Out-of-core version of load_data -> create_lag -> select_sample -> create_portfolios for panels that do
+	## not fit in memory: the master parquet is read one month at a time (see stream_months) and only the small
+	## StrategyState is kept between months. Yields the df_rets row of each month as soon as the month is done;
+	## pd.concat the output for the full table. Pass a StrategyState as state to use its settings instead of the
+	## arguments and to keep it for later update_strategy calls.
+	if state is None:
+		state = StrategyState(signal_variable, sample_start, sample_end, remove_micro_caps, sort_frequency, num_port, lag,
+							  window, min_obs, stat_type, micro_cap_percentile, micro_cap_exchanges)
+
+	yield from state.stream(data_dir, file_name)
+
+@instrumented
+def update_strategy(state_file, df_month, results_file = None):
+
+	## Month-end update: add one new month of the master panel (all rows share one ldate) to a saved
+	## StrategyState, append the month's returns to results_file (a df_rets csv such as
+	## Strategy/StrategyReturns_*.csv) and save the state again. The state is saved last and a month already
+	## in results_file is replaced, so a job that dies part-way can simply be rerun.
+	## The results match a full rerun because the state holds everything the pipeline carries across months.
+	## Returns the new df_rets row (None when no stock is eligible).
+	state = StrategyState.load(state_file)
+
+	ldates = df_month['ldate'].unique()
+	if len(ldates) != 1:
+		raise Exception('update_strategy expects exactly one month of data, got %d.' %(len(ldates)))
+
+	df_rets = state.update(ldates[0], df_month)
+
+	if results_file is not None and df_rets is not None:
+		if os.path.exists(results_file):
+			df_results = pd.read_csv(results_file, index_col = 0, parse_dates = ['ldate'])
+			df_results = df_results[df_results['ldate'] != df_rets['ldate'].iloc[0]]
+			df_rets_all = pd.concat([df_results, df_rets], ignore_index = True)
+		else:
+			df_rets_all = df_rets
+
+		## Replace the file in one step (as StrategyState.save) so that a crash never truncates earlier months
+		temp_file = '%s.%d.tmp' %(results_file, os.getpid())
+		df_rets_all.to_csv(temp_file)
+		os.replace(temp_file, results_file)
+
+	state.save(state_file)
+
+	return df_rets
+
+#------------------------------------------------#
+#  Factor Regressions
+
+## Factor models used by analyze_strategy; each maps to its regressors (the constant is added by the engine)
+FACTOR_MODELS = {'CAPM' : ['mktrf'],
+				 'FF3' : ['mktrf', 'smb', 'hml'],
+				 'FF5' : ['mktrf', 'smb', 'hml', 'rmw', 'cma'],
+				 'FF6' : ['mktrf', 'smb', 'hml', 'rmw', 'cma', 'umd']}
+
+@instrumented
+def factor_regressions(df, y_cols, factor_models = FACTOR_MODELS, periods_per_year = 12, dropna = True):
+
+	## Regress every return column in y_cols on every factor model in one batched least-squares solve per model.
+	## All strategies share one design matrix, so a model costs a single pseudo-inverse no matter how many strategies
+	## are passed in. With dropna = True the sample is the set of rows where every y_col and every factor is present,
+	## i.e. the same sample a joint dropna gives before fitting each sm.OLS. Standard errors are the usual (nonrobust) OLS ones.
+	## Returns a tidy DataFrame with one row per (strategy, model): coefficients, standard errors, t-stats and p-values for
+	## 'alpha' and each factor, plus nobs, r2, r2_adj, the annualized alpha, annualized residual vol and information ratio.
+
+	if isinstance(factor_models, (list, tuple)):
+		factor_models = {model : FACTOR_MODELS[model] for model in factor_models}
+
+	factor_cols = list(dict.fromkeys(f for factors in factor_models.values() for f in factors))
+	reg_df = df[list(dict.fromkeys(list(y_cols) + factor_cols))]
+	if dropna:
+		reg_df = reg_df.dropna()
+
+	Y = reg_df[list(y_cols)].to_numpy(dtype = 'float64')
+	nobs = Y.shape[0]
+	sst = ((Y - Y.mean(axis = 0)) ** 2).sum(axis = 0)
+
+	results = []
+	for model, factors in factor_models.items():
+
+		X = np.column_stack([np.ones(nobs), reg_df[factors].to_numpy(dtype = 'float64')])
+		k = X.shape[1]
+		df_resid = nobs - k
+
+		X_pinv = np.linalg.pinv(X)
+		B = X_pinv @ Y
+		resid = Y - X @ B
+		ssr = (resid ** 2).sum(axis = 0)
+
+		## (X'X)^-1 = pinv(X) pinv(X)'; samples with no residual degrees of freedom give NaN, as in statsmodels
+		with np.errstate(invalid = 'ignore', divide = 'ignore'):
+			se = np.sqrt(np.outer(np.einsum('ij,ij->i', X_pinv, X_pinv), ssr / df_resid)) if df_resid > 0 else np.full(B.shape, np.nan)
+			t_stat = B / se
+			p_value = 2 * t_dist.sf(np.abs(t_stat), df_resid)
+
+			r2 = 1 - ssr / sst
+			r2_adj = 1 - (1 - r2) * (nobs - 1) / df_resid
+		resid_vol = resid.std(axis = 0) * np.sqrt(periods_per_year)
+		alpha_ann = B[0] * periods_per_year
+
+		df_model = DataFrame({'strategy' : list(y_cols), 'model' : model, 'nobs' : nobs})
+		for i, term in enumerate(['alpha'] + list(factors)):
+			df_model[term] = B[i]
+			df_model[term + '_se'] = se[i]
+			df_model[term + '_t'] = t_stat[i]
+			df_model[term + '_p'] = p_value[i]
+		df_model['r2'] = r2
+		df_model['r2_adj'] = r2_adj
+		df_model['alpha_ann'] = alpha_ann
+		df_model['resid_vol'] = resid_vol
+		df_model['IR'] = alpha_ann / resid_vol
+		results.append(df_model)
+
+	## Coefficient columns follow the first model that uses each factor
+	df_results = pd.concat(results, ignore_index = True)
+	term_cols = [c for term in ['alpha'] + factor_cols for c in [term, term + '_se', term + '_t', term + '_p']]
+
+	return df_results[['strategy', 'model', 'nobs'] + term_cols + ['r2', 'r2_adj', 'alpha_ann', 'resid_vol', 'IR']]
+
+def regression_table(df_results, regressor_order, model_names = None):
+
+	## Text table in the layout of statsmodels' summary_col(stars = True): one column per row of df_results,
+	## coefficients with significance stars over their standard errors in parentheses, then R-squared, N and R2.
+
+	model_names = model_names or ['(%d)' %(i + 1) for i in range(len(df_results))]
+	terms = [term for term in regressor_order if term in df_results.columns]
+
+	def format_coef(row, term):
+		if pd.isna(row[term]):
+			return '', ''
+		p = row[term + '_p']
+		stars = '***' if p < 0.01 else '**' if p < 0.05 else '*' if p < 0.1 else ''
+		return '%.4f%s' %(row[term], stars), '(%.4f)' %(row[term + '_se'])
+
+	table = {}
+	for name, (_, row) in zip(model_names, df_results.iterrows()):
+		column = []
+		for term in terms:
+			column.extend(format_coef(row, term))
+		column.extend(['%.4f' %(row['r2']), '%.4f' %(row['r2_adj']), '%d' %(row['nobs']), '%.2f' %(row['r2'])])
+		table[name] = column
+
+	index = []
+	for term in terms:
+		index.extend(['const' if term == 'alpha' else term, ''])
+	index.extend(['R-squared', 'R-squared Adj.', 'N', 'R2'])
+
+	## Left-aligned columns as wide as their widest cell, separated by one space, header names centred
+	index_width = max(len(x) for x in index) + 1
+	widths = {name : max(len(x) for x in [name] + column) for name, column in table.items()}
+
+	lines = [''.ljust(index_width) + ' '.join(name.center(widths[name]) for name in table)]
+	for i, label in enumerate(index):
+		lines.append(label.ljust(index_width) + ' '.join(table[name][i].ljust(widths[name]) for name in table))
+	width = len(lines[0])
+
+	return '\n'.join(['', '=' * width, lines[0], '-' * width] + lines[1:] +
+					 ['=' * width, 'Standard errors in parentheses.', '* p<.1, ** p<.05, ***p<.01'])
+
+
+#------------------------------------------------#
+#  Performance Charts
+
+## Charts drawn by analyze_strategy's 'Performance' branch and by performance_report, in display order
+PERFORMANCE_CHARTS = ['average_portfolio_return', 'cumulative_longonly', 'cumulative_longshort_rank', 'cumulative_longshort_portfolio']
+
+def _new_figure(headless, **kwargs):
+
+	## pyplot figure for interactive use; a bare Figure (no backend, nothing to show) when the chart goes to a file
+	if not headless:
+		return plt.figure(**kwargs)
+
+	from matplotlib.figure import Figure
+	return Figure(**kwargs)
+
+def _finish_figure(fig, output):
+
+	if output is None:
 		plt.show()
-		plt.close()
+		plt.close(fig)
+	else:
+		fig.savefig(output)
 
-	elif analysis_type == 'Summary':
+def performance_series(df):
 
-		select_cols = ['retP_rank_longonly', 'retP_rank_longshort', 'retF_vw', 'mktrf', 'smb', 'hml']
-		print(df[select_cols].describe().T)
+	## Series behind the performance charts, computed once from strategy returns merged with the factors
+	df = df.sort_values(['ym'])
 
-	elif analysis_type == 'Factor Regression':
+	select_cols = [x for x in df.columns if 'retP_vw_P' in x]
+	portfolio_means = df[select_cols].mean()
+	portfolio_means.index = portfolio_means.index.map(lambda x : x.replace('retP_vw_P', ''))
 
-		## Table 1: 3 FF Model
-		print('')
-		print('---------------------------------------------------------------')
-		print('> Running Factor Regressions: Table 1  - 3 Fama-French Factors')
-		print('---------------------------------------------------------------')
+	df_cum = DataFrame(index = df['ym'])
+	df_cum['CLNmkt'] = np.log(1 + df['mktrf'] + df['rf']).cumsum().values
+	df_cum['CLNrf'] = np.log(1 + df['rf']).cumsum().values
+	df_cum['CLNretP_longonly'] = np.log(1 + df['retP_rank_longonly']).cumsum().values
+	df_cum['CLNretP_longshort'] = np.log(1 + df['retP_rank_longshort'] + df['rf']).cumsum().values
+	df_cum['CLNretF_vw'] = np.log(1 + df['retF_vw'] + df['rf']).cumsum().values
 
-		import statsmodels.api as sm
+	return {'portfolio_means' : portfolio_means, 'cumulative' : df_cum}
 
-		df['retP_rank_longonly_e'] = df['retP_rank_longonly'] - df['rf']
+def draw_performance_chart(ax, chart, series):
 
-		reg_df = df[['retF_vw', 'mktrf', 'retP_rank_longonly_e', 'retP_rank_longshort', 'smb', 'hml']].dropna()
-		m1 = sm.OLS(reg_df['retF_vw'], sm.add_constant(reg_df['mktrf'])).fit()
-		m2 = sm.OLS(reg_df['retP_rank_longonly_e'], sm.add_constant(reg_df['mktrf'])).fit()
-		m3 = sm.OLS(reg_df['retP_rank_longshort'], sm.add_constant(reg_df['mktrf'])).fit()
-		m4 = sm.OLS(reg_df['retF_vw'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml']])).fit()
-		m5 = sm.OLS(reg_df['retP_rank_longonly_e'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml']])).fit()
-		m6 = sm.OLS(reg_df['retP_rank_longshort'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml']])).fit()
-
-		from statsmodels.iolib.summary2 import summary_col
-		summary = summary_col([m1, m2, m3, m4, m5, m6], regressor_order = ['const', 'mktrf', 'hml', 'smb'],
-							  stars = True, drop_omitted = True,
-							  model_names=['(1)', '(2)', '(3)', '(4)', '(5)', '(6)'],
-							  info_dict = {'N':lambda x: "{0:d}".format(int(x.nobs)),
-										   'R2':lambda x: "{:.2f}".format(x.rsquared)})
-		print(summary)
-		print('(1): Long-Short Value Weights ~ CAPM Model')
-		print('(2): Long-Only Rank Weights ~ CAPM Model')
-		print('(3): Long-Short Rank Weights ~ CAPM Model')
-		print('(4): Long-Short Value Weights ~ 3-Factor Fama French Model')
-		print('(5): Long-Only Rank Weights ~ 3-Factor Fama French Model')
-		print('(6): Long-Short Rank Weights ~ 3-Factor Fama French Model')
-
-		summary_IR, cnt = {}, 1
-		for model in [m1, m2, m3, m4, m5, m6]:
-			summary_IR[cnt] = {}
-			summary_IR[cnt]['Alpha'] = model.params['const'] * 12
-			summary_IR[cnt]['Std(resid)'] = np.std(model.resid) * np.sqrt(12)
-			summary_IR[cnt]['Information Ratio'] = summary_IR[cnt]['Alpha'] / summary_IR[cnt]['Std(resid)']
-
-			cnt += 1
-
-		summary_IR = DataFrame(summary_IR)
-		print('Annualized Information Ratios:')
-		print(summary_IR.round(3))
-
-		## Table 2: 3 FF Model
-		print('\n\n')
-		print('---------------------------------------------------------------')
-		print('> Running Factor Regressions: Table 2  - 5 Fama-French Factors + Momentum')
-		print('---------------------------------------------------------------')
-
-		import statsmodels.api as sm
+	if chart == 'average_portfolio_return':
+		plot_series = series['portfolio_means']
+		ax.grid(axis = 'y', zorder = 0)
+		ax.bar(plot_series.index, plot_series.values * 100, color = 'maroon', width = 0.5, zorder = 5)
+		ax.set_title('Average Portfolio Return')
+		ax.set_xlabel('Portfolio Quantile'); ax.set_ylabel('Portfolio Return (%)')
+		return
 
-		df['retP_rank_longonly_e'] = df['retP_rank_longonly'] - df['rf']
+	## Cumulative log returns: (portfolio column, benchmark column, benchmark label, title)
+	portfolio_col, benchmark_col, benchmark_label, title = {
+		'cumulative_longonly' : ('CLNretP_longonly', 'CLNmkt', 'Market', 'Cumulative Returns for the Long-Only Strategy'),
+		'cumulative_longshort_rank' : ('CLNretP_longshort', 'CLNrf', 'Risk-free Benchmark', 'Cumulative Returns for the Long-Short Rank-Based Strategy'),
+		'cumulative_longshort_portfolio' : ('CLNretF_vw', 'CLNrf', 'Risk-free Benchmark', 'Cumulative Returns for the Long-Short Portfolio-Based Strategy'),
+	}[chart]
+
+	plot_df = series['cumulative']
+	plot_df[portfolio_col].plot(ax = ax, color = 'maroon', label = 'Portfolio')
+	plot_df[benchmark_col].plot(ax = ax, color = 'gray', label = benchmark_label)
+	ax.set_xlabel('Date'); ax.set_ylabel('Cumulative Return')
+	ax.set_title(title)
+	ax.legend()
+
+def merge_factors(df_strategy, df_ff = None):
+
+	## Strategy returns merged with the monthly factors from the factor store, keyed on 'ym'
+	if df_ff is None:
+		df_ff = get_factors('monthly')
+	df_ff = df_ff.rename(columns = {'ldate' : 'ym'})
+
+	df_strategy = df_strategy.rename(columns = {'ldate' : 'ym'})
+	df_strategy['ym'] = pd.to_datetime(df_strategy['ym'])
+
+	return pd.merge(df_strategy, df_ff, on = ['ym'], validate = 'many_to_one', indicator = True)
+
+def render_performance(df, output_dir, formats = ['png'], charts = PERFORMANCE_CHARTS):
+
+	## Draw each chart once, off screen, and save it in every requested format (png, svg, pdf, ...)
+	## df is the strategy merged with the factors. Returns the list of files written.
+	os.makedirs(output_dir, exist_ok = True)
+	series = performance_series(df)
+
+	files = []
+	for chart in charts:
+		fig = _new_figure(True, figsize = (12, 6))
+		draw_performance_chart(fig.add_subplot(), chart, series)
+		for fmt in formats:
+			output_file = os.path.join(output_dir, '%s.%s' %(chart, fmt))
+			_finish_figure(fig, output_file)
+			files.append(output_file)
+
+	return files
+
+## Monthly factors held by each report worker; set once by the pool initializer
+_REPORT_FACTORS = None
+
+def _init_report_worker(df_ff):
+
+	global _REPORT_FACTORS
+	_REPORT_FACTORS = df_ff
+
+def _render_report_task(task):
+
+	name, df_strategy, output_dir, formats = task
+	start_wall = time.perf_counter()
+
+	df = merge_factors(df_strategy, _REPORT_FACTORS)
+	files = render_performance(df, os.path.join(output_dir, name), formats)
+
+	return files, time.perf_counter() - start_wall
+
+@instrumented
+def performance_report(strategies, output_dir, formats = ['png'], max_workers = None):
+
+	## Render the 'Performance' charts of many strategies without a display, one strategy per task on a process pool.
+	## strategies maps a name (used as the sub-directory) to its df_strategy. The monthly factors are read from the
+	## factor store here and shipped to each worker once. Charts land in output_dir/<name>/<chart>.<format>; an
+	## index.html linking all of them is written to output_dir. Returns the index as a DataFrame.
+
+	os.makedirs(output_dir, exist_ok = True)
+	df_ff = get_factors('monthly')
+	tasks = [(name, df_strategy, output_dir, formats) for name, df_strategy in strategies.items()]
+
+	log('> Rendering %d strategies on %s workers...' %(len(tasks), max_workers or os.cpu_count()))
+
+	index_list = []
+	with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_report_worker, initargs = (df_ff,)) as executor:
+		for (name, _, _, _), (files, seconds) in zip(tasks, executor.map(_render_report_task, tasks)):
+			for output_file in files:
+				chart, fmt = os.path.splitext(os.path.basename(output_file))
+				index_list.append({'strategy' : name, 'chart' : chart, 'format' : fmt[1:],
+								   'path' : os.path.relpath(output_file, output_dir), 'seconds' : seconds})
+
+	df_index = DataFrame(index_list, columns = ['strategy', 'chart', 'format', 'path', 'seconds'])
+
+	## index.html: one section per strategy, charts in display order (first format only for the preview)
+	html = ['<html><head><title>Strategy Performance</title></head><body>', '<h1>Strategy Performance</h1>']
+	for name, df_name in df_index.groupby('strategy', sort = False):
+		html.append('<h2>%s</h2>' %(name))
+		for _, row in df_name[df_name['format'] == formats[0]].iterrows():
+			html.append('<p><a href="%s"><img src="%s" alt="%s" width="800"></a></p>' %(row['path'], row['path'], row['chart']))
+	html.append('</body></html>')
+
+	with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+		f.write('\n'.join(html))
+
+	return df_index
+
+
+@instrumented
+def analyze_strategy(df_strategy, analysis_type, output_dir = None, formats = ['png']):
+
+	#------------------------------------------------#
+	#  Prepare Data
+
+	log('> Merging strategy returns with Fama and French factor returns...')
+
+	df = merge_factors(df_strategy)
+
+	if analysis_type == 'Performance':
+
+		## Each chart is drawn from series computed once; with output_dir set they are saved instead of shown
+		if output_dir is not None:
+			render_performance(df, output_dir, formats)
+		else:
+			series = performance_series(df)
+			for chart in PERFORMANCE_CHARTS:
+				fig = _new_figure(False, figsize = (12, 6))
+				draw_performance_chart(fig.gca(), chart, series)
+				_finish_figure(fig, None)
 
-		reg_df = df[['retF_vw', 'mktrf', 'retP_rank_longonly_e', 'retP_rank_longshort', 'smb', 'hml', 'rmw', 'cma', 'umd']].dropna()
-		m1 = sm.OLS(reg_df['retF_vw'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml', 'rmw', 'cma']])).fit()
-		m2 = sm.OLS(reg_df['retP_rank_longonly_e'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml', 'rmw', 'cma']])).fit()
-		m3 = sm.OLS(reg_df['retP_rank_longshort'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml', 'rmw', 'cma']])).fit()
-		m4 = sm.OLS(reg_df['retF_vw'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml', 'rmw', 'cma', 'umd']])).fit()
-		m5 = sm.OLS(reg_df['retP_rank_longonly_e'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml', 'rmw', 'cma', 'umd']])).fit()
-		m6 = sm.OLS(reg_df['retP_rank_longshort'], sm.add_constant(reg_df[['mktrf', 'smb', 'hml', 'rmw', 'cma', 'umd']])).fit()
-
-		from statsmodels.iolib.summary2 import summary_col
-		summary = summary_col([m1, m2, m3, m4, m5, m6], regressor_order = ['const', 'mktrf', 'hml', 'smb', 'rmw', 'cma', 'umd'],
-							  stars = True, drop_omitted = True,
-							  model_names=['(1)', '(2)', '(3)', '(4)', '(5)', '(6)'],
-							  info_dict = {'N':lambda x: "{0:d}".format(int(x.nobs)),
-										   'R2':lambda x: "{:.2f}".format(x.rsquared)})
-		print(summary)
-		print('(1): Long-Short Value Weights ~ 5-Factor Fama French Model')
-		print('(2): Long-Only Rank Weights ~ 5-Factor Fama French Model')
-		print('(3): Long-Short Rank Weights ~ 5-Factor Fama French Model')
-		print('(4): Long-Short Value Weights ~ 6-Factor Fama French Model')
-		print('(5): Long-Only Rank Weights ~ 6-Factor Fama French Model')
-		print('(6): Long-Short Rank Weights ~ 6-Factor Fama French Model')
-
-		summary_IR, cnt = {}, 1
-		for model in [m1, m2, m3, m4, m5, m6]:
-			summary_IR[cnt] = {}
-			summary_IR[cnt]['Alpha'] = model.params['const'] * 12
-			summary_IR[cnt]['Std(resid)'] = np.std(model.resid) * np.sqrt(12)
-			summary_IR[cnt]['Information Ratio'] = summary_IR[cnt]['Alpha'] / summary_IR[cnt]['Std(resid)']
-
-			cnt += 1
-
-		summary_IR = DataFrame(summary_IR)
-		print('Annualized Information Ratios:')
-		print(summary_IR.round(3))
+	elif analysis_type == 'Summary':
+
+		select_cols = ['retP_rank_longonly', 'retP_rank_longshort', 'retF_vw', 'mktrf', 'smb', 'hml']
+		print(df[select_cols].describe().T)
+
+	elif analysis_type == 'Factor Regression':
+
+		df['retP_rank_longonly_e'] = df['retP_rank_longonly'] - df['rf']
+		y_cols = ['retF_vw', 'retP_rank_longonly_e', 'retP_rank_longshort']
+
+		## Each table is one batched solve; models are ordered (1)-(3) for the first factor model, (4)-(6) for the second
+		tables = [('Table 1  - 3 Fama-French Factors', ['CAPM', 'FF3'], ['const', 'mktrf', 'hml', 'smb'],
+				   ['CAPM Model', '3-Factor Fama French Model']),
+				  ('Table 2  - 5 Fama-French Factors + Momentum', ['FF5', 'FF6'], ['const', 'mktrf', 'hml', 'smb', 'rmw', 'cma', 'umd'],
+				   ['5-Factor Fama French Model', '6-Factor Fama French Model'])]
+
+		for table_id, (title, models, regressor_order, model_labels) in enumerate(tables):
+
+			print('\n\n' if table_id else '')
+			print('---------------------------------------------------------------')
+			print('> Running Factor Regressions: %s' %(title))
+			print('---------------------------------------------------------------')
+
+			df_results = factor_regressions(df, y_cols, models)
+			df_results['model'] = pd.Categorical(df_results['model'], categories = models)
+			df_results = df_results.sort_values(['model'], kind = 'stable').reset_index(drop = True)
+
+			print(regression_table(df_results, ['alpha' if x == 'const' else x for x in regressor_order]))
+			cnt = 1
+			for model_label in model_labels:
+				for strategy_label in ['Long-Short Value Weights', 'Long-Only Rank Weights', 'Long-Short Rank Weights']:
+					print('(%d): %s ~ %s' %(cnt, strategy_label, model_label))
+					cnt += 1
+
+			summary_IR = df_results[['alpha_ann', 'resid_vol', 'IR']].T
+			summary_IR.index = ['Alpha', 'Std(resid)', 'Information Ratio']
+			summary_IR.columns = range(1, len(df_results) + 1)
+			print('Annualized Information Ratios:')
+			print(summary_IR.round(3))
 
 	else:
 
@@ -572,61 +2221,183 @@ def analyze_strategy(df_strategy, analysis_type):
 --------------------------------------------------------------------
 '''
 
-def plot_cumulative_returns_etf(df, var_list):
+#------------------------------------------------#
+#  Identifier Index
+
+class IdentifierIndex:
+
+	## Point-in-time identifier lookups on a long panel without scanning it.
+	## Rows are ordered by (permno, ldate) once; each permno then owns one contiguous range of that
+	## order, and a date window inside it is two binary searches. Tickers are stored as spells
+	## (ticker, permno, first ldate, last ldate) sorted by ticker, so a ticker resolves to the permno
+	## that carried it at a given date, or most recently, also by binary search.
+
+	def __init__(self, order, permnos, starts, ends, ldates, spells):
+
+		self.order = order
+		self.permnos = permnos
+		self.starts = starts
+		self.ends = ends
+		self.ldates = ldates
+		self.spells = spells
+
+	@classmethod
+	def from_long(cls, df):
+
+		permno = df['permno'].to_numpy()
+		ldate = df['ldate'].to_numpy()
+
+		## Positions sorted by (permno, ldate); None when the frame is already in that order (load_data sorts it)
+		order = np.lexsort((ldate, permno))
+		if (order == np.arange(len(order))).all():
+			order = None
+		else:
+			permno, ldate = permno[order], ldate[order]
+
+		permnos, starts = np.unique(permno, return_index = True)
+		ends = np.append(starts[1:], len(permno))
+
+		## Ticker spells: runs of the same ticker within a permno
+		if 'ticker' in df.columns:
+			ticker = df['ticker'].to_numpy(dtype = object)
+			if order is not None:
+				ticker = ticker[order]
+			valid = np.flatnonzero(pd.notna(ticker) & pd.notna(ldate))
+			new_spell = np.ones(len(valid), dtype = bool)
+			new_spell[1:] = (permno[valid][1:] != permno[valid][:-1]) | (ticker[valid][1:] != ticker[valid][:-1])
+			first = valid[new_spell]
+			last = valid[np.append(np.flatnonzero(new_spell)[1:] - 1, len(valid) - 1)] if len(valid) else valid
+			spells = DataFrame({'ticker' : ticker[first], 'permno' : permno[first], 'start' : ldate[first], 'end' : ldate[last]})
+		else:
+			spells = DataFrame(columns = ['ticker', 'permno', 'start', 'end'])
+
+		spells = spells.sort_values(['ticker', 'end', 'start'], kind = 'stable').reset_index(drop = True)
+
+		return cls(order, permnos, starts, ends, ldate, spells)
 
+	def history(self, ticker):
+
+		## All (permno, start, end) spells of a ticker, oldest first
+		tickers = self.spells['ticker'].to_numpy()
+		lo, hi = np.searchsorted(tickers, ticker, 'left'), np.searchsorted(tickers, ticker, 'right')
+
+		return self.spells.iloc[lo:hi]
+
+	def permno(self, ticker, date = None):
+
+		## permno carrying ticker on date; without a date (or if no spell covers it) the latest spell up to date
+		spells = self.history(ticker)
+		if date is not None:
+			date = pd.Timestamp(date)
+			spells = spells[spells['start'] <= date]
+			covering = spells[spells['end'] >= date]
+			if len(covering) > 0:
+				spells = covering
+		if len(spells) == 0:
+			raise Exception('Ticker %s not found%s.' %(ticker, '' if date is None else ' on or before %s' %(date.date())))
+
+		return spells['permno'].iloc[-1]
+
+	def rows(self, permno, start_date = None, end_date = None):
+
+		## Row positions of permno in the original frame, ldate within [start_date, end_date], in date order
+		k = np.searchsorted(self.permnos, permno)
+		if k == len(self.permnos) or self.permnos[k] != permno:
+			return np.array([], dtype = np.int64)
+
+		lo, hi = self.starts[k], self.ends[k]
+		ldates = self.ldates[lo:hi]
+		if start_date is not None:
+			lo = lo + np.searchsorted(ldates, np.datetime64(pd.Timestamp(start_date)), 'left')
+		if end_date is not None:
+			hi = self.starts[k] + np.searchsorted(ldates, np.datetime64(pd.Timestamp(end_date)), 'right')
+
+		return np.arange(lo, hi) if self.order is None else self.order[lo:hi]
+
+	def extract(self, df, permno, start_date = None, end_date = None, columns = None):
+
+		## Time series of one stock: a slice of df (the frame the index was built from)
+		rows = self.rows(permno, start_date, end_date)
+		df_stock = df.iloc[rows] if self.order is not None else df.iloc[rows[0]:rows[-1] + 1] if len(rows) else df.iloc[0:0]
+
+		return df_stock if columns is None else df_stock[columns]
+
+	def matches(self, df, samples = 32):
+
+		## Spot check that df still has the permno and ldate the index recorded, at evenly spaced and at random
+		## positions of the sorted order (an in-place sort or reassigned identifiers move them)
+		n = len(self.ldates)
+		if len(df) != n:
+			return False
+		if n == 0:
+			return True
+		positions = np.unique(np.concatenate([np.linspace(0, n - 1, samples).astype(np.int64), np.random.default_rng().integers(0, n, samples)]))
+		rows = positions if self.order is None else self.order[positions]
+		permnos = self.permnos[np.searchsorted(self.starts, positions, 'right') - 1]
+
+		return bool((df['permno'].to_numpy()[rows] == permnos).all() and (df['ldate'].to_numpy()[rows] == self.ldates[positions]).all())
+
+## Indexes built by identifier_index, keyed by (id, shape) of their panel and dropped once it is garbage collected
+_ID_INDEXES = {}
+
+def identifier_index(df):
+
+	## The IdentifierIndex of df, built on the first call and reused while df lives with the same shape and
+	## still matches it (see IdentifierIndex.matches): an in-place sort or edit of permno / ldate rebuilds it
+	key = (id(df), df.shape)
+	if key not in _ID_INDEXES:
+		weakref.finalize(df, _ID_INDEXES.pop, key, None)
+	if key not in _ID_INDEXES or not _ID_INDEXES[key].matches(df):
+		_ID_INDEXES[key] = IdentifierIndex.from_long(df)
+
+	return _ID_INDEXES[key]
+
+def plot_cumulative_returns_etf(df, var_list, output_file = None):
+
+	## With output_file set the chart is saved there (format from the extension) instead of shown
 	plot_df = df.copy()
 	# plot_df = df.set_index('ym')
 	for var in var_list:
 		plot_df['LN%s' %(var)] = np.log(1 + plot_df['%s' %(var)])
 		plot_df['CLN%s' %(var)] = plot_df['LN%s' %(var)].cumsum()
 
-	fig, ax = plt.subplots(1, 1)
+	fig = _new_figure(output_file is not None)
+	ax = fig.add_subplot()
 	for var in var_list:
 		ax.plot(plot_df.index, plot_df['CLN%s' %(var)], label = var)
-	plt.xlabel('Date'); plt.ylabel('Cumulative Return')
-	plt.legend()
+	ax.set_xlabel('Date'); ax.set_ylabel('Cumulative Return')
+	ax.legend()
 	fig.tight_layout()
-	plt.show()
-	plt.close()
-
-def plot_variables(df, variable_list, permno_list, start_date, end_date):
-
-	df_plot = df[(df['ldate'] >= start_date) & (df['ldate'] <= end_date) & (df['permno'].isin(permno_list))]
-	df_plot = df_plot[variable_list + ['permno', 'ldate']].set_index('ldate')
+	_finish_figure(fig, output_file)
 
-	for variable in variable_list:
-		fig, ax = plt.subplots()
-		for permno in permno_list:
-			plt.plot(df_plot[df_plot['permno'] == permno][variable], label = permno)
-			plt.legend(bbox_to_anchor = [1, 1], loc = 'upper left')
-			plt.title('Variable: %s' %(variable))
-		plt.show()
+def plot_variables(df, variable_list, id_type, id_list, start_date, end_date, output_dir = None, id_index = None):
 
-def plot_variables(df, variable_list, id_type, id_list, start_date, end_date):
+	## Without id_index the index of df is built once and reused by later calls on the same panel (see identifier_index)
+	if id_index is None:
+		id_index = identifier_index(df)
 
 	## Retrieve permno
 	if id_type == 'ticker':
-		permno_list = []
-		for ticker in id_list:
-			sub_df = df[df['ticker'] == ticker]
-			permno = sub_df[['ticker', 'permno', 'ldate']].sort_values(['ldate'], ascending = False).dropna().iloc[0]['permno']
-			permno_list.append(permno)
+		permno_list = [id_index.permno(ticker) for ticker in id_list]
 	elif id_type == 'permno':
 		permno_list = id_list
 	elif id_type != 'permno':
 		raise Exception('Please provide a valid id type: permno or ticker.')
 
-	df_plot = df[(df['ldate'] >= start_date) & (df['ldate'] <= end_date) & (df['permno'].isin(permno_list))]
-	df_plot = df_plot[variable_list + ['permno', 'ticker', 'ldate']].set_index('ldate')
+	## One slice of the panel per stock
+	plot_list = [id_index.extract(df, permno, start_date, end_date, variable_list + ['ldate']).set_index('ldate') for permno in permno_list]
 
+	## With output_dir set each variable's chart is saved to output_dir/<variable>.png instead of shown
+	if output_dir is not None:
+		os.makedirs(output_dir, exist_ok = True)
 
 	for variable in variable_list:
 
-		fig, ax = plt.subplots()
+		fig = _new_figure(output_dir is not None)
+		ax = fig.add_subplot()
 		for i in range(0, len(id_list)):
-			permno = permno_list[i]
 			label = id_list[i]
-			plt.plot(df_plot[df_plot['permno'] == permno][variable], label = label)
-			plt.legend(bbox_to_anchor = [1, 1], loc = 'upper left')
-			plt.title('Variable: %s' %(variable))
-		plt.show()
+			ax.plot(plot_list[i][variable], label = label)
+			ax.legend(bbox_to_anchor = [1, 1], loc = 'upper left')
+			ax.set_title('Variable: %s' %(variable))
+		_finish_figure(fig, os.path.join(output_dir, '%s.png' %(variable)) if output_dir is not None else None)
@@ -0,0 +1,264 @@
+'''
+
+Benchmark suite for the qpm pipeline on synthetic CRSP/Compustat-shaped panels, so that performance
+can be measured (and compared across commits) without WRDS access.
+
+	python qpm_benchmark.py --rows 1000 100000 1000000 --output bench.json
+	python qpm_benchmark.py --compare before.json after.json
+
+'''
+
+#------------------------------------------------#
+#  Import Packages
+
+import pandas as pd
+import numpy as np
+
+import os, io, sys, json, time, tempfile, argparse, platform, contextlib, subprocess
+
+import qpm
+
+DataFrame = pd.DataFrame
+Series = pd.Series
+
+## Stages timed by run_benchmarks, in pipeline order
+BENCHMARKS = ['load_data', 'create_lag', 'select_sample', 'create_portfolios_monthly', 'create_portfolios_june',
+			  'analyze_strategy', 'rolling_betas']
+
+#------------------------------------------------#
+#  Synthetic Panel
+
+def synthetic_factors(num_months, seed = 0, start_date = '1963-07-01'):
+
+	## Monthly Fama-French factors and the CRSP value-weighted market return
+	rng = np.random.default_rng(seed)
+	df_ff = DataFrame({'ldate' : pd.date_range(start_date, periods = num_months, freq = 'MS')})
+	df_ff['rf'] = np.clip(rng.normal(0.003, 0.001, num_months), 0, None)
+	df_ff['mktrf'] = rng.normal(0.006, 0.045, num_months)
+	for factor, mean, vol in [('smb', 0.002, 0.03), ('hml', 0.003, 0.03), ('umd', 0.006, 0.045), ('rmw', 0.003, 0.02), ('cma', 0.003, 0.02)]:
+		df_ff[factor] = rng.normal(mean, vol, num_months)
+	df_ff['vwretd'] = df_ff['mktrf'] + df_ff['rf']
+
+	return df_ff
+
+def synthetic_panel(num_rows = 100000, num_months = None, seed = 0, start_date = '1963-07-01'):
+
+	## Seeded permno x month panel with the columns load_data expects, about num_rows rows (by default over
+	## enough months for roughly 500 stocks a month, at most 600 months):
+	##   - listings start at random months and end with a delisting (last return includes a delisting return)
+	##     or at the end of the sample; about 2% of the months in between are missing
+	##   - exchcd 1/2/3 (NYSE stocks larger on average) and shrcd 10/11/12
+	##   - returns from a one-factor model, market caps compounding with them
+	##   - annual fundamentals (be, at, revt, cogs) that change every July and are sometimes missing
+	##   - monthly factors (rf, mktrf, smb, hml, umd, rmw, cma) and vwretd on every row
+	num_months = num_months or int(np.clip(num_rows // 500, 24, 600))
+	rng = np.random.default_rng(seed)
+	df_ff = synthetic_factors(num_months, seed, start_date)
+
+	#------------------------------------------------#
+	#  Listings
+
+	## Listing start and length; enough permnos to reach num_rows
+	mean_life = max(num_months // 4, 1)
+	sample = np.minimum(rng.geometric(1 / mean_life, 10000), num_months - rng.integers(0, num_months, 10000))
+	num_permno = max(int(np.ceil(num_rows / sample.mean() * 1.05)), 1)
+
+	first = rng.integers(0, num_months, num_permno)
+	life = np.minimum(rng.geometric(1 / mean_life, num_permno), num_months - first)
+	delisted = first + life < num_months
+
+	## Rows: month offsets within each listing, trimmed to num_rows
+	permno_idx = np.repeat(np.arange(num_permno), life)
+	offset = np.arange(len(permno_idx)) - np.repeat(np.cumsum(life) - life, life)
+	month = first[permno_idx] + offset
+	last_row = offset == life[permno_idx] - 1
+
+	## Missing months in the middle of a listing
+	keep = (rng.random(len(month)) > 0.02) | (offset == 0) | last_row
+	permno_idx, month, offset, last_row = permno_idx[keep][:num_rows], month[keep][:num_rows], offset[keep][:num_rows], last_row[keep][:num_rows]
+	n = len(permno_idx)
+
+	#------------------------------------------------#
+	#  Stock Characteristics
+
+	exchcd = rng.choice(np.array([1, 2, 3], dtype = np.int8), num_permno, p = [0.3, 0.1, 0.6])
+	shrcd = rng.choice(np.array([10, 11, 12], dtype = np.int8), num_permno, p = [0.3, 0.68, 0.02])
+	beta = rng.normal(1, 0.3, num_permno)
+	sigma = rng.uniform(0.05, 0.18, num_permno)
+	log_me0 = rng.normal(4 + 1.5 * (exchcd == 1), 1.8)
+
+	df = DataFrame({'permno' : (10000 + permno_idx).astype(np.int64), 'ldate' : df_ff['ldate'].to_numpy()[month]})
+	df['exchcd'] = exchcd[permno_idx].astype(np.int64)
+	df['shrcd'] = shrcd[permno_idx].astype(np.int64)
+
+	ff = df_ff.iloc[month].reset_index(drop = True)
+	ret = ff['rf'].to_numpy() + beta[permno_idx] * ff['mktrf'].to_numpy() + rng.normal(0, 1, n) * sigma[permno_idx]
+	ret = np.maximum(ret, -0.95)
+	dlret = np.where(delisted[permno_idx] & last_row, np.where(rng.random(n) < 0.3, -0.3, rng.normal(0, 0.1, n)), 0.)
+	df['daret'] = (1 + ret) * (1 + dlret) - 1
+	df['retx'] = df['daret'] - 0.002
+
+	## Market cap compounds with price returns within each listing
+	log_growth = np.log1p(np.maximum(df['retx'].to_numpy(), -0.95))
+	cum = np.cumsum(log_growth)
+	start = np.flatnonzero(np.r_[True, permno_idx[1:] != permno_idx[:-1]])
+	cum -= np.repeat(cum[start] - log_growth[start], np.diff(np.r_[start, n]))
+	df['me'] = np.exp(log_me0[permno_idx] + cum)
+	df['prc'] = np.exp(rng.normal(3, 1, num_permno))[permno_idx] * np.exp(cum)
+	df['shrout'] = df['me'] * 1000 / df['prc']
+	df['vol'] = np.exp(rng.normal(8, 1.5, n))
+
+	## Annual fundamentals, fixed from July to June
+	fyear = (month - (6 - pd.Timestamp(start_date).month + 1) % 12) // 12
+	pair, pair_idx = np.unique(permno_idx.astype(np.int64) * (num_months // 12 + 2) + fyear + 1, return_inverse = True)
+	num_pair = len(pair)
+	be = np.exp(log_me0[permno_idx] + cum)[np.unique(pair_idx, return_index = True)[1]] * np.exp(rng.normal(-0.5, 0.8, num_pair))
+	at = be * np.exp(rng.normal(0.8, 0.5, num_pair))
+	revt = at * np.exp(rng.normal(-0.3, 0.5, num_pair))
+	cogs = revt * rng.uniform(0.4, 0.9, num_pair)
+	for name, values in [('be', be), ('at', at), ('revt', revt), ('cogs', cogs)]:
+		values = np.where(rng.random(num_pair) < 0.05, np.nan, values)
+		df[name] = values[pair_idx]
+
+	## Identifiers
+	df['ticker'] = pd.Categorical.from_codes(permno_idx, ['T%05d' %(i) for i in range(num_permno)])
+	df['conm'] = pd.Categorical.from_codes(permno_idx, ['COMPANY %d' %(10000 + i) for i in range(num_permno)])
+
+	for col in ['rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma', 'vwretd']:
+		df[col] = ff[col].to_numpy()
+
+	return df
+
+#------------------------------------------------#
+#  Benchmarks
+
+def _git_commit():
+
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+							  cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+	except OSError:
+		return None
+
+def _peak_rss():
+
+	## Peak resident set size of the process in bytes; None where the resource module is missing (Windows)
+	try:
+		import resource
+	except ImportError:
+		return None
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+def _timed(func, *args):
+
+	## Wall and CPU seconds and peak RSS growth of one call, with its printed output silenced. Only the standard
+	## library is used, so that the harness runs against any commit of qpm, including those before stage/set_quiet.
+	start_rss = _peak_rss()
+	with contextlib.redirect_stdout(io.StringIO()):
+		start_wall, start_cpu = time.perf_counter(), time.process_time()
+		result = func(*args)
+		wall_seconds, cpu_seconds = time.perf_counter() - start_wall, time.process_time() - start_cpu
+	peak_rss = _peak_rss()
+
+	return result, {'wall_seconds' : wall_seconds, 'cpu_seconds' : cpu_seconds,
+					'peak_rss_delta' : max(peak_rss - start_rss, 0) if peak_rss is not None else None}
+
+def run_benchmarks(rows = [1000, 100000], seed = 0, num_months = None, repeat = 1, benchmarks = BENCHMARKS, output = None):
+
+	## Time each benchmark on a synthetic panel of each size (best wall time of repeat runs). Results are
+	## one record per (benchmark, rows) with wall/CPU seconds and peak RSS growth, plus run metadata
+	## (commit, versions, machine) so that files from different commits can be compared with compare_benchmarks.
+	results = []
+	for num_rows in rows:
+
+		df_panel = synthetic_panel(num_rows, num_months, seed)
+		## Sample starts a tenth of the way in, so that lags and the first June sort have history
+		num_panel_months = df_panel['ldate'].nunique()
+		sample_start = df_panel['ldate'].min() + pd.DateOffset(months = max(num_panel_months // 10, 1))
+		sample_end = df_panel['ldate'].max()
+
+		with tempfile.TemporaryDirectory() as data_dir:
+			df_panel.to_parquet(os.path.join(data_dir, 'panel.parquet'))
+
+			## setup builds fresh arguments for every run outside the timed call (e.g. a copy of a frame func modifies)
+			def run(name, func, *args, setup = None):
+				best = None
+				for _ in range(repeat):
+					result, record = _timed(func, *(setup() if setup is not None else args))
+					best = record if best is None or record['wall_seconds'] < best['wall_seconds'] else best
+				if name in benchmarks:
+					results.append({'benchmark' : name, 'rows' : num_rows, 'seed' : seed, 'repeat' : repeat,
+									'wall_seconds' : best['wall_seconds'], 'cpu_seconds' : best['cpu_seconds'],
+									'peak_rss_delta' : best['peak_rss_delta']})
+					print('%-28s %10d rows %9.3f s' %(name, num_rows, best['wall_seconds']))
+				return result
+
+			## Later stages need the earlier ones' output, so they always run; only the selected ones are reported
+			df_full = run('load_data', qpm.load_data, data_dir, 'panel.parquet')
+			df_full['signal'] = run('create_lag', qpm.create_lag, df_full, 'be', 1)
+			df = run('select_sample', qpm.select_sample, df_full, sample_start, sample_end, True)
+			run('create_portfolios_monthly', qpm.create_portfolios, setup = lambda: (df.copy(), 'Monthly', 10))
+			_, df_rets = run('create_portfolios_june', qpm.create_portfolios, setup = lambda: (df.copy(), 'June', 10))
+			## Commits before the factor store read the factors from FFData.parquet in the working directory
+			if 'analyze_strategy' in benchmarks:
+				df_panel.drop_duplicates('ldate')[['ldate', 'rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma']].to_parquet(os.path.join(data_dir, 'FFData.parquet'))
+				cwd = os.getcwd()
+				os.chdir(data_dir)
+				try:
+					run('analyze_strategy', qpm.analyze_strategy, df_rets, 'Factor Regression')
+				finally:
+					os.chdir(cwd)
+
+			## Commits before the database session imported wrds when qpm_download was imported
+			if 'rolling_betas' in benchmarks:
+				try:
+					import qpm_download
+				except ImportError as e:
+					print('%-28s skipped (%s)' %('rolling_betas', e))
+				else:
+					df_betas = df_panel[['permno', 'ldate', 'daret', 'rf', 'vwretd']].rename(columns = {'ldate' : 'ym', 'daret' : 'ret'})
+					run('rolling_betas', qpm_download.rolling_betas, df_betas)
+
+	report = {'meta' : {'commit' : _git_commit(), 'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+						'python' : platform.python_version(), 'pandas' : pd.__version__, 'numpy' : np.__version__,
+						'machine' : platform.machine(), 'processor' : platform.processor(), 'cpu_count' : os.cpu_count()},
+			  'results' : results}
+
+	if output is not None:
+		with open(output, 'w') as f:
+			json.dump(report, f, indent = 1)
+
+	return report
+
+def compare_benchmarks(before, after):
+
+	## Side-by-side wall times of two run_benchmarks results (dicts or json paths); ratio < 1 means faster
+	def results(report):
+		if isinstance(report, str):
+			with open(report) as f:
+				report = json.load(f)
+		return DataFrame(report['results']).set_index(['benchmark', 'rows'])['wall_seconds']
+
+	df_compare = pd.concat([results(before), results(after)], axis = 1, keys = ['before', 'after'])
+	df_compare['ratio'] = df_compare['after'] / df_compare['before']
+
+	return df_compare
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description = 'Benchmark the qpm pipeline on synthetic panels.')
+	parser.add_argument('--rows', type = int, nargs = '+', default = [1000, 100000])
+	parser.add_argument('--months', type = int, default = None)
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--repeat', type = int, default = 1)
+	parser.add_argument('--benchmarks', nargs = '+', default = BENCHMARKS, choices = BENCHMARKS)
+	parser.add_argument('--output', default = None)
+	parser.add_argument('--compare', nargs = 2, metavar = ('BEFORE', 'AFTER'), default = None)
+	args = parser.parse_args()
+
+	if args.compare:
+		print(compare_benchmarks(*args.compare).round(3))
+	else:
+		run_benchmarks(args.rows, args.seed, args.months, args.repeat, args.benchmarks, args.output)
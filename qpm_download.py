@@ -12,20 +12,501 @@ by Ralph S.J. Koijen and Sangmin S. Oh.
 # Import Packages
 import pandas as pd
 import numpy as np
-import wrds
 import statsmodels.api as sm
 from statsmodels.regression.rolling import RollingOLS
 import qpm_download
+import qpm
+import os, re, time, json, glob, hashlib, atexit, threading, functools, concurrent.futures
 
-def cross_section_compact(_SAMPLE_START, _SAMPLE_END, _STRATEGY_NAME, signal_variables):
+###############################################
+## Database Session
+###############################################
+
+# Errors worth retrying: dropped connections, timeouts and server restarts (local OSErrors such as a missing
+# file or a denied permission fail at once)
+_TRANSIENT_ERRORS = (ConnectionError, TimeoutError)
+_TRANSIENT_NAMES = ('OperationalError', 'InterfaceError', 'DisconnectionError')
+_TRANSIENT_MESSAGES = re.compile(r'connect|closed|timeout|timed out|terminat|reset|ssl|broken pipe', re.IGNORECASE)
+
+def _transient(e):
+    
+    # OperationalError also covers bad SQL on some drivers, so the message must point at the connection
+    return isinstance(e, _TRANSIENT_ERRORS) or (type(e).__name__ in _TRANSIENT_NAMES and bool(_TRANSIENT_MESSAGES.search(str(e))))
+
+def _nulls_as_float(df):
+    
+    # A chunk can hold no value of a column (e.g. no delisting return in a year), which pandas reads as object;
+    # make such columns float, as they are when values are present
+    return df.astype({x : float for x in df.columns if df[x].dtype == object and df[x].isna().all()})
+
+class Session:
+    
+    # One database connection shared by every download function.
+    # With no engine, a wrds.Connection is opened on the first query (one login per process) and queries
+    # run on its SQLAlchemy engine, whose pool hands out connections. engine can instead be any SQLAlchemy
+    # engine or DB-API connection (e.g. a local PostgreSQL or duckdb.connect()), so that a stand-in
+    # database can replace WRDS. Transient failures are retried with exponential backoff, after dropping
+    # the pooled connections of the engine that failed (see _reset).
+    
+    def __init__(self, engine = None, retries = 3, backoff = 1.0):
+        
+        self.engine = engine
+        self.retries = retries
+        self.backoff = backoff
+        self._owned = engine is None
+        self._wrds = None
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        
+        with self._lock:
+            if self.engine is None:
+                import wrds
+                self._wrds = wrds.Connection()
+                self.engine = getattr(self._wrds, 'engine', self._wrds)
+        
+        return self.engine
+    
+    def _read(self, engine, sql_statement, chunksize = None):
+        
+        # SQLAlchemy engine: pandas checks a connection out of the pool. With chunksize, rows come through a
+        # server-side cursor chunksize at a time instead of being buffered whole by the driver first
+        if hasattr(engine, 'dialect'):
+            if chunksize is None:
+                return pd.read_sql_query(sql_statement, engine)
+            with engine.connect().execution_options(stream_results = True) as connection:
+                chunks = pd.read_sql_query(sql_statement, connection, chunksize = chunksize)
+                return pd.concat([_nulls_as_float(x) for x in chunks], ignore_index = True)
+        
+        # wrds.Connection without an engine attribute
+        if hasattr(engine, 'raw_sql'):
+            with self._lock:
+                return engine.raw_sql(sql_statement) if chunksize is None else engine.raw_sql(sql_statement, chunksize = chunksize)
+        
+        # DB-API connection: connections are not shared across threads, so queries take turns
+        with self._lock:
+            cursor = engine.cursor()
+            try:
+                cursor.execute(sql_statement)
+                columns = [x[0] for x in cursor.description]
+                if chunksize is None:
+                    return pd.DataFrame.from_records(cursor.fetchall(), columns = columns)
+                chunks = []
+                rows = cursor.fetchmany(chunksize)
+                while rows:
+                    chunks.append(_nulls_as_float(pd.DataFrame.from_records(rows, columns = columns)))
+                    rows = cursor.fetchmany(chunksize)
+                return pd.concat(chunks, ignore_index = True) if chunks else pd.DataFrame(columns = columns)
+            finally:
+                cursor.close()
+    
+    @property
+    def source(self):
+        
+        # Which database the queries go to, part of the query cache key so that results of WRDS and of a stand-in
+        # database never answer for each other: 'wrds' for the connection the session opens, the URL (without
+        # password) of an engine, the DSN of a DB-API connection, or the object itself for an in-memory database
+        if self._owned:
+            return 'wrds'
+        url = getattr(self.engine, 'url', None)
+        if url is not None and getattr(url, 'database', None) not in (None, '', ':memory:'):
+            return url.render_as_string(hide_password = True) if hasattr(url, 'render_as_string') else str(url)
+        dsn = getattr(self.engine, 'dsn', None)
+        if isinstance(dsn, str):
+            return dsn
+        return '%s.%s@%x' %(type(self.engine).__module__, type(self.engine).__name__, id(self.engine))
+    
+    def _reset(self, engine):
+        
+        # Queries on other threads share the engine, so it is not closed: its pool drops its idle connections
+        # and opens new ones on the next checkout, while connections in use finish their queries. A wrds.Connection
+        # without an engine is reopened, unless another thread already did so after the same failure
+        with self._lock:
+            if self.engine is not engine:
+                return
+            if hasattr(engine, 'dispose'):
+                engine.dispose()
+            elif self._owned and self._wrds is not None:
+                self._wrds.close()
+                self._wrds, self.engine = None, None
+    
+    def raw_sql(self, sql_statement, chunksize = None):
+        
+        for attempt in range(self.retries + 1):
+            engine = self.engine if self.engine is not None else self._connect()
+            try:
+                return self._read(engine, sql_statement, chunksize)
+            except Exception as e:
+                if not _transient(e) or attempt == self.retries:
+                    raise
+                qpm.log('Query failed (%s), retrying in %g s...' %(type(e).__name__, self.backoff * 2**attempt))
+                time.sleep(self.backoff * 2**attempt)
+                self._reset(engine)
+    
+    def close(self):
+        
+        # Close what the session opened; engines passed in belong to the caller
+        with self._lock:
+            if self._owned and self._wrds is not None:
+                self._wrds.close()
+                self._wrds, self.engine = None, None
+    
+    def __enter__(self):
+        
+        return self
+    
+    def __exit__(self, *args):
+        
+        self.close()
+
+_SESSION = None
+
+def get_session():
+    
+    # The process-wide session, created (but not yet connected) on first use
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = Session()
+    
+    return _SESSION
+
+def set_session(engine = None, retries = 3, backoff = 1.0):
+    
+    # Use engine (a Session, SQLAlchemy engine or DB-API connection) for every download function;
+    # set_session() goes back to a lazily opened WRDS connection
+    global _SESSION
+    close_session()
+    _SESSION = engine if isinstance(engine, Session) else Session(engine, retries, backoff)
+    
+    return _SESSION
+
+def close_session():
+    
+    if _SESSION is not None:
+        _SESSION.close()
+
+atexit.register(close_session)
+
+###############################################
+## Query Cache
+###############################################
+
+# Results of queries on reference tables that barely change are kept as parquet files in _QUERY_CACHE_DIR, keyed
+# by the normalized SQL text (which holds the date window) and the database it ran on (Session.source), and reused
+# until they are older than the TTL of the tables they read. Queries touching a table without a TTL (e.g. crsp_m_stock.msf) always go to the database.
+_QUERY_CACHE_VERSION = 1
+_QUERY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'qpm', 'queries')
+_DAY = 24 * 3600
+_QUERY_CACHE_TTL = {'ff.fivefactors_monthly' : 7 * _DAY, 'ff.fivefactors_daily' : 7 * _DAY, 'crsp_m_stock.msi' : 7 * _DAY,
+                    'comp.names' : 7 * _DAY, 'crsp.ccmxpf_lnkhist' : 7 * _DAY, 'trucost.wrds_companies' : 7 * _DAY,
+                    'trucost.wrds_esg' : 7 * _DAY, 'trucost.wrds_environment' : 7 * _DAY}
+_QUERY_CACHE_REFRESH = False
+
+# Hits, misses and uncached queries per table (the first table of the query) in this process
+_QUERY_CACHE_STATS = {}
+_QUERY_CACHE_LOCK = threading.Lock()
+
+def set_query_cache(cache_dir = _QUERY_CACHE_DIR, ttl = {}, refresh = False):
+    
+    # cache_dir = None turns the cache off. ttl updates the TTLs in seconds by table (0 stops caching a table, e.g.
+    # {'comp.funda' : 86400} caches Compustat for a day). refresh = True sends every query to the database again
+    # and stores the new results, until set_query_cache is called without it
+    global _QUERY_CACHE_DIR, _QUERY_CACHE_REFRESH
+    _QUERY_CACHE_DIR, _QUERY_CACHE_REFRESH = cache_dir, refresh
+    _QUERY_CACHE_TTL.update({x.lower() : y for x, y in ttl.items()})
+
+def _normalize_sql(sql_statement):
+    
+    return ' '.join(sql_statement.split()).rstrip(';')
+
+def _query_tables(sql_statement):
+    
+    return [x.lower() for x in re.findall(r'(?:FROM|JOIN)\s+([\w.]+)', sql_statement, re.IGNORECASE)]
+
+def _query_ttl(sql_statement):
+    
+    # The shortest TTL of the tables in the query; None when one of them is not cached
+    ttl = [_QUERY_CACHE_TTL.get(x, 0) for x in _query_tables(sql_statement)]
+    
+    return min(ttl) if ttl and min(ttl) > 0 else None
+
+def _query_cache_file(sql_statement, source):
+    
+    payload = json.dumps([_normalize_sql(sql_statement), source, _QUERY_CACHE_VERSION])
+    
+    return os.path.join(_QUERY_CACHE_DIR, '%s.parquet' %(hashlib.sha256(payload.encode()).hexdigest()[:32]))
+
+def _count(table, outcome):
+    
+    with _QUERY_CACHE_LOCK:
+        counts = _QUERY_CACHE_STATS.setdefault(table, {'hits' : 0, 'misses' : 0, 'uncached' : 0})
+        counts[outcome] += 1
+
+def _read_query_cache(sql_statement, table, source):
+    
+    # The cached result, or None (and the query is counted as a miss or as uncached)
+    ttl = _query_ttl(sql_statement) if _QUERY_CACHE_DIR is not None else None
+    if ttl is None:
+        _count(table, 'uncached')
+        return None
+    
+    cache_file = _query_cache_file(sql_statement, source)
+    if _QUERY_CACHE_REFRESH or not os.path.exists(cache_file) or time.time() - os.path.getmtime(cache_file) > ttl:
+        _count(table, 'misses')
+        return None
+    
+    _count(table, 'hits')
+    return pd.read_parquet(cache_file)
+
+def _write_query_cache(sql_statement, df, source):
+    
+    if _QUERY_CACHE_DIR is None or _query_ttl(sql_statement) is None:
+        return
+    
+    # Write to a temporary file first so that a crash (or another thread) never leaves a truncated entry behind
+    os.makedirs(_QUERY_CACHE_DIR, exist_ok = True)
+    cache_file = _query_cache_file(sql_statement, source)
+    temp_file = '%s.%d.%d.tmp' %(cache_file, os.getpid(), threading.get_ident())
+    df.to_parquet(temp_file, index = False)
+    os.replace(temp_file, cache_file)
+    with open(cache_file.replace('.parquet', '.json'), 'w') as f:
+        json.dump({'query' : _normalize_sql(sql_statement), 'tables' : _query_tables(sql_statement), 'source' : source,
+                   'created' : pd.Timestamp.now().isoformat()}, f)
+
+def query_cache_stats():
     
-    # Establish connection with wrds
-    db = wrds.Connection()
+    # Hits, misses and uncached queries by table since the process started (or reset_query_cache_stats)
+    df_stats = pd.DataFrame.from_dict(_QUERY_CACHE_STATS, orient = 'index', columns = ['hits', 'misses', 'uncached'])
+    df_stats.index.name = 'table'
+    
+    return df_stats
+
+def reset_query_cache_stats():
+    
+    _QUERY_CACHE_STATS.clear()
+
+def clear_query_cache(table = None):
+    
+    # Remove every cached result, or only those of queries reading table
+    if _QUERY_CACHE_DIR is None:
+        return
+    
+    for cache_file in glob.glob(os.path.join(_QUERY_CACHE_DIR, '*.parquet')):
+        meta_file = cache_file.replace('.parquet', '.json')
+        if table is not None:
+            if not os.path.exists(meta_file):
+                continue
+            with open(meta_file) as f:
+                if table.lower() not in json.load(f)['tables']:
+                    continue
+        for x in [cache_file, meta_file]:
+            if os.path.exists(x):
+                os.remove(x)
+
+def _query(db, sql_statement, chunksize = None):
+    
+    # Run a query through wrds (or take it from the query cache) and record it as a stage (time, memory, rows
+    # returned and whether the cache answered, see qpm.stage_report)
+    table = re.search(r'FROM\s+(\S+)', sql_statement, re.IGNORECASE)
+    table = table.group(1) if table else 'query'
+    with qpm.stage('sql: %s' %(table), query = _normalize_sql(sql_statement)) as record:
+        df = _read_query_cache(sql_statement, table.lower(), db.source)
+        record['cache_hit'] = df is not None
+        if df is None:
+            df = db.raw_sql(sql_statement) if chunksize is None else db.raw_sql(sql_statement, chunksize)
+            _write_query_cache(sql_statement, df, db.source)
+        record['rows_out'] = len(df)
+    
+    return df
+
+###############################################
+## Concurrent Queries
+###############################################
+
+# At most this many queries in flight at once (set_max_workers(1) sends them one at a time)
+_MAX_WORKERS = 4
+_POOL = None
+
+# Futures submitted by the download function running on each thread (see _cancel_on_error)
+_SUBMITTED = threading.local()
+
+def set_max_workers(max_workers):
+    
+    global _MAX_WORKERS, _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait = True)
+    _MAX_WORKERS, _POOL = max_workers, None
+
+def _submit(db, sql_statement, chunksize = None):
+    
+    # Run _query on the shared thread pool and return its future: .result() waits for the data (or re-raises
+    # the query's error). The calling thread keeps cleaning earlier results while later queries are on the network
+    global _POOL
+    if _POOL is None:
+        _POOL = concurrent.futures.ThreadPoolExecutor(max_workers = _MAX_WORKERS, thread_name_prefix = 'qpm_download')
+    
+    depth = qpm.stage_depth()
+    def task():
+        qpm.set_stage_depth(depth)
+        return _query(db, sql_statement, chunksize)
+    
+    future = _POOL.submit(task)
+    if getattr(_SUBMITTED, 'futures', None) is not None:
+        _SUBMITTED.futures.append(future)
+    
+    return future
+
+def _cancel_on_error(func):
+    
+    # When a download function fails, its queries that have not started are cancelled and those already on
+    # the database are waited for, so that none keeps running for a result nobody reads
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer, _SUBMITTED.futures = getattr(_SUBMITTED, 'futures', None), []
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            for future in _SUBMITTED.futures:
+                future.cancel()
+            concurrent.futures.wait(_SUBMITTED.futures)
+            raise
+        finally:
+            _SUBMITTED.futures = outer
+    
+    return wrapper
+
+###############################################
+## Streaming Downloads
+###############################################
+
+# With output_dir, the large query of a download function (CRSP monthly or daily returns) is sent one window
+# of chunk_years at a time, fetched _CHUNKSIZE rows at a time, and each window is cleaned and written to
+# output_dir/year=YYYY/ (see qpm.write_partitions) before the next one is read. The function then returns
+# output_dir, which qpm.load_data reads with partition pruning. The next window's query is sent while the
+# current one is cleaned. The years already in output_dir are removed when the first window is written (see
+# qpm.clear_partitions), unless the download is incremental.
+_CHUNKSIZE = 100000
+
+def _windows(_SAMPLE_START, _SAMPLE_END, years = None):
+    
+    # Split the sample at calendar years into windows of `years` years; one window when years is None
+    if years is None:
+        return [(_SAMPLE_START, _SAMPLE_END)]
+    
+    start, end = pd.Timestamp(_SAMPLE_START), pd.Timestamp(_SAMPLE_END)
+    windows = []
+    while start <= end:
+        window_end = min(pd.Timestamp(start.year + years - 1, 12, 31), end)
+        windows.append((start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+        start = pd.Timestamp(start.year + years, 1, 1)
+    
+    return windows
+
+def _window_betas(df, df_history):
+    
+    # rolling_betas for one window: the regression looks back 60 months, so the last 59 returns of each stock in
+    # earlier windows are prepended. Returns df with betas and the history to pass to the next window
+    columns = ['permno', 'ym', 'ret', 'rf', 'vwretd']
+    df_returns = df[columns] if df_history is None else pd.concat([df_history, df[columns]], ignore_index = True)
+    df_returns = rolling_betas(df_returns.copy())
+    df = pd.merge(df, df_returns[['permno', 'ym', 'beta']], on = ['permno', 'ym'], how = 'left', validate = '1:1')[list(df.columns) + ['beta']]
+    
+    return df, df_returns.groupby('permno').tail(59)[columns]
+
+def _window_lags(df, df_last):
+    
+    # The first month of each stock in a window has nothing to lag within the window: take ldate_lag, screen and
+    # me_lagged from its last month in earlier windows (df_last, with permno, ldate and me). df is sorted by permno
+    # and ldate and is updated in place; returns the last months to pass to the next window
+    first = ~df['permno'].duplicated()
+    if df_last is not None:
+        df_previous = pd.merge(df.loc[first, ['permno', 'ldate']], df_last, on = 'permno', how = 'left', suffixes = ('', '_lag'))
+        screen = (df_previous['ldate_lag'] == df_previous['ldate'] - pd.DateOffset(months=1)).astype(int).replace(0, np.nan)
+        df.loc[first, 'ldate_lag'] = df_previous['ldate_lag'].values
+        df.loc[first, 'screen'] = screen.values
+        df.loc[first, 'me_lagged'] = (df_previous['me'] * screen).values
+    
+    df_window = df.groupby('permno').tail(1)[['permno', 'ldate', 'me']]
+    
+    return df_window if df_last is None else pd.concat([df_last, df_window], ignore_index = True).groupby('permno').tail(1)
+
+def _sample_factors(df_FF, _SAMPLE_START, _SAMPLE_END):
+    
+    # Monthly factors of the sample on ldate, as load_data registers them
+    df_FF = df_FF[(df_FF['ym'] >= pd.Period(_SAMPLE_START, freq='M')) & (df_FF['ym'] <= pd.Period(_SAMPLE_END, freq='M'))]
+    
+    return df_FF.assign(ldate = df_FF['ym'].dt.to_timestamp())
+
+###############################################
+## Incremental Downloads
+###############################################
+
+# With incremental = True, cross_section and cross_section_compact continue the dataset that a streaming download
+# wrote to output_dir. Only the CRSP months after its last month (the watermark) are downloaded, with the Compustat
+# filings that can still reach them (6-month reporting lag, then carried 12 months) and, for Trucost, each
+# institution's records from its last one before the new months. Betas and lagged market cap continue from the
+# history in the dataset, and the new months are appended to its partitions.
+
+def _watermark(output_dir):
+    
+    # Last month in the dataset, or None when there is no dataset yet
+    if not os.path.isdir(output_dir):
+        return None
+    partitions = qpm.catalog(*os.path.split(os.path.abspath(output_dir)))['partitions']
+    if not partitions:
+        return None
+    
+    return qpm.read_dataset(output_dir, columns = ['ldate'], start_date = '%d-01-01' %(partitions[-1]))['ldate'].max()
+
+def _increment(output_dir, _SAMPLE_START, _SAMPLE_END):
+    
+    # First day of the new CRSP months (None when the dataset is up to date) and of the Compustat filings to
+    # download, and the history _window_betas and _window_lags continue from
+    watermark = _watermark(output_dir)
+    if watermark is None:
+        raise Exception('No dataset in %s to update. Download it once with output_dir and incremental = False.' %(output_dir))
+    
+    new_month = watermark.to_period('M') + 1
+    crsp_start = max(pd.Timestamp(_SAMPLE_START), new_month.to_timestamp())
+    funda_start = max(pd.Timestamp(_SAMPLE_START), (new_month - 17).to_timestamp())
+    if crsp_start > pd.Timestamp(_SAMPLE_END):
+        return None, None, None, None
+    
+    # Only a few columns of the history are read: each stock's last 59 returns (betas look back 60 months)
+    # and its last market cap
+    df = qpm.read_dataset(output_dir, columns = ['permno', 'ldate', 'daret', 'rf', 'vwretd', 'me'])
+    df = df.sort_values(by = ['permno', 'ldate'])
+    df['ym'] = pd.PeriodIndex(df['ldate'], freq='M')
+    df_history = df.rename(columns = {'daret' : 'ret'})[['permno', 'ym', 'ret', 'rf', 'vwretd']].groupby('permno').tail(59)
+    df_last = df[['permno', 'ldate', 'me']].groupby('permno').tail(1)
+    
+    return crsp_start.strftime('%Y-%m-%d'), funda_start.strftime('%Y-%m-%d'), df_history, df_last
+
+@_cancel_on_error
+def cross_section_compact(_SAMPLE_START, _SAMPLE_END, _STRATEGY_NAME, signal_variables, compact = False, float32 = False,
+                          output_dir = None, chunk_years = 1, incremental = False):
+    
+    # With output_dir, CRSP returns are downloaded chunk_years at a time and written to output_dir (see Streaming Downloads)
+    # With incremental = True, only the months after those already in output_dir are downloaded (see Incremental Downloads)
+    crsp_start, funda_start, df_history, df_last = _SAMPLE_START, _SAMPLE_START, None, None
+    if incremental:
+        if output_dir is None:
+            raise Exception('Incremental downloads continue the dataset in output_dir.')
+        crsp_start, funda_start, df_history, df_last = _increment(output_dir, _SAMPLE_START, _SAMPLE_END)
+        if crsp_start is None:
+            qpm.log('> %s is up to date' %(output_dir))
+            return output_dir
+    
+    # Shared connection with wrds (see get_session)
+    db = get_session()
     
     ###############################################
-    ## Step 1. Import Fundamentals from Compustat
+    ## Submit Queries
     ###############################################
-    print('Step 1. Import Fundamentals from Compustat')
+    
+    # No query depends on another's result: all of them are sent now, run concurrently on the
+    # shared pool (see _submit), and each step below waits only for the results it needs
+    queries = {}
     
     # Create list of variables to download
     variables_string = ', '.join(f'a.{vvv}' for vvv in signal_variables)
@@ -36,26 +517,18 @@ def cross_section_compact(_SAMPLE_START, _SAMPLE_END, _STRATEGY_NAME, signal_var
         SELECT a.gvkey, a.datadate, a.at, a.ni, a.prcc_c, {variables_string}
         FROM COMP.FUNDA as a
         WHERE a.consol = 'C' AND a.popsrc = 'D' AND a.datafmt = 'STD' AND a.curcd = 'USD'
-        AND a.indfmt = 'INDL' AND a.datadate >= '{_SAMPLE_START}' AND a.datadate <= '{_SAMPLE_END}'
+        AND a.indfmt = 'INDL' AND a.datadate >= '{funda_start}' AND a.datadate <= '{_SAMPLE_END}'
         """
     else:
         sql_statement = f"""
         SELECT a.gvkey, a.datadate, a.at, a.ni, a.prcc_c
         FROM COMP.FUNDA as a
         WHERE a.consol = 'C' AND a.popsrc = 'D' AND a.datafmt = 'STD' AND a.curcd = 'USD'
-        AND a.indfmt = 'INDL' AND a.datadate >= '{_SAMPLE_START}' AND a.datadate <= '{_SAMPLE_END}'
+        AND a.indfmt = 'INDL' AND a.datadate >= '{funda_start}' AND a.datadate <= '{_SAMPLE_END}'
         """
     
-    # Perform the query
-    df_Compustat = db.raw_sql(sql_statement)
-    
-    # Require minimum information
-    df_Compustat = df_Compustat[(df_Compustat['at'].notna()) & 
-                                (df_Compustat['ni'].notna()) & 
-                                (df_Compustat['prcc_c'].notna())]
-    df_Compustat.drop(['ni', 'prcc_c'],axis=1, inplace=True)
-    if (_STRATEGY_NAME != 'AssetGrowth') & (_STRATEGY_NAME != 'Quality'):
-        df_Compustat.drop('at', axis=1, inplace=True)
+    # Send the query
+    queries['Compustat'] = _submit(db, sql_statement)
     
     # Define your SQL statement for link dataset
     sql_statement = """
@@ -68,8 +541,62 @@ def cross_section_compact(_SAMPLE_START, _SAMPLE_END, _STRATEGY_NAME, signal_var
     ORDER BY a.gvkey
     """
     
-    # Perform the query
-    df_Link = db.raw_sql(sql_statement)
+    # Send the query
+    queries['Link'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for monthly data
+    sql_CRSP = """
+    SELECT a.permno, b.ticker, a.date, a.ret, a.vol, 
+           a.shrout, a.prc, b.shrcd, b.exchcd, c.dlstcd, c.dlret
+    FROM crsp_m_stock.msf as a
+    LEFT JOIN crsp_m_stock.msenames as b
+    ON a.permno=b.permno AND b.namedt<=a.date AND a.date<=b.nameendt
+    LEFT JOIN crsp_m_stock.msedelist as c
+    ON a.permno=c.permno AND date_trunc('month', a.date) = date_trunc('month', c.dlstdt)
+    WHERE a.date >= '{}' AND a.date <= '{}'
+    """
+    
+    # Send the query (for the first window of months when streaming, see _windows)
+    windows = _windows(crsp_start, _SAMPLE_END, chunk_years if output_dir is not None else None)
+    chunksize = _CHUNKSIZE if output_dir is not None else None
+    queries['CRSP'] = _submit(db, sql_CRSP.format(*windows[0]), chunksize)
+    
+    # Define your SQL statement for Fama-French factors
+    sql_statement = """
+    SELECT date, mktrf, smb, hml, rf, umd, rmw, cma
+    FROM ff.fivefactors_monthly
+    """
+    
+    # Send the query
+    queries['FF'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for Market returns from CRSP
+    sql_statement = """
+    SELECT date, vwretd
+    FROM crsp_m_stock.msi
+    """
+    
+    # Send the query
+    queries['Mkt'] = _submit(db, sql_statement)
+    
+    ###############################################
+    ## Step 1. Import Fundamentals from Compustat
+    ###############################################
+    qpm.step('Step 1. Import Fundamentals from Compustat', 'cross_section_compact')
+    
+    # Wait for the query (see Submit Queries)
+    df_Compustat = queries['Compustat'].result()
+    
+    # Require minimum information
+    df_Compustat = df_Compustat[(df_Compustat['at'].notna()) & 
+                                (df_Compustat['ni'].notna()) & 
+                                (df_Compustat['prcc_c'].notna())]
+    df_Compustat.drop(['ni', 'prcc_c'],axis=1, inplace=True)
+    if (_STRATEGY_NAME != 'AssetGrowth') & (_STRATEGY_NAME != 'Quality'):
+        df_Compustat.drop('at', axis=1, inplace=True)
+    
+    # Wait for the query (see Submit Queries)
+    df_Link = queries['Link'].result()
     
     # Rename variables
     df_Link = df_Link.rename(columns={'lpermno':'permno','linkdt':'StartDate','linkenddt':'EndDate'})
@@ -83,11 +610,11 @@ def cross_section_compact(_SAMPLE_START, _SAMPLE_END, _STRATEGY_NAME, signal_var
     # Merge
     df_Compustat = pd.merge(df_Compustat, df_Link, on='gvkey', how='inner')
     
-    print('Done')
+    qpm.step_done()
     ###############################################
     ## Step 2. Adjust Fundamentals from Compustat
     ###############################################
-    print('Step 2. Adjust Fundamentals from Compustat')
+    qpm.step('Step 2. Adjust Fundamentals from Compustat', 'cross_section_compact')
     
     # Restrict to observations with valid date
     df_Compustat = df_Compustat[(df_Compustat['StartDate'] <= df_Compustat['datadate']) & 
@@ -119,142 +646,169 @@ def cross_section_compact(_SAMPLE_START, _SAMPLE_END, _STRATEGY_NAME, signal_var
     df_Compustat = df_Compustat.groupby(['permno','ym']).last().reset_index()
     df_Compustat.drop('datadate', axis=1, inplace=True)
     
-    print('Done')
+    qpm.step_done()
     ###############################################
-    ## Step 3. Import Returns and Factors
+    ## Step 3. Import Factors
     ###############################################
-    print('Step 3. Import Returns and Factors')
-    
-    # Define your SQL statement for monthly data
-    sql_statement = """
-    SELECT a.permno, b.ticker, a.date, a.ret, a.vol, 
-           a.shrout, a.prc, b.shrcd, b.exchcd, c.dlstcd, c.dlret
-    FROM crsp_m_stock.msf as a
-    LEFT JOIN crsp_m_stock.msenames as b
-    ON a.permno=b.permno AND b.namedt<=a.date AND a.date<=b.nameendt
-    LEFT JOIN crsp_m_stock.msedelist as c
-    ON a.permno=c.permno AND date_trunc('month', a.date) = date_trunc('month', c.dlstdt)
-    WHERE a.date >= '{}' AND a.date <= '{}'
-    """
-    
-    # Perform the query
-    df_CRSP = db.raw_sql(sql_statement.format(_SAMPLE_START, _SAMPLE_END))
-    
-    # Reformat date
-    df_CRSP['date'] = pd.to_datetime(df_CRSP['date'])
-    df_CRSP['ym'] = pd.PeriodIndex(df_CRSP.date, freq='M')
-    df_CRSP = df_CRSP.drop('date', axis=1).reset_index(drop=True)
-    
-    # Adjust returns for delisting
-    df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & ( (df_CRSP['exchcd']==1) | (df_CRSP['exchcd']==2) ), 'dlret'] = -0.35
-    df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & (df_CRSP['exchcd']==3), 'dlret'] = -0.55
-    df_CRSP.loc[df_CRSP['dlret']<-1, 'dlret'] = -1.0
-    df_CRSP.loc[df_CRSP['dlret'].isna(), 'dlret'] = 0.0
-    df_CRSP['ret'] = df_CRSP['ret'] + df_CRSP['dlret']
-    df_CRSP.loc[(df_CRSP['ret'].isna()) & (df_CRSP['dlret']!=0.0), 'ret'] = df_CRSP['dlret']
-    df_CRSP.drop(['dlret','dlstcd'], axis=1, inplace=True)
-    
-    # Convert units and construct market cap
-    df_CRSP['shrout'] = df_CRSP['shrout']/1000
-    df_CRSP['vol'] = df_CRSP['vol']/10000
-    df_CRSP['me'] = df_CRSP['shrout']*abs(df_CRSP['prc'])
-    
-    # Retain only common shares traded on NASDAQ, NYSE and AMEX
-    df_CRSP = df_CRSP[( (df_CRSP['shrcd'] == 10) | (df_CRSP['shrcd'] == 11) | (df_CRSP['shrcd'] == 12) ) & 
-                      ( (df_CRSP['exchcd'] == 1) | (df_CRSP['exchcd'] == 2) | (df_CRSP['exchcd'] == 3) )]
-    
-    # Define your SQL statement for Fama-French factors
-    sql_statement = """
-    SELECT date, mktrf, smb, hml, rf, umd, rmw, cma
-    FROM ff.fivefactors_monthly
-    """
+    qpm.step('Step 3. Import Factors', 'cross_section_compact')
     
-    # Perform the query
-    df_FF = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_FF = queries['FF'].result()
     
     # Reformat date
     df_FF['date'] = pd.to_datetime(df_FF['date'])
     df_FF['ym'] = pd.PeriodIndex(df_FF.date, freq='M')
     df_FF.drop('date', axis=1, inplace=True)
     
-    # Define your SQL statement for Market returns from CRSP
-    sql_statement = """
-    SELECT date, vwretd
-    FROM crsp_m_stock.msi
-    """
-    
-    # Perform the query
-    df_Mkt = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_Mkt = queries['Mkt'].result()
     
     # Reformat date
     df_Mkt['date'] = pd.to_datetime(df_Mkt['date'])
     df_Mkt['ym'] = pd.PeriodIndex(df_Mkt.date, freq='M')
     df_Mkt.drop('date', axis=1, inplace=True)
     
-    print('Done')
-    ###############################################
-    ## Step 4. Merge Datasets
-    ###############################################
-    print('Step 4. Merge Datasets')
+    qpm.step_done()
     
-    # Merge CRSP and Compustat
-    df_full = pd.merge(df_CRSP, df_Compustat, on=['permno','ym'], how='inner', validate='1:1')
+    # Steps 4 to 7 run once per window of months: the whole sample, or chunk_years at a time when streaming to
+    # output_dir. Earlier windows pass on what the next one needs (see _window_betas and _window_lags).
+    for i, (window_start, window_end) in enumerate(windows):
+        
+        ###############################################
+        ## Step 4. Import Returns
+        ###############################################
+        qpm.step('Step 4. Import Returns (%s to %s)' %(window_start, window_end), 'cross_section_compact')
+        
+        # Wait for the query and send the one for the next window
+        df_CRSP = queries.pop('CRSP').result()
+        if i + 1 < len(windows):
+            queries['CRSP'] = _submit(db, sql_CRSP.format(*windows[i + 1]), chunksize)
+        
+        # Reformat date
+        df_CRSP['date'] = pd.to_datetime(df_CRSP['date'])
+        df_CRSP['ym'] = pd.PeriodIndex(df_CRSP.date, freq='M')
+        df_CRSP = df_CRSP.drop('date', axis=1).reset_index(drop=True)
+        
+        # Adjust returns for delisting
+        df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & ( (df_CRSP['exchcd']==1) | (df_CRSP['exchcd']==2) ), 'dlret'] = -0.35
+        df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & (df_CRSP['exchcd']==3), 'dlret'] = -0.55
+        df_CRSP.loc[df_CRSP['dlret']<-1, 'dlret'] = -1.0
+        df_CRSP.loc[df_CRSP['dlret'].isna(), 'dlret'] = 0.0
+        df_CRSP['ret'] = df_CRSP['ret'] + df_CRSP['dlret']
+        df_CRSP.loc[(df_CRSP['ret'].isna()) & (df_CRSP['dlret']!=0.0), 'ret'] = df_CRSP['dlret']
+        df_CRSP.drop(['dlret','dlstcd'], axis=1, inplace=True)
+        
+        # Convert units and construct market cap
+        df_CRSP['shrout'] = df_CRSP['shrout']/1000
+        df_CRSP['vol'] = df_CRSP['vol']/10000
+        df_CRSP['me'] = df_CRSP['shrout']*abs(df_CRSP['prc'])
+        
+        # Retain only common shares traded on NASDAQ, NYSE and AMEX
+        df_CRSP = df_CRSP[( (df_CRSP['shrcd'] == 10) | (df_CRSP['shrcd'] == 11) | (df_CRSP['shrcd'] == 12) ) & 
+                          ( (df_CRSP['exchcd'] == 1) | (df_CRSP['exchcd'] == 2) | (df_CRSP['exchcd'] == 3) )]
+        
+        qpm.step_done()
+        ###############################################
+        ## Step 5. Merge Datasets
+        ###############################################
+        qpm.step('Step 5. Merge Datasets', 'cross_section_compact')
+        
+        # Merge CRSP and Compustat
+        df_full = pd.merge(df_CRSP, df_Compustat, on=['permno','ym'], how='inner', validate='1:1')
 
-    # Merge master dataset with factors
-    df_full = pd.merge(df_full, df_FF, on='ym', how='inner', validate='m:1')
-    df_full = pd.merge(df_full, df_Mkt, on='ym', how='inner', validate='m:1')
-    
-    print('Done')
-    ###############################################
-    ## Step 5. Compute Rolling Beta if Necessary and Last Edits
-    ###############################################
-    print('Step 5. Compute Rolling Beta and Last Edits')
-    
-    if _STRATEGY_NAME == 'Quality':
-        df_full = qpm_download.rolling_betas(df_full)
+        # Merge master dataset with factors
+        df_full = pd.merge(df_full, df_FF, on='ym', how='inner', validate='m:1')
+        df_full = pd.merge(df_full, df_Mkt, on='ym', how='inner', validate='m:1')
+        
+        qpm.step_done()
+        ###############################################
+        ## Step 6. Compute Rolling Beta if Necessary and Last Edits
+        ###############################################
+        qpm.step('Step 6. Compute Rolling Beta and Last Edits', 'cross_section_compact')
+        
+        if _STRATEGY_NAME == 'Quality' and output_dir is None:
+            df_full = qpm_download.rolling_betas(df_full)
+        elif _STRATEGY_NAME == 'Quality':
+            df_full, df_history = _window_betas(df_full, df_history)
 
-    # Rename and construct last variables depending on the strategy
-    df_full = df_full.rename(columns={'ym':'ldate'})
-    df_full = df_full.rename(columns={'ret':'daret'})
-    if _STRATEGY_NAME == 'Value':
-        df_full = df_full.rename(columns={'ceq':'be'})
-    elif _STRATEGY_NAME == 'Quality':
-        df_full['profitA'] = (df_full['revt']-df_full['cogs'])/df_full['at']
-    
-    # Reformat date
-    df_full['ldate'] = df_full['ldate'].dt.to_timestamp()
+        # Rename and construct last variables depending on the strategy
+        df_full = df_full.rename(columns={'ym':'ldate'})
+        df_full = df_full.rename(columns={'ret':'daret'})
+        if _STRATEGY_NAME == 'Value':
+            df_full = df_full.rename(columns={'ceq':'be'})
+        elif _STRATEGY_NAME == 'Quality':
+            df_full['profitA'] = (df_full['revt']-df_full['cogs'])/df_full['at']
+        
+        # Reformat date
+        df_full['ldate'] = df_full['ldate'].dt.to_timestamp()
 
-    print('Done')
-    ###############################################
-    ## Step 6. Lag Market Cap
-    ###############################################
-    print('Step 6. Lag Market Cap')
-    
-    df_full.drop_duplicates(subset = ['permno', 'ldate'], keep = 'first', inplace = True)
-    df_full.sort_values(by = ['permno', 'ldate'], inplace = True)
+        qpm.step_done()
+        ###############################################
+        ## Step 7. Lag Market Cap
+        ###############################################
+        qpm.step('Step 7. Lag Market Cap', 'cross_section_compact')
+        
+        df_full.drop_duplicates(subset = ['permno', 'ldate'], keep = 'first', inplace = True)
+        
+        # Downcast identifiers (and characteristics with float32) before sorting, see qpm.compact_panel;
+        # streamed partitions are written as downloaded (load_data(compact = True) compacts them)
+        if compact and output_dir is None:
+            qpm.compact_panel(df_full, float32)
+        
+        df_full.sort_values(by = ['permno', 'ldate'], inplace = True)
 
-    df_full['ldate_lag'] = df_full.groupby(['permno'])['ldate'].shift(1)
-    df_full['screen'] = (df_full['ldate_lag'] == df_full['ldate'] - pd.DateOffset(months=1)).astype(int).replace(0, np.nan)
+        df_full['ldate_lag'] = df_full.groupby(['permno'])['ldate'].shift(1)
+        df_full['screen'] = (df_full['ldate_lag'] == df_full['ldate'] - pd.DateOffset(months=1)).astype(int).replace(0, np.nan)
 
-    df_full['me_lagged'] = df_full.groupby(['permno'])['me'].shift(1).multiply(df_full['screen'])
-    df_full.drop(['ldate_lag','screen'], axis=1, inplace=True)
-    
-    # Save Fama-French Data
-    df_full[['ldate', 'rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma']].drop_duplicates().to_parquet('FFData.parquet')
+        df_full['me_lagged'] = df_full.groupby(['permno'])['me'].shift(1).multiply(df_full['screen'])
+        
+        # The first month of each stock lags into earlier windows (see _window_lags)
+        if output_dir is not None:
+            df_last = _window_lags(df_full, df_last)
+        df_full.drop(['ldate_lag','screen'], axis=1, inplace=True)
+        
+        # Write the window's years (appended to the existing partitions in incremental mode, otherwise replacing
+        # the whole dataset)
+        if output_dir is not None:
+            if i == 0 and not incremental:
+                qpm.clear_partitions(output_dir)
+            qpm.write_partitions(df_full, output_dir, append = incremental)
+        
+        qpm.step_done()
     
-    print('Done')
+    # Register Fama-French Data (a stream keeps only its last window in memory, so from the factor query)
+    if output_dir is not None:
+        qpm.register_factors(_sample_factors(df_FF, _SAMPLE_START, _SAMPLE_END))
+        return output_dir
+    qpm.register_factors(df_full)
     
     return df_full
 
-def cross_section(_SAMPLE_START, _SAMPLE_END):
-    
-    # Establish connection with wrds
-    db = wrds.Connection()
+@_cancel_on_error
+def cross_section(_SAMPLE_START, _SAMPLE_END, compact = False, float32 = False, output_dir = None, chunk_years = 1,
+                  incremental = False):
+    
+    # With output_dir, CRSP returns are downloaded chunk_years at a time and written to output_dir (see Streaming Downloads)
+    # With incremental = True, only the months after those already in output_dir are downloaded (see Incremental Downloads)
+    crsp_start, funda_start, df_history, df_last = _SAMPLE_START, _SAMPLE_START, None, None
+    if incremental:
+        if output_dir is None:
+            raise Exception('Incremental downloads continue the dataset in output_dir.')
+        crsp_start, funda_start, df_history, df_last = _increment(output_dir, _SAMPLE_START, _SAMPLE_END)
+        if crsp_start is None:
+            qpm.log('> %s is up to date' %(output_dir))
+            return output_dir
+    
+    # Shared connection with wrds (see get_session)
+    db = get_session()
     
     ###############################################
-    ## Step 1. Import Fundamentals from Compustat
+    ## Submit Queries
     ###############################################
-    print('Step 1. Import Fundamentals from Compustat')
+    
+    # No query depends on another's result: all of them are sent now, run concurrently on the
+    # shared pool (see _submit), and each step below waits only for the results it needs
+    queries = {}
     
     # Define your SQL statement for Compustat data
     sql_statement = """
@@ -265,13 +819,8 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     AND a.indfmt = 'INDL' AND a.datadate >= '{}' AND a.datadate <= '{}'
     """
     
-    # Perform the query
-    df_Compustat = db.raw_sql(sql_statement.format(_SAMPLE_START, _SAMPLE_END))
-    
-    # Require minimum information
-    df_Compustat = df_Compustat[(df_Compustat['at'].notna()) & 
-                                (df_Compustat['ni'].notna()) & 
-                                (df_Compustat['prcc_c'].notna())]
+    # Send the query
+    queries['Compustat'] = _submit(db, sql_statement.format(funda_start, _SAMPLE_END))
     
     # Define your SQL statement for link dataset
     sql_statement = """
@@ -284,8 +833,104 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     ORDER BY a.gvkey
     """
     
-    # Perform the query
-    df_Link = db.raw_sql(sql_statement)
+    # Send the query
+    queries['Link'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for Trucost ESG scores
+    sql_statement = """
+    SELECT scoredate, scorevalue, institutionid, aspectname
+    FROM TRUCOST.WRDS_ESG as a
+    WHERE aspectname in ('Environmental Dimension', 'S&P Global ESG Score',
+                         'Economic Governance Dimension', 'Social Dimension')
+    AND csascoretypename = 'Modeled'
+    """
+    
+    # Incremental mode: scores from each institution's last one before the new months, which Step 4 carries forward
+    if incremental:
+        sql_statement += """AND scoredate >= COALESCE((SELECT MAX(b.scoredate) FROM TRUCOST.WRDS_ESG as b
+                                       WHERE b.institutionid = a.institutionid AND b.scoredate < '{0}'
+                                       AND b.aspectname in ('Environmental Dimension', 'S&P Global ESG Score',
+                                                            'Economic Governance Dimension', 'Social Dimension')
+                                       AND b.csascoretypename = 'Modeled' AND b.scorevalue IS NOT NULL), '{0}')
+    """.format(crsp_start)
+
+    # Send the query
+    queries['Scores'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for Trucost carbon intensity
+    sql_statement = """
+    SELECT institutionid, periodenddate, di_319407
+    FROM TRUCOST.WRDS_ENVIRONMENT as a
+    """
+    
+    # Incremental mode: records from each institution's last one before the new months, which Step 4 carries forward
+    if incremental:
+        sql_statement += """WHERE periodenddate >= COALESCE((SELECT MAX(b.periodenddate) FROM TRUCOST.WRDS_ENVIRONMENT as b
+                                             WHERE b.institutionid = a.institutionid AND b.periodenddate < '{0}'
+                                             AND b.di_319407 IS NOT NULL), '{0}')
+    """.format(crsp_start)
+
+    # Send the query
+    queries['CI'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for firms' identifiers
+    sql_statement = """
+    SELECT gvkey, institutionid
+    FROM trucost.wrds_companies
+    """
+    # Send the query
+    queries['ID'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for monthly data
+    sql_CRSP = """
+    SELECT a.permno, b.ticker, a.date, a.ret, a.retx, a.vol, 
+           a.shrout, a.prc, b.shrcd, b.exchcd, b.comnam, c.dlstcd, c.dlret
+    FROM crsp_m_stock.msf as a
+    LEFT JOIN crsp_m_stock.msenames as b
+    ON a.permno=b.permno AND b.namedt<=a.date AND a.date<=b.nameendt
+    LEFT JOIN crsp_m_stock.msedelist as c
+    ON a.permno=c.permno AND date_trunc('month', a.date) = date_trunc('month', c.dlstdt)
+    WHERE a.date >= '{}' AND a.date <= '{}'
+    """
+    
+    # Send the query (for the first window of months when streaming, see _windows)
+    windows = _windows(crsp_start, _SAMPLE_END, chunk_years if output_dir is not None else None)
+    chunksize = _CHUNKSIZE if output_dir is not None else None
+    queries['CRSP'] = _submit(db, sql_CRSP.format(*windows[0]), chunksize)
+    
+    # Define your SQL statement for Fama-French factors
+    sql_statement = """
+    SELECT date, mktrf, smb, hml, rf, umd, rmw, cma
+    FROM ff.fivefactors_monthly
+    """
+    
+    # Send the query
+    queries['FF'] = _submit(db, sql_statement)
+    
+    # Define your SQL statement for Market returns from CRSP
+    sql_statement = """
+    SELECT date, vwretd
+    FROM crsp_m_stock.msi
+    """
+    
+    # Send the query
+    queries['Mkt'] = _submit(db, sql_statement)
+    
+    ###############################################
+    ## Step 1. Import Fundamentals from Compustat
+    ###############################################
+    qpm.step('Step 1. Import Fundamentals from Compustat', 'cross_section')
+    
+    # Wait for the query (see Submit Queries)
+    df_Compustat = queries['Compustat'].result()
+    
+    # Require minimum information
+    df_Compustat = df_Compustat[(df_Compustat['at'].notna()) & 
+                                (df_Compustat['ni'].notna()) & 
+                                (df_Compustat['prcc_c'].notna())]
+    
+    # Wait for the query (see Submit Queries)
+    df_Link = queries['Link'].result()
     
     # Rename variables
     df_Link = df_Link.rename(columns={'lpermno':'permno','linkdt':'StartDate','linkenddt':'EndDate'})
@@ -299,11 +944,11 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     # Merge
     df_Compustat = pd.merge(df_Compustat, df_Link, on='gvkey', how='inner')
     
-    print('Done')
+    qpm.step_done()
     ###############################################
     ## Step 2. Adjust Fundamentals from Compustat
     ###############################################
-    print('Step 2. Adjust Fundamentals from Compustat')
+    qpm.step('Step 2. Adjust Fundamentals from Compustat', 'cross_section')
         
     # Restrict to observations with valid date
     df_Compustat = df_Compustat[(df_Compustat['StartDate'] <= df_Compustat['datadate']) & 
@@ -334,24 +979,15 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     df_Compustat = df_Compustat.sort_values(by=['permno','ym','datadate'])
     df_Compustat = df_Compustat.groupby(['permno','ym']).last().reset_index()
     
-    print('Done')
+    qpm.step_done()
     ###############################################
     ## Step 3. Import Fundamentals from Trucost
     ###############################################
-    print('Step 3. Import Fundamentals from Trucost')
+    qpm.step('Step 3. Import Fundamentals from Trucost', 'cross_section')
 
 
-    # Define your SQL statement for Trucost ESG scores
-    sql_statement = """
-    SELECT scoredate, scorevalue, institutionid, aspectname
-    FROM TRUCOST.WRDS_ESG
-    WHERE aspectname in ('Environmental Dimension', 'S&P Global ESG Score',
-                         'Economic Governance Dimension', 'Social Dimension')
-    AND csascoretypename = 'Modeled'
-    """
-
-    # Perform the query
-    df_Scores = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_Scores = queries['Scores'].result()
 
     # Require minimum information
     df_Scores = df_Scores[(df_Scores['scoredate'].notna()) & 
@@ -360,14 +996,8 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     # Reformat date
     df_Scores['scoredate'] = pd.to_datetime(df_Scores['scoredate'])
 
-    # Define your SQL statement for Trucost carbon intensity
-    sql_statement = """
-    SELECT institutionid, periodenddate, di_319407
-    FROM TRUCOST.WRDS_ENVIRONMENT
-    """
-
-    # Perform the query
-    df_CI = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_CI = queries['CI'].result()
 
     # Require minimum information
     df_CI = df_CI[(df_CI['periodenddate'].notna()) & 
@@ -376,22 +1006,17 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     # Reformat date
     df_CI['periodenddate'] = pd.to_datetime(df_CI['periodenddate'])
 
-    # Define your SQL statement for firms' identifiers
-    sql_statement = """
-    SELECT gvkey, institutionid
-    FROM trucost.wrds_companies
-    """
-    # Perform the query
-    df_ID = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_ID = queries['ID'].result()
 
     # Drop duplicates
     df_ID = df_ID.drop_duplicates(subset = ['institutionid'], keep = False)
 
-    print('Done')
+    qpm.step_done()
     ###############################################
     ## Step 4. Adjust Fundamentals from Trucost
     ###############################################
-    print('Step 4. Adjust Fundamentals from Trucost')
+    qpm.step('Step 4. Adjust Fundamentals from Trucost', 'cross_section')
 
     # Rename scores
     df_Scores.loc[df_Scores['aspectname'] == 'S&P Global ESG Score', 'aspectname'] = 'ESG_score'
@@ -460,149 +1085,167 @@ def cross_section(_SAMPLE_START, _SAMPLE_END):
     df_ESG = df_ESG[['permno','ldate','ESG_score','E_score',
                      'S_score','G_score','carbon_intensity']]
 
-    print('Done')
+    qpm.step_done()
     ###############################################
-    ## Step 5. Import Returns and Factors
+    ## Step 5. Import Factors
     ###############################################
-    print('Step 5. Import Returns and Factors')
-        
-    # Define your SQL statement for monthly data
-    sql_statement = """
-    SELECT a.permno, b.ticker, a.date, a.ret, a.retx, a.vol, 
-           a.shrout, a.prc, b.shrcd, b.exchcd, b.comnam, c.dlstcd, c.dlret
-    FROM crsp_m_stock.msf as a
-    LEFT JOIN crsp_m_stock.msenames as b
-    ON a.permno=b.permno AND b.namedt<=a.date AND a.date<=b.nameendt
-    LEFT JOIN crsp_m_stock.msedelist as c
-    ON a.permno=c.permno AND date_trunc('month', a.date) = date_trunc('month', c.dlstdt)
-    WHERE a.date >= '{}' AND a.date <= '{}'
-    """
+    qpm.step('Step 5. Import Factors', 'cross_section')
     
-    # Perform the query
-    df_CRSP = db.raw_sql(sql_statement.format(_SAMPLE_START, _SAMPLE_END))
-    
-    # Reformat date
-    df_CRSP['date'] = pd.to_datetime(df_CRSP['date'])
-    df_CRSP['ym'] = pd.PeriodIndex(df_CRSP.date, freq='M')
-    df_CRSP = df_CRSP.drop('date', axis=1).reset_index(drop=True)
-    
-    # Adjust returns for delisting
-    df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & ( (df_CRSP['exchcd']==1) | (df_CRSP['exchcd']==2) ), 'dlret'] = -0.35
-    df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & (df_CRSP['exchcd']==3), 'dlret'] = -0.55
-    df_CRSP.loc[df_CRSP['dlret']<-1, 'dlret'] = -1.0
-    df_CRSP.loc[df_CRSP['dlret'].isna(), 'dlret'] = 0.0
-    df_CRSP['ret'] = df_CRSP['ret'] + df_CRSP['dlret']
-    df_CRSP.loc[(df_CRSP['ret'].isna()) & (df_CRSP['dlret']!=0.0), 'ret'] = df_CRSP['dlret']
-    
-    # Convert units and construct market cap
-    df_CRSP['shrout'] = df_CRSP['shrout']/1000
-    df_CRSP['vol'] = df_CRSP['vol']/10000
-    df_CRSP['mve_c'] = df_CRSP['shrout']*abs(df_CRSP['prc'])
-    
-    # Retain only common shares traded on NASDAQ, NYSE and AMEX
-    df_CRSP = df_CRSP[( (df_CRSP['shrcd'] == 10) | (df_CRSP['shrcd'] == 11) | (df_CRSP['shrcd'] == 12) ) & 
-                      ( (df_CRSP['exchcd'] == 1) | (df_CRSP['exchcd'] == 2) | (df_CRSP['exchcd'] == 3) )]
-    
-    # Define your SQL statement for Fama-French factors
-    sql_statement = """
-    SELECT date, mktrf, smb, hml, rf, umd, rmw, cma
-    FROM ff.fivefactors_monthly
-    """
-    
-    # Perform the query
-    df_FF = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_FF = queries['FF'].result()
     
     # Reformat date
     df_FF['date'] = pd.to_datetime(df_FF['date'])
     df_FF['ym'] = pd.PeriodIndex(df_FF.date, freq='M')
     df_FF.drop('date', axis=1, inplace=True)
     
-    # Define your SQL statement for Market returns from CRSP
-    sql_statement = """
-    SELECT date, vwretd
-    FROM crsp_m_stock.msi
-    """
-    
-    # Perform the query
-    df_Mkt = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_Mkt = queries['Mkt'].result()
     
     # Reformat date
     df_Mkt['date'] = pd.to_datetime(df_Mkt['date'])
     df_Mkt['ym'] = pd.PeriodIndex(df_Mkt.date, freq='M')
     df_Mkt.drop('date', axis=1, inplace=True)
     
-    print('Done')
-    ###############################################
-    ## Step 6. Merge Datasets
-    ###############################################
-    print('Step 6. Merge Datasets')
+    qpm.step_done()
     
-    # Merge CRSP and Compustat
-    df_full = pd.merge(df_CRSP, df_Compustat, on=['permno','ym'], how='inner', validate='1:1')
+    # Steps 6 to 9 run once per window of months: the whole sample, or chunk_years at a time when streaming to
+    # output_dir. Earlier windows pass on what the next one needs (see _window_betas and _window_lags).
+    for i, (window_start, window_end) in enumerate(windows):
+        
+        ###############################################
+        ## Step 6. Import Returns
+        ###############################################
+        qpm.step('Step 6. Import Returns (%s to %s)' %(window_start, window_end), 'cross_section')
+        
+        # Wait for the query and send the one for the next window
+        df_CRSP = queries.pop('CRSP').result()
+        if i + 1 < len(windows):
+            queries['CRSP'] = _submit(db, sql_CRSP.format(*windows[i + 1]), chunksize)
+        
+        # Reformat date
+        df_CRSP['date'] = pd.to_datetime(df_CRSP['date'])
+        df_CRSP['ym'] = pd.PeriodIndex(df_CRSP.date, freq='M')
+        df_CRSP = df_CRSP.drop('date', axis=1).reset_index(drop=True)
+        
+        # Adjust returns for delisting
+        df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & ( (df_CRSP['exchcd']==1) | (df_CRSP['exchcd']==2) ), 'dlret'] = -0.35
+        df_CRSP.loc[( df_CRSP['dlret'].isna() ) & ( (df_CRSP['dlstcd']==500) | ( (df_CRSP['dlstcd']>=520) & (df_CRSP['dlstcd']<=584) ) ) & (df_CRSP['exchcd']==3), 'dlret'] = -0.55
+        df_CRSP.loc[df_CRSP['dlret']<-1, 'dlret'] = -1.0
+        df_CRSP.loc[df_CRSP['dlret'].isna(), 'dlret'] = 0.0
+        df_CRSP['ret'] = df_CRSP['ret'] + df_CRSP['dlret']
+        df_CRSP.loc[(df_CRSP['ret'].isna()) & (df_CRSP['dlret']!=0.0), 'ret'] = df_CRSP['dlret']
+        
+        # Convert units and construct market cap
+        df_CRSP['shrout'] = df_CRSP['shrout']/1000
+        df_CRSP['vol'] = df_CRSP['vol']/10000
+        df_CRSP['mve_c'] = df_CRSP['shrout']*abs(df_CRSP['prc'])
+        
+        # Retain only common shares traded on NASDAQ, NYSE and AMEX
+        df_CRSP = df_CRSP[( (df_CRSP['shrcd'] == 10) | (df_CRSP['shrcd'] == 11) | (df_CRSP['shrcd'] == 12) ) & 
+                          ( (df_CRSP['exchcd'] == 1) | (df_CRSP['exchcd'] == 2) | (df_CRSP['exchcd'] == 3) )]
+        
+        qpm.step_done()
+        ###############################################
+        ## Step 7. Merge Datasets
+        ###############################################
+        qpm.step('Step 7. Merge Datasets', 'cross_section')
+        
+        # Merge CRSP and Compustat
+        df_full = pd.merge(df_CRSP, df_Compustat, on=['permno','ym'], how='inner', validate='1:1')
 
-    # Merge master dataset with factors
-    df_full = pd.merge(df_full, df_FF, on='ym', how='inner', validate='m:1')
-    df_full = pd.merge(df_full, df_Mkt, on='ym', how='inner', validate='m:1')
-    
-    print('Done')
-    ###############################################
-    ## Step 7. Compute Rolling Beta and Last Edits
-    ###############################################
-    print('Step 7. Compute Rolling Beta and Last Edits')
+        # Merge master dataset with factors
+        df_full = pd.merge(df_full, df_FF, on='ym', how='inner', validate='m:1')
+        df_full = pd.merge(df_full, df_Mkt, on='ym', how='inner', validate='m:1')
+        
+        qpm.step_done()
+        ###############################################
+        ## Step 8. Compute Rolling Beta and Last Edits
+        ###############################################
+        qpm.step('Step 8. Compute Rolling Beta and Last Edits', 'cross_section')
 
-    df_full = qpm_download.rolling_betas(df_full)
+        if output_dir is None:
+            df_full = qpm_download.rolling_betas(df_full)
+        else:
+            df_full, df_history = _window_betas(df_full, df_history)
 
-    # Rename and construct last variables
-    df_full = df_full.rename(columns={'ym':'ldate'})
-    df_full = df_full.rename(columns={'mve_c':'me'})
-    df_full = df_full.rename(columns={'ret':'daret'})
-    df_full = df_full.rename(columns={'ceq':'be'})
-    df_full['profitA'] = (df_full['revt']-df_full['cogs'])/df_full['at']
+        # Rename and construct last variables
+        df_full = df_full.rename(columns={'ym':'ldate'})
+        df_full = df_full.rename(columns={'mve_c':'me'})
+        df_full = df_full.rename(columns={'ret':'daret'})
+        df_full = df_full.rename(columns={'ceq':'be'})
+        df_full['profitA'] = (df_full['revt']-df_full['cogs'])/df_full['at']
 
-    # Merge master dataset with ESG data
-    df_full = pd.merge(df_full, df_ESG, on=['permno','ldate'], how='left', validate='1:1')
-    
-    # Reformat date
-    df_full['ldate'] = df_full['ldate'].dt.to_timestamp()
-    
-    # Restrict to variables of interest
-    df_full = df_full[['permno','ticker','conm','retx','vwretd','mktrf','smb','hml','rf','umd','rmw',
-                       'cma','ldate','me','be','daret','vol','shrout','prc','shrcd','exchcd',
-                       'revt','cogs','at','beta','profitA','ESG_score','E_score','S_score','G_score','carbon_intensity']]
+        # Merge master dataset with ESG data
+        df_full = pd.merge(df_full, df_ESG, on=['permno','ldate'], how='left', validate='1:1')
+        
+        # Reformat date
+        df_full['ldate'] = df_full['ldate'].dt.to_timestamp()
+        
+        # Restrict to variables of interest
+        df_full = df_full[['permno','ticker','conm','retx','vwretd','mktrf','smb','hml','rf','umd','rmw',
+                           'cma','ldate','me','be','daret','vol','shrout','prc','shrcd','exchcd',
+                           'revt','cogs','at','beta','profitA','ESG_score','E_score','S_score','G_score','carbon_intensity']]
 
-    print('Done')
-    ###############################################
-    ## Step 8. Lag Market Cap
-    ###############################################
-    print('Step 8. Lag Market Cap')
-    
-    df_full.drop_duplicates(subset = ['permno', 'ldate'], keep = 'first', inplace = True)
-    df_full.sort_values(by = ['permno', 'ldate'], inplace = True)
+        qpm.step_done()
+        ###############################################
+        ## Step 9. Lag Market Cap
+        ###############################################
+        qpm.step('Step 9. Lag Market Cap', 'cross_section')
+        
+        df_full.drop_duplicates(subset = ['permno', 'ldate'], keep = 'first', inplace = True)
+        
+        # Downcast identifiers (and characteristics with float32) before sorting, see qpm.compact_panel;
+        # streamed partitions are written as downloaded (load_data(compact = True) compacts them)
+        if compact and output_dir is None:
+            qpm.compact_panel(df_full, float32)
+        
+        df_full.sort_values(by = ['permno', 'ldate'], inplace = True)
 
-    df_full['ldate_lag'] = df_full.groupby(['permno'])['ldate'].shift(1)
-    df_full['screen'] = (df_full['ldate_lag'] == df_full['ldate'] - pd.DateOffset(months=1)).astype(int).replace(0, np.nan)
+        df_full['ldate_lag'] = df_full.groupby(['permno'])['ldate'].shift(1)
+        df_full['screen'] = (df_full['ldate_lag'] == df_full['ldate'] - pd.DateOffset(months=1)).astype(int).replace(0, np.nan)
 
-    df_full['me_lagged'] = df_full.groupby(['permno'])['me'].shift(1).multiply(df_full['screen'])
-    
-    # Save Fama-French Data
-    df_full[['ldate', 'rf', 'mktrf', 'smb', 'hml', 'umd', 'rmw', 'cma']].drop_duplicates().to_parquet('FFData.parquet')
+        df_full['me_lagged'] = df_full.groupby(['permno'])['me'].shift(1).multiply(df_full['screen'])
+        
+        # The first month of each stock lags into earlier windows (see _window_lags)
+        if output_dir is not None:
+            df_last = _window_lags(df_full, df_last)
+        
+        # Write the window's years (appended to the existing partitions in incremental mode, otherwise replacing
+        # the whole dataset)
+        if output_dir is not None:
+            if i == 0 and not incremental:
+                qpm.clear_partitions(output_dir)
+            qpm.write_partitions(df_full, output_dir, append = incremental)
+        
+        qpm.step_done()
     
-    print('Done')
+    # Register Fama-French Data (a stream keeps only its last window in memory, so from the factor query)
+    if output_dir is not None:
+        qpm.register_factors(_sample_factors(df_FF, _SAMPLE_START, _SAMPLE_END))
+        return output_dir
+    qpm.register_factors(df_full)
     
     return df_full
 
-def time_series(_SAMPLE_START, _SAMPLE_END):
+@_cancel_on_error
+def time_series(_SAMPLE_START, _SAMPLE_END, output_dir = None, chunk_years = 1):
     
-    # Establish connection with wrds
-    db = wrds.Connection()
+    # With output_dir, daily returns are downloaded chunk_years at a time and written to output_dir (see Streaming Downloads)
+    
+    # Shared connection with wrds (see get_session)
+    db = get_session()
     
     ###############################################
-    ## Step 1. Import Daily Data
+    ## Submit Queries
     ###############################################
-    print('Step 1. Import Daily Data')
+    
+    # No query depends on another's result: all of them are sent now, run concurrently on the
+    # shared pool (see _submit), and each step below waits only for the results it needs
+    queries = {}
     
     # Define your SQL statement for daily data
-    sql_statement = """
+    sql_daily = """
     SELECT a.permno, b.ticker, a.date, a.ret                           
     FROM crsp_m_stock.dsf as a
     LEFT JOIN crsp_m_stock.dsenames as b
@@ -610,23 +1253,11 @@ def time_series(_SAMPLE_START, _SAMPLE_END):
     WHERE a.date >= '{}' AND a.date <= '{}' AND b.shrcd between 73 and 73 AND (b.ticker = 'SPY' OR b.ticker = 'XLF')
     """
     
-    # Perform the query
+    # Send the query (for the first window of days when streaming, see _windows)
     #df_ETF_daily = db.raw_sql(sql_statement.format('2003-01-01', '2023-07-31'))
-    df_ETF_daily = db.raw_sql(sql_statement.format('2003-01-01', _SAMPLE_END))
-    
-    # Construct monthly date
-    df_ETF_daily['date'] = pd.to_datetime(df_ETF_daily['date'])
-    df_ETF_daily['ym'] = df_ETF_daily['date'].apply(lambda x: x.replace(day=1))
-
-    # Restrict only to variables of interest and rename
-    df_ETF_daily = df_ETF_daily[['date','ym','permno','ret']].drop_duplicates()
-    df_ETF_daily = df_ETF_daily.rename(columns={'ret':'retd'})
-    
-    print('Done')
-    ###############################################
-    ## Step 2. Import Monthly Data
-    ###############################################
-    print('Step 2. Import Monthly Data')
+    windows = _windows('2003-01-01', _SAMPLE_END, chunk_years if output_dir is not None else None)
+    chunksize = _CHUNKSIZE if output_dir is not None else None
+    queries['ETF_daily'] = _submit(db, sql_daily.format(*windows[0]), chunksize)
     
     # Define your SQL statement for monthly data
     sql_statement = """
@@ -637,8 +1268,25 @@ def time_series(_SAMPLE_START, _SAMPLE_END):
     WHERE a.date >= '{}' AND a.date <= '{}' AND b.shrcd between 73 and 73 AND (b.ticker = 'SPY' OR b.ticker = 'XLF')
     """
     
-    # Perform the query
-    df_ETF_monthly = db.raw_sql(sql_statement.format('2003-01-01', _SAMPLE_END))
+    # Send the query
+    queries['ETF_monthly'] = _submit(db, sql_statement.format('2003-01-01', _SAMPLE_END))
+    
+    # Define your SQL statement for FF factors
+    sql_statement = """
+    SELECT date, mktrf, rf
+    FROM ff.fivefactors_monthly
+    """
+    
+    # Send the query
+    queries['FF'] = _submit(db, sql_statement)
+    
+    ###############################################
+    ## Step 1. Import Monthly Data
+    ###############################################
+    qpm.step('Step 1. Import Monthly Data', 'time_series')
+    
+    # Wait for the query (see Submit Queries)
+    df_ETF_monthly = queries['ETF_monthly'].result()
     
     # Construct monthly date
     df_ETF_monthly['ym'] = pd.to_datetime(df_ETF_monthly['date']).apply(lambda x: x.replace(day=1))
@@ -647,20 +1295,14 @@ def time_series(_SAMPLE_START, _SAMPLE_END):
     df_ETF_monthly = df_ETF_monthly[['ym','permno','ticker','ret']].drop_duplicates()
     df_ETF_monthly = df_ETF_monthly.rename(columns={'ret':'retM'})
     
-    print('Done')
+    qpm.step_done()
     ###############################################
-    ## Step 3. Import Fama-French Factors
+    ## Step 2. Import Fama-French Factors
     ###############################################
-    print('Step 3. Import Fama-French Factors')
+    qpm.step('Step 2. Import Fama-French Factors', 'time_series')
     
-    # Define your SQL statement for FF factors
-    sql_statement = """
-    SELECT date, mktrf, rf
-    FROM ff.fivefactors_monthly
-    """
-    
-    # Perform the query
-    df_FF = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_FF = queries['FF'].result()
     
     # Construct monthly date
     df_FF['ym'] = pd.to_datetime(df_FF['date']).apply(lambda x: x.replace(day=1))
@@ -668,24 +1310,61 @@ def time_series(_SAMPLE_START, _SAMPLE_END):
     # Restrict only to variables of interest and rename
     df_FF = df_FF[['ym','mktrf','rf']]
     
-    # Merge the various datasets together
-    df_ETF_raw = pd.merge(left = df_ETF_daily, right = df_ETF_monthly, on =['ym','permno'], how = 'inner', validate = 'm:1')
-    df_ETF_raw = pd.merge(left = df_ETF_raw, right = df_FF, on ='ym', how = 'inner', validate = 'm:1')
+    qpm.step_done()
     
-    return df_ETF_raw
+    # Step 3 runs once per window of days: the whole sample, or chunk_years at a time when streaming to output_dir
+    for i, (window_start, window_end) in enumerate(windows):
+        
+        ###############################################
+        ## Step 3. Import Daily Data
+        ###############################################
+        qpm.step('Step 3. Import Daily Data (%s to %s)' %(window_start, window_end), 'time_series')
+        
+        # Wait for the query and send the one for the next window
+        df_ETF_daily = queries.pop('ETF_daily').result()
+        if i + 1 < len(windows):
+            queries['ETF_daily'] = _submit(db, sql_daily.format(*windows[i + 1]), chunksize)
+        
+        # Construct monthly date
+        df_ETF_daily['date'] = pd.to_datetime(df_ETF_daily['date'])
+        df_ETF_daily['ym'] = df_ETF_daily['date'].apply(lambda x: x.replace(day=1))
 
-def etfs(_SAMPLE_START, _SAMPLE_END):
+        # Restrict only to variables of interest and rename
+        df_ETF_daily = df_ETF_daily[['date','ym','permno','ret']].drop_duplicates()
+        df_ETF_daily = df_ETF_daily.rename(columns={'ret':'retd'})
+        
+        # Merge the various datasets together
+        df_ETF_raw = pd.merge(left = df_ETF_daily, right = df_ETF_monthly, on =['ym','permno'], how = 'inner', validate = 'm:1')
+        df_ETF_raw = pd.merge(left = df_ETF_raw, right = df_FF, on ='ym', how = 'inner', validate = 'm:1')
+        
+        # Write the window's years (replacing the whole dataset)
+        if output_dir is not None:
+            if i == 0:
+                qpm.clear_partitions(output_dir)
+            qpm.write_partitions(df_ETF_raw, output_dir, date_column = 'date')
+    
+    qpm.close_step()
     
-    # Establish connection with wrds
-    db = wrds.Connection()
+    return df_ETF_raw if output_dir is None else output_dir
+
+@_cancel_on_error
+def etfs(_SAMPLE_START, _SAMPLE_END, output_dir = None, chunk_years = 1):
+    
+    # With output_dir, daily returns are downloaded chunk_years at a time and written to output_dir (see Streaming Downloads)
+    
+    # Shared connection with wrds (see get_session)
+    db = get_session()
     
     ###############################################
-    ## Step 1. Import Daily Data
+    ## Submit Queries
     ###############################################
-    print('Step 1. Import Daily Data')
+    
+    # No query depends on another's result: all of them are sent now, run concurrently on the
+    # shared pool (see _submit), and each step below waits only for the results it needs
+    queries = {}
     
     # Define your SQL statement for daily data
-    sql_statement = """
+    sql_daily = """
     SELECT a.permno, b.ticker, a.date, a.ret                           
     FROM crsp_m_stock.dsf as a
     LEFT JOIN crsp_m_stock.dsenames as b
@@ -693,23 +1372,11 @@ def etfs(_SAMPLE_START, _SAMPLE_END):
     WHERE a.date >= '{}' AND a.date <= '{}' AND b.shrcd between 73 and 73 AND (b.ticker = 'IYF' OR b.ticker = 'IYK' OR b.ticker = 'IYW' OR b.ticker = 'IYZ' OR b.ticker = 'IYE')
     """
     
-    # Perform the query
+    # Send the query (for the first window of days when streaming, see _windows)
     #df_ETF_daily = db.raw_sql(sql_statement.format('2003-01-01', '2023-07-31'))
-    df_ETF_daily = db.raw_sql(sql_statement.format('2003-01-01', _SAMPLE_END))
-    
-    # Construct monthly date
-    df_ETF_daily['date'] = pd.to_datetime(df_ETF_daily['date'])
-    df_ETF_daily['ym'] = df_ETF_daily['date'].apply(lambda x: x.replace(day=1))
-
-    # Restrict only to variables of interest and rename
-    df_ETF_daily = df_ETF_daily[['date','ym','permno','ret']].drop_duplicates()
-    df_ETF_daily = df_ETF_daily.rename(columns={'ret':'retd'})
-    
-    print('Done')
-    ###############################################
-    ## Step 2. Import Monthly Data
-    ###############################################
-    print('Step 2. Import Monthly Data')
+    windows = _windows('2003-01-01', _SAMPLE_END, chunk_years if output_dir is not None else None)
+    chunksize = _CHUNKSIZE if output_dir is not None else None
+    queries['ETF_daily'] = _submit(db, sql_daily.format(*windows[0]), chunksize)
     
     # Define your SQL statement for monthly data
     sql_statement = """
@@ -720,8 +1387,25 @@ def etfs(_SAMPLE_START, _SAMPLE_END):
     WHERE a.date >= '{}' AND a.date <= '{}' AND b.shrcd between 73 and 73 AND (b.ticker = 'IYF' OR b.ticker = 'IYK' OR b.ticker = 'IYW' OR b.ticker = 'IYZ' OR b.ticker = 'IYE')
     """
 
-    # Perform the query
-    df_ETF_monthly = db.raw_sql(sql_statement.format('2003-01-01', _SAMPLE_END))
+    # Send the query
+    queries['ETF_monthly'] = _submit(db, sql_statement.format('2003-01-01', _SAMPLE_END))
+    
+    # Define your SQL statement for FF factors
+    sql_statement = """
+    SELECT date, mktrf, rf
+    FROM ff.fivefactors_monthly
+    """
+    
+    # Send the query
+    queries['FF'] = _submit(db, sql_statement)
+    
+    ###############################################
+    ## Step 1. Import Monthly Data
+    ###############################################
+    qpm.step('Step 1. Import Monthly Data', 'etfs')
+    
+    # Wait for the query (see Submit Queries)
+    df_ETF_monthly = queries['ETF_monthly'].result()
     
     # Construct monthly date
     df_ETF_monthly['ym'] = pd.to_datetime(df_ETF_monthly['date']).apply(lambda x: x.replace(day=1))
@@ -730,20 +1414,14 @@ def etfs(_SAMPLE_START, _SAMPLE_END):
     df_ETF_monthly = df_ETF_monthly[['ym','permno','ticker','ret']].drop_duplicates()
     df_ETF_monthly = df_ETF_monthly.rename(columns={'ret':'retM'})
     
-    print('Done')
+    qpm.step_done()
     ###############################################
-    ## Step 3. Import Fama-French Factors
+    ## Step 2. Import Fama-French Factors
     ###############################################
-    print('Step 3. Import Fama-French Factors')
+    qpm.step('Step 2. Import Fama-French Factors', 'etfs')
     
-    # Define your SQL statement for FF factors
-    sql_statement = """
-    SELECT date, mktrf, rf
-    FROM ff.fivefactors_monthly
-    """
-    
-    # Perform the query
-    df_FF = db.raw_sql(sql_statement)
+    # Wait for the query (see Submit Queries)
+    df_FF = queries['FF'].result()
     
     # Construct monthly date
     df_FF['ym'] = pd.to_datetime(df_FF['date']).apply(lambda x: x.replace(day=1))
@@ -751,16 +1429,47 @@ def etfs(_SAMPLE_START, _SAMPLE_END):
     # Restrict only to variables of interest and rename
     df_FF = df_FF[['ym','mktrf','rf']]
     
-    # Merge the various datasets together
-    df_ETF_raw = pd.merge(left = df_ETF_daily, right = df_ETF_monthly, on =['ym','permno'], how = 'inner', validate = 'm:1')
-    df_ETF_raw = pd.merge(left = df_ETF_raw, right = df_FF, on ='ym', how = 'inner', validate = 'm:1')
+    qpm.step_done()
     
-    return df_ETF_raw
+    # Step 3 runs once per window of days: the whole sample, or chunk_years at a time when streaming to output_dir
+    for i, (window_start, window_end) in enumerate(windows):
+        
+        ###############################################
+        ## Step 3. Import Daily Data
+        ###############################################
+        qpm.step('Step 3. Import Daily Data (%s to %s)' %(window_start, window_end), 'etfs')
+        
+        # Wait for the query and send the one for the next window
+        df_ETF_daily = queries.pop('ETF_daily').result()
+        if i + 1 < len(windows):
+            queries['ETF_daily'] = _submit(db, sql_daily.format(*windows[i + 1]), chunksize)
+        
+        # Construct monthly date
+        df_ETF_daily['date'] = pd.to_datetime(df_ETF_daily['date'])
+        df_ETF_daily['ym'] = df_ETF_daily['date'].apply(lambda x: x.replace(day=1))
+
+        # Restrict only to variables of interest and rename
+        df_ETF_daily = df_ETF_daily[['date','ym','permno','ret']].drop_duplicates()
+        df_ETF_daily = df_ETF_daily.rename(columns={'ret':'retd'})
+        
+        # Merge the various datasets together
+        df_ETF_raw = pd.merge(left = df_ETF_daily, right = df_ETF_monthly, on =['ym','permno'], how = 'inner', validate = 'm:1')
+        df_ETF_raw = pd.merge(left = df_ETF_raw, right = df_FF, on ='ym', how = 'inner', validate = 'm:1')
+        
+        # Write the window's years (replacing the whole dataset)
+        if output_dir is not None:
+            if i == 0:
+                qpm.clear_partitions(output_dir)
+            qpm.write_partitions(df_ETF_raw, output_dir, date_column = 'date')
+    
+    qpm.close_step()
+    
+    return df_ETF_raw if output_dir is None else output_dir
 
 def FFdaily(_SAMPLE_START, _SAMPLE_END):
     
-    # Establish connection with wrds
-    db = wrds.Connection()
+    # Shared connection with wrds (see get_session)
+    db = get_session()
     
     # Define your SQL statement for FF factors
     sql_statement = """
@@ -769,12 +1478,15 @@ def FFdaily(_SAMPLE_START, _SAMPLE_END):
     """
     
     # Perform the query
-    df_FF = db.raw_sql(sql_statement.format(_SAMPLE_START, _SAMPLE_END))
+    df_FF = _query(db, sql_statement.format(_SAMPLE_START, _SAMPLE_END))
     
     # Construct monthly date
     df_FF['date'] = pd.to_datetime(df_FF['date'])
     df_FF['ym'] = pd.PeriodIndex(df_FF['date'], freq='M')
     
+    # Register Daily Fama-French Data
+    qpm.register_factors(df_FF, frequency = 'daily')
+    
     return df_FF
                   
 def rolling_betas(df):
@@ -0,0 +1,37 @@
+import sqlite3
+
+import qpm_download
+
+
+def _stand_in(path, rf):
+
+    # A DB-API connection holding ff.fivefactors_monthly (a table the query cache keeps) with one row
+    connection = sqlite3.connect(str(path / 'main.db'))
+    connection.execute("ATTACH DATABASE '%s' AS ff" %(path / 'ff.db'))
+    connection.execute('CREATE TABLE ff.fivefactors_monthly (date TEXT, rf REAL)')
+    connection.execute("INSERT INTO ff.fivefactors_monthly VALUES ('2020-01-31', ?)", (rf,))
+    connection.commit()
+
+    return qpm_download.Session(connection)
+
+
+def test_query_cache_is_per_session(tmp_path):
+
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    session_a, session_b = _stand_in(tmp_path / 'a', 0.01), _stand_in(tmp_path / 'b', 0.02)
+    qpm_download.set_query_cache(str(tmp_path / 'cache'))
+    qpm_download.reset_query_cache_stats()
+    sql_statement = 'SELECT date, rf FROM ff.fivefactors_monthly'
+
+    try:
+        assert session_a.source != session_b.source
+        assert qpm_download._query(session_a, sql_statement)['rf'].iloc[0] == 0.01
+        assert qpm_download._query(session_b, sql_statement)['rf'].iloc[0] == 0.02
+        assert qpm_download._query(session_a, sql_statement)['rf'].iloc[0] == 0.01
+
+        stats = qpm_download.query_cache_stats().loc['ff.fivefactors_monthly']
+        assert (stats['hits'], stats['misses']) == (1, 2)
+    finally:
+        qpm_download.set_query_cache()
+        qpm_download.reset_query_cache_stats()